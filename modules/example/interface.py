@@ -11,6 +11,7 @@ module_information = ModuleInformation( # Only service_name and module_supported
         # hidden: hides module from CLI help options
         # jwt_system_enable: handles bearer and refresh tokens automatically, though currently untested
         # private: override any public modules, only enabled with the -p/--private argument, currently broken
+        # static_track_info: track info holds no expiring links or tokens, so artist downloads reuse what planning fetched
     global_settings = {},
     global_storage_variables = [],
     session_settings = {},
@@ -95,6 +96,13 @@ class ModuleInterface:
             error = '' # only use if there is an error
         )
 
+    tracks_info_batch_size = 50 # optional, most ids get_tracks_info is given at once, 0 for the tracks prefetched ahead
+
+    def get_tracks_info(self, track_ids: list, quality_tier: QualityEnum, codec_options: CodecOptions, data={}) -> dict: # optional, for services with a bulk endpoint
+        # One request for a whole album or playlist instead of get_track_info per track, keyed by the track ID as a string
+        tracks_data = self.session.get_tracks(track_ids)
+        return {str(track_id): self.get_track_info(track_id, quality_tier, codec_options, data=tracks_data) for track_id in track_ids}
+
     def get_track_download(self, file_url, codec):
         track_location = create_temp_filename()
         # Do magic here
@@ -15,7 +15,7 @@ from orpheus.core import *
 from orpheus.music_downloader import beauty_format_seconds
 from orpheus.cli import watchdog, menu
 from utils.network import set_offline_mode, network_manager
-from orpheus.delivery import delivery_pipeline
+from orpheus.delivery import DownloadPlan, delivery_pipeline
 
 
 def _build_media_from_url(orpheus: Orpheus, link: str):
@@ -89,6 +89,14 @@ def _build_media_from_command(orpheus: Orpheus, parts):
     }
 
 
+def _arguments_or_file_entries(arguments):
+    # A single argument naming a file is a list of entries, one per line
+    if len(arguments) == 1 and os.path.exists(arguments[0]):
+        with open(arguments[0], 'r') as f:
+            return [line.strip() for line in f if line.strip()]
+    return arguments
+
+
 def _process_download_entries(orpheus: Orpheus, entries):
     path = orpheus.settings['global']['general']['download_path']
     if path.endswith('/'):
@@ -126,6 +134,38 @@ def _process_download_entries(orpheus: Orpheus, entries):
             future.result()
 
 
+def _format_bytes(size: int) -> str:
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024:
+            return f'{size:.1f} {unit}'
+        size /= 1024
+    return f'{size:.2f} TiB'
+
+
+def _print_plan_summary(plan: DownloadPlan):
+    summary = plan.summary()
+    print()
+    print(f'Tracks: {summary["tracks"]} ({summary["existing"]} already downloaded, {summary["skipped"]} skipped)')
+    print(f'To download: {summary["to_download"]} tracks, about {_format_bytes(summary["total_bytes"])}'
+          + (f' ({summary["unknown_size"]} of unknown size)' if summary['unknown_size'] else ''))
+    if summary['estimated_seconds'] is not None:
+        print(f'Estimated transfer time: {beauty_format_seconds(summary["estimated_seconds"])}')
+    else:
+        print('Estimated transfer time: unknown until something has been downloaded')
+
+
+def _third_party_modules_from_args(orpheus: Orpheus, args):
+    tpm = {ModuleModes.covers: '', ModuleModes.lyrics: '', ModuleModes.credits: ''}
+    for i in tpm:
+        moduleselected = getattr(args, i.name).lower()
+        if moduleselected == 'default':
+            moduleselected = orpheus.settings['global']['module_defaults'][i.name]
+        if moduleselected == 'default':
+            moduleselected = None
+        tpm[i] = moduleselected
+    return tpm
+
+
 def _interactive_download_input(orpheus: Orpheus):
     while True:
         try:
@@ -329,7 +369,8 @@ def main():
     help_ = 'Use "settings [option]" for orpheus controls (coreupdate, fullupdate, modinstall), "settings [module]' \
            '[option]" for module specific options (update, test, setup), searching by "[search/luckysearch] [module]' \
            '[track/artist/playlist/album] [query]", or just putting in urls. (you may need to wrap the URLs in double' \
-           'quotes if you have issues downloading)'
+           'quotes if you have issues downloading). "plan [urls]" previews a download into a plan file, "execute' \
+           ' [plan file]" downloads it, "retag [folder]" tags downloaded files again with the current tagging'
     parser = argparse.ArgumentParser(description='Orpheus: modular music archival')
     parser.add_argument('-p', '--private', action='store_true', help=argparse.SUPPRESS)
     parser.add_argument('-o', '--output', help='Select a download output path. Default is the provided download path in config/settings.py')
@@ -338,6 +379,7 @@ def main():
     parser.add_argument('-cr', '--credits', default='default', help='Override module to get credits from')
     parser.add_argument('-sd', '--separatedownload', default='default', help='Select a different module that will download the playlist instead of the main module. Only for playlists.')
     parser.add_argument('--menu', action='store_true', help='Launch the interactive CLI menu')
+    parser.add_argument('--plan-file', default='plan.json', help='Where "plan" writes the download plan. Default is plan.json')
     parser.add_argument('arguments', nargs='*', help=help_)
     args = parser.parse_args()
 
@@ -380,6 +422,40 @@ def main():
                 print(f'Offline mode is currently {"enabled" if network_manager.offline_mode else "disabled"}.')
         else:
             raise Exception(f'Unknown config option: {subcommand}')
+    elif orpheus_mode == 'retag':
+        if len(args.arguments) != 2 or not os.path.isdir(args.arguments[1]):
+            print('Retag must be done as orpheus.py retag [library folder]')
+            return
+        orpheus_core_retag(orpheus, args.arguments[1])
+    elif orpheus_mode == 'plan':
+        # Resolves everything like a download would, without downloading audio
+        path = args.output if args.output else orpheus.settings['global']['general']['download_path']
+        if path[-1] == '/': path = path[:-1]
+        entries = _arguments_or_file_entries(args.arguments[1:])
+        media_to_download = {}
+        if entries and not entries[0].startswith('http') and len(entries) >= 3:
+            media_to_download = _build_media_from_command(orpheus, entries)
+        else:
+            for entry in entries:
+                for service_name, media in _build_media_from_url(orpheus, entry).items():
+                    media_to_download.setdefault(service_name, []).extend(media)
+        if not media_to_download:
+            print('Plan must be made as orpheus.py plan [urls] or orpheus.py plan [module] [track/album/playlist/artist] [media ID 1] ...')
+            return
+
+        plan = orpheus_core_download(orpheus, media_to_download, _third_party_modules_from_args(orpheus, args), args.separatedownload.lower(), path, dry_run=True)
+        plan.save(args.plan_file)
+        _print_plan_summary(plan)
+        print(f'Plan written to {args.plan_file}, run it with orpheus.py execute {args.plan_file}')
+    elif orpheus_mode == 'execute':
+        if len(args.arguments) != 2 or not os.path.isfile(args.arguments[1]):
+            print('Execute must be done as orpheus.py execute [plan file]')
+            return
+        plan = DownloadPlan.load(args.arguments[1])
+        _print_plan_summary(plan)
+        output_path = args.output[:-1] if args.output and args.output.endswith('/') else args.output
+        os.makedirs(output_path or plan.output_path, exist_ok=True)
+        orpheus_core_execute_plan(orpheus, plan, output_path)
     else:
         path = args.output if args.output else orpheus.settings['global']['general']['download_path']
         if path[-1] == '/': path = path[:-1]  # removes '/' from end if it exists
@@ -455,7 +531,7 @@ def main():
             print('Sessions management is now handled via the menu or configuration wizard.')
             return
         else:  # if no specific modes are detected, parse as urls, but first try loading as a list of URLs
-            arguments = tuple(open(args.arguments[0], 'r')) if len(args.arguments) == 1 and os.path.exists(args.arguments[0]) else args.arguments
+            arguments = _arguments_or_file_entries(args.arguments)
             media_to_download = {}
             for link in arguments:
                 if link.startswith('http'):
@@ -497,14 +573,7 @@ def main():
                     print(f'Skipping invalid argument: "{link}"')
 
         # Prepare the third-party modules similar to above
-        tpm = {ModuleModes.covers: '', ModuleModes.lyrics: '', ModuleModes.credits: ''}
-        for i in tpm:
-            moduleselected = getattr(args, i.name).lower()
-            if moduleselected == 'default':
-                moduleselected = orpheus.settings['global']['module_defaults'][i.name]
-            if moduleselected == 'default':
-                moduleselected = None
-            tpm[i] = moduleselected
+        tpm = _third_party_modules_from_args(orpheus, args)
         sdm = args.separatedownload.lower()
 
         if not media_to_download:
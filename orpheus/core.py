@@ -3,13 +3,15 @@ from copy import deepcopy
 from datetime import datetime
 from urllib.parse import urlparse
 
-from orpheus.music_downloader import Downloader
+from orpheus.music_downloader import Downloader, beauty_format_seconds
 from utils.models import *
 from utils.utils import *
+from utils.cover_cache import cover_cache
 from utils.exceptions import *
-from orpheus.services import brain, service_registry, session_manager, NetworkEvent, LoginEvent
-from orpheus.delivery import delivery_pipeline
+from orpheus.services import brain, service_registry, session_manager, NetworkEvent, LoginEvent, MetadataCache, TrackIndex
+from orpheus.delivery import DownloadPlan, PlannedJob, delivery_pipeline
 from orpheus.modules.base import has_contract_methods
+from orpheus.housekeeping import RetagCheckpoint, RetagReport, retag_checkpoint_location, retag_library
 
 # try:
 #     time_request = requests.get('https://github.com') # to be replaced with something useful, like an Orpheus updates json
@@ -54,7 +56,8 @@ class Orpheus:
             },
             "artist_downloading":{
                 "return_credited_albums": True,
-                "separate_tracks_skip_downloaded": True
+                "separate_tracks_skip_downloaded": True,
+                "skip_duplicate_recordings": True
             },
             "formatting": {
                 "album_format": "{name}{explicit}",
@@ -93,6 +96,48 @@ class Orpheus:
                 "paths_m3u": "absolute",
                 "extended_m3u": True
             },
+            "performance": {
+                "max_parallel_tracks": 1,
+                "metadata_prefetch_depth": 2,
+                "staged_pipeline": False,
+                "stage_workers": {
+                    "resolve": 2,
+                    "fetch_audio": 2,
+                    "fetch_assets": 2,
+                    "convert": 1,
+                    "tag": 1,
+                    "finalize": 1
+                },
+                "stage_queue_size": 2,
+                "segmented_download_min_size_mb": 16,
+                "max_download_segments": 4,
+                "cover_cache_memory_mb": 64,
+                "cover_candidate_workers": 4,
+                "track_index": True,
+                "track_index_ttl_days": 30,
+                "track_index_negative_ttl_hours": 24,
+                "metadata_cache": False,
+                "metadata_cache_ttl_minutes": {
+                    "track": 60,
+                    "album": 1440,
+                    "playlist": 10,
+                    "artist": 360
+                },
+                "metadata_cache_size_mb": 256,
+                "artist_planning_workers": 4,
+                "conversion_workers": 0,
+                "streaming_conversion": False,
+                "tagging_workers": 2,
+                "asset_workers": 4,
+                "tag_padding_kb": {
+                    "flac": 64,
+                    "mp3": 64,
+                    "m4a": 64,
+                    "ogg": 16,
+                    "opus": 16
+                },
+                "retag_workers": 0
+            },
             "advanced": {
                 "advanced_login_system": False,
                 "codec_conversions": {
@@ -105,6 +150,7 @@ class Orpheus:
                     }
                 },
                 "conversion_keep_original": False,
+                "output_profiles": {},
                 "cover_variance_threshold": 8,
                 "debug_mode": False,
                 "disable_subscription_checks": False,
@@ -118,6 +164,9 @@ class Orpheus:
         self.data_folder_base = 'config'
         self.settings_location = os.path.join(self.data_folder_base, 'settings.json')
         self.session_storage_location = os.path.join(self.data_folder_base, 'loginstorage.bin')
+        self.track_index_location = os.path.join(self.data_folder_base, 'track_index.db')
+        self.metadata_cache_location = os.path.join(self.data_folder_base, 'metadata_cache')
+        self.throughput_location = os.path.join(self.data_folder_base, 'throughput.json')
 
         os.makedirs('config', exist_ok=True)
         self.raw_settings = json.loads(open(self.settings_location, 'r').read()) if os.path.exists(self.settings_location) else {}
@@ -162,6 +211,8 @@ class Orpheus:
                     contract_info = has_contract_methods(getattr(importlib.import_module(f'modules.{module}.interface'), 'ModuleInterface', object))
                     if contract_info['missing_required']:
                         logging.warning(f'Orpheus: module "{module}" does not implement required DownloadModule methods.')
+                    if contract_info['batch_track_info']:
+                        logging.debug(f'Orpheus: {module} fetches track info in batches')
                 logging.debug(f'Orpheus: {module} added as a module')
             else:
                 logging.warning(f'Orpheus: skipping module "{module}" due to invalid or private module information.')
@@ -190,6 +241,9 @@ class Orpheus:
 
         self.update_module_storage()
         configure_request_session(self.settings['global']['advanced'].get('allow_insecure_requests', False))
+        performance_settings = self.settings['global'].get('performance', {})
+        configure_segmented_downloads(performance_settings.get('segmented_download_min_size_mb', 16), performance_settings.get('max_download_segments', 4))
+        cover_cache.configure(performance_settings.get('cover_cache_memory_mb', 64))
 
         for i in self.extension_list:
             extension_settings: ExtensionInformation = getattr(importlib.import_module(f'extensions.{i}.interface'), 'extension_settings', None)
@@ -463,64 +517,133 @@ class Orpheus:
         return True
 
 
-def orpheus_core_download(orpheus_session: Orpheus, media_to_download, third_party_modules, separate_download_module, output_path):
-    downloader = Downloader(orpheus_session.settings['global'], orpheus_session.module_controls, oprinter, output_path)
-    os.makedirs('temp', exist_ok=True)
+def _job_result(downloader: Downloader) -> dict:
+    # Tracks whose tags could only be saved to a _tags.txt file
+    return {'tag_failures': ','.join(downloader.tag_failures)} if downloader.tag_failures else {}
 
-    for mainmodule, items in media_to_download.items():
-        for media in items:
-            if ModuleModes.download not in orpheus_session.module_settings[mainmodule].module_supported_modes:
-                raise Exception(f'{mainmodule} does not support track downloading') # TODO: replace with ModuleDoesNotSupportAbility
-
-            # Load and prepare module
-            music = orpheus_session.load_module(mainmodule)
-            downloader.service = music
-            downloader.service_name = mainmodule
-
-            for i in third_party_modules:
-                moduleselected = third_party_modules[i]
-                if moduleselected:
-                    if moduleselected not in orpheus_session.module_list:
-                        raise Exception(f'{moduleselected} does not exist in modules.') # TODO: replace with InvalidModuleError
-                    elif i not in orpheus_session.module_settings[moduleselected].module_supported_modes:
-                        raise Exception(f'Module {moduleselected} does not support {i}') # TODO: replace with ModuleDoesNotSupportAbility
-                    else:
-                        # If all checks pass, load up the selected module
-                        orpheus_session.load_module(moduleselected)
-
-            downloader.third_party_modules = third_party_modules
-
-            mediatype = media.media_type
-            media_id = media.media_id
-
-            downloader.download_mode = mediatype
-            job_id = delivery_pipeline.begin_job(mainmodule, mediatype.name, media_id)
-
-            # Mode to download playlist using other service
-            if separate_download_module != 'default' and separate_download_module != mainmodule:
-                if mediatype is not DownloadTypeEnum.playlist:
-                    raise Exception('The separate download module option is only for playlists.') # TODO: replace with ModuleDoesNotSupportAbility
-                try:
-                    downloader.download_playlist(media_id, custom_module=separate_download_module, extra_kwargs=media.extra_kwargs)
-                    delivery_pipeline.complete_job(job_id, mainmodule, True)
-                except Exception:
-                    delivery_pipeline.complete_job(job_id, mainmodule, False, reason='playlist_download_failed')
-                    raise
-            else:  # Standard download modes
-                try:
-                    if mediatype is DownloadTypeEnum.album:
-                        downloader.download_album(media_id, extra_kwargs=media.extra_kwargs)
-                    elif mediatype is DownloadTypeEnum.track:
-                        downloader.download_track(media_id, extra_kwargs=media.extra_kwargs)
-                    elif mediatype is DownloadTypeEnum.playlist:
-                        downloader.download_playlist(media_id, extra_kwargs=media.extra_kwargs)
-                    elif mediatype is DownloadTypeEnum.artist:
-                        downloader.download_artist(media_id, extra_kwargs=media.extra_kwargs)
-                    else:
-                        raise Exception(f'\tUnknown media type "{mediatype}"')
-                    delivery_pipeline.complete_job(job_id, mainmodule, True)
-                except Exception:
-                    delivery_pipeline.complete_job(job_id, mainmodule, False, reason='download_failed')
-                    raise
 
-    if os.path.exists('temp'): shutil.rmtree('temp')
+def orpheus_core_download(orpheus_session: Orpheus, media_to_download, third_party_modules, separate_download_module, output_path, dry_run=False):
+    """
+    Downloads every media item. With dry_run, items are only resolved and expanded into tracks,
+    and the returned DownloadPlan lists where each track would end up and roughly how large it is.
+    """
+    downloader = Downloader(orpheus_session.settings['global'], orpheus_session.module_controls, oprinter, output_path)
+    downloader.dry_run = dry_run
+    os.makedirs('temp', exist_ok=True)
+    plan = DownloadPlan(output_path, {mode.name: module for mode, module in third_party_modules.items()}, separate_download_module,
+                        bytes_per_second=transfer_stats.load(orpheus_session.throughput_location),
+                        parallel_downloads=orpheus_session.settings['global'].get('performance', {}).get('max_parallel_tracks', 1))
+
+    try:
+        performance_settings = orpheus_session.settings['global'].get('performance', {})
+        if performance_settings.get('track_index', True):
+            downloader.track_index = TrackIndex(orpheus_session.track_index_location,
+                                                ttl=performance_settings.get('track_index_ttl_days', 30) * 86400,
+                                                negative_ttl=performance_settings.get('track_index_negative_ttl_hours', 24) * 3600)
+            downloader.track_index.prune()
+        if performance_settings.get('metadata_cache', False):
+            ttls = performance_settings.get('metadata_cache_ttl_minutes', {})
+            downloader.metadata_cache = MetadataCache(orpheus_session.metadata_cache_location,
+                                                      ttls={kind: minutes * 60 for kind, minutes in ttls.items()},
+                                                      max_bytes=int(performance_settings.get('metadata_cache_size_mb', 256) * 1024 * 1024))
+
+        for mainmodule, items in media_to_download.items():
+            for media in items:
+                if ModuleModes.download not in orpheus_session.module_settings[mainmodule].module_supported_modes:
+                    raise Exception(f'{mainmodule} does not support track downloading') # TODO: replace with ModuleDoesNotSupportAbility
+
+                # Load and prepare module
+                orpheus_session.load_module(mainmodule)
+                downloader.service = downloader.module_service(mainmodule)
+                downloader.service_name = mainmodule
+
+                for i in third_party_modules:
+                    moduleselected = third_party_modules[i]
+                    if moduleselected:
+                        if moduleselected not in orpheus_session.module_list:
+                            raise Exception(f'{moduleselected} does not exist in modules.') # TODO: replace with InvalidModuleError
+                        elif i not in orpheus_session.module_settings[moduleselected].module_supported_modes:
+                            raise Exception(f'Module {moduleselected} does not support {i}') # TODO: replace with ModuleDoesNotSupportAbility
+                        else:
+                            # If all checks pass, load up the selected module
+                            orpheus_session.load_module(moduleselected)
+
+                downloader.third_party_modules = third_party_modules
+
+                mediatype = media.media_type
+                media_id = media.media_id
+
+                downloader.download_mode = mediatype
+                job_id = delivery_pipeline.begin_job(mainmodule, mediatype.name, media_id)
+                downloader.start_job(job_id)
+                downloader.planned_tracks = []
+
+                # Mode to download playlist using other service
+                if separate_download_module != 'default' and separate_download_module != mainmodule:
+                    if mediatype is not DownloadTypeEnum.playlist:
+                        raise Exception('The separate download module option is only for playlists.') # TODO: replace with ModuleDoesNotSupportAbility
+                    try:
+                        downloader.download_playlist(media_id, custom_module=separate_download_module, extra_kwargs=media.extra_kwargs)
+                        delivery_pipeline.complete_job(job_id, mainmodule, True, **_job_result(downloader))
+                    except Exception:
+                        delivery_pipeline.complete_job(job_id, mainmodule, False, reason='playlist_download_failed')
+                        raise
+                else:  # Standard download modes
+                    try:
+                        if mediatype is DownloadTypeEnum.album:
+                            downloader.download_album(media_id, extra_kwargs=media.extra_kwargs)
+                        elif mediatype is DownloadTypeEnum.track:
+                            downloader.download_track(media_id, extra_kwargs=media.extra_kwargs)
+                        elif mediatype is DownloadTypeEnum.playlist:
+                            downloader.download_playlist(media_id, extra_kwargs=media.extra_kwargs)
+                        elif mediatype is DownloadTypeEnum.artist:
+                            downloader.download_artist(media_id, extra_kwargs=media.extra_kwargs)
+                        else:
+                            raise Exception(f'\tUnknown media type "{mediatype}"')
+                        delivery_pipeline.complete_job(job_id, mainmodule, True, **_job_result(downloader))
+                    except Exception:
+                        delivery_pipeline.complete_job(job_id, mainmodule, False, reason='download_failed')
+                        raise
+
+                if dry_run:
+                    plan.jobs.append(PlannedJob(mainmodule, mediatype.name, str(media_id), media.extra_kwargs or {}, downloader.planned_tracks))
+    finally:
+        # Also when a module fails, so the pools' threads, temporary covers and the throughput measured so far aren't lost
+        downloader.conversion_pool.shutdown()
+        downloader.tagging_pool.shutdown()
+        downloader.asset_pool.shutdown()
+        if downloader.track_index: downloader.track_index.close()
+        if not dry_run: transfer_stats.save(orpheus_session.throughput_location)
+        if downloader.metadata_cache: downloader.metadata_cache.report()
+        logging.debug('Cover cache: %s', cover_cache.stats())
+        cover_cache.clear()
+        if os.path.exists('temp'): shutil.rmtree('temp')
+    return plan if dry_run else None
+
+
+def orpheus_core_execute_plan(orpheus_session: Orpheus, plan: DownloadPlan, output_path=None):
+    """Downloads the jobs of a plan made by a dry run. Tracks that exist by now are skipped as usual."""
+    media_to_download = {}
+    for job in plan.jobs:
+        media_to_download.setdefault(job.service, []).append(
+            MediaIdentification(media_type=DownloadTypeEnum[job.media_type], media_id=job.media_id, extra_kwargs=job.extra_kwargs))
+    third_party_modules = {mode: plan.third_party_modules.get(mode.name) for mode in (ModuleModes.covers, ModuleModes.lyrics, ModuleModes.credits)}
+    orpheus_core_download(orpheus_session, media_to_download, third_party_modules, plan.separate_download_module, output_path or plan.output_path)
+
+
+def orpheus_core_retag(orpheus_session: Orpheus, path: str) -> RetagReport:
+    """Tags every file below path again from its own tags, resuming an interrupted run over the same path."""
+    performance_settings = orpheus_session.settings['global'].get('performance', {})
+    padding = {container: int(float(padding_kb) * 1024) for container, padding_kb in performance_settings.get('tag_padding_kb', {}).items()}
+    checkpoint = RetagCheckpoint(retag_checkpoint_location(orpheus_session.data_folder_base, path))
+    if checkpoint.done: print(f'Resuming, {len(checkpoint.done)} files were retagged by an earlier run')
+
+    def progress(report: RetagReport):
+        print(f'\t{report.resumed + report.processed}/{report.files} files, {report.files_per_second:.0f} files/s')
+
+    report = retag_library(path, checkpoint, padding, int(performance_settings.get('retag_workers', 0)), progress=progress)
+    print(f'Retagged {report.retagged} files, {report.unchanged} already up to date, {len(report.failures)} failed'
+          f' ({report.processed} files in {beauty_format_seconds(report.seconds)}, {report.files_per_second:.0f} files/s)')
+    for location, error in report.failures.items():
+        print(f'\tFailed: {location}: {error}')
+    return report
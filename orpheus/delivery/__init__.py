@@ -1,3 +1,31 @@
-from .pipeline import DeliveryPipeline, delivery_pipeline
+from .context import TrackContext
+from .m3u import M3UPlaylist
+from .memo import SingleFlightMemo
+from .plan import ArtistPlan, DownloadPlan, PlannedAlbum, PlannedJob, PlannedTrack, recording_key
+from .pipeline import DeliveryPipeline, DeliveryTelemetry, delivery_pipeline
+from .prefetch import MetadataPrefetcher
+from .profiles import ConversionOutput, OutputProfile, load_output_profiles
+from .queue import JobWorkerPool
+from .stages import PipelineStage, StagedPipeline
 
-__all__ = ["DeliveryPipeline", "delivery_pipeline"]
+__all__ = [
+    "ArtistPlan",
+    "ConversionOutput",
+    "DeliveryPipeline",
+    "DeliveryTelemetry",
+    "DownloadPlan",
+    "delivery_pipeline",
+    "JobWorkerPool",
+    "load_output_profiles",
+    "M3UPlaylist",
+    "MetadataPrefetcher",
+    "OutputProfile",
+    "PipelineStage",
+    "PlannedAlbum",
+    "PlannedJob",
+    "PlannedTrack",
+    "recording_key",
+    "SingleFlightMemo",
+    "StagedPipeline",
+    "TrackContext",
+]
@@ -0,0 +1,58 @@
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+from utils.models import AlbumInfo, CodecEnum, ContainerEnum, DownloadTypeEnum, TrackDownloadInfo, TrackInfo
+
+
+@dataclass
+class TrackContext:
+    """
+    Per-track state handed to download workers. The Downloader's job-level
+    attributes (service, download mode) are snapshotted here so concurrent
+    tracks never read or mutate shared state.
+    """
+
+    service: Any
+    service_name: str
+    download_mode: Optional[DownloadTypeEnum]
+    track_id: Optional[str] = None
+    indent_level: int = 1
+    show_progress: bool = True
+    album_location: str = ''
+    main_artist: str = ''
+    track_index: int = 0
+    number_of_tracks: int = 0
+    cover_temp_location: str = ''
+    shared_cover_url: str = ''  # Cover all tracks of an album share, fetched with the track's other assets
+    extra_kwargs: dict = field(default_factory=dict)
+
+    # Filled in by Downloader._resolve_track, possibly ahead of time by the MetadataPrefetcher
+    resolved: bool = False
+    skip_reason: Optional[str] = None  # 'artist', 'error', 'exists' or 'not_found'
+    album_info: Optional[AlbumInfo] = None
+    track_location_name: Optional[str] = None
+    conversions: Optional[dict] = None  # None when the codec_conversions setting is invalid
+    output_profiles: Optional[list] = None  # (OutputProfile, location name) pairs, None when the setting is invalid
+    download_info: Optional[TrackDownloadInfo] = None
+    download_error: Optional[BaseException] = None
+
+    # Handed from one download stage to the next
+    status: Optional[str] = None  # 'skipped', 'failed' or 'downloaded' once the track needs no further stages
+    codec: Optional[CodecEnum] = None
+    container: Optional[ContainerEnum] = None
+    audio_location: Optional[str] = None
+    converted: bool = False  # Set once the conversion is done, possibly while downloading
+    extra_outputs: list = field(default_factory=list)  # (location, container) of output profiles besides audio_location
+    old_track_location: Optional[str] = None
+    old_container: Optional[ContainerEnum] = None
+    assets: Optional[dict] = None  # Asset name to the future of its (value, error), fetched while the audio downloads
+    embedded_lyrics: str = ''
+    credits_list: list = field(default_factory=list)
+    stage_metrics: dict = field(default_factory=dict)  # Reported with the stage's telemetry, then cleared
+    post_process: Optional[Future] = None  # Converting, tagging and finalizing handed to the conversion or tagging pool
+
+    # Filled in by the finalize stage (or the exists check) once the track has a final location,
+    # or up front by the artist planner
+    track_info: Optional[TrackInfo] = None
+    track_location: Optional[str] = None
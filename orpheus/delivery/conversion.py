@@ -0,0 +1,51 @@
+import os
+import threading
+from typing import BinaryIO, Callable, Optional
+
+import ffmpeg
+
+
+def run_ffmpeg(stream, feed: Callable[[BinaryIO], None] = None) -> Optional[float]:
+    """
+    Runs an ffmpeg-python stream like stream.run(capture_stdout=True, capture_stderr=True)
+    and returns the CPU time ffmpeg used, None where the platform can't tell.
+    With feed, the stream reads its input from 'pipe:' and feed writes it to ffmpeg's stdin.
+    Raises ffmpeg.Error with the captured output when ffmpeg fails.
+    """
+    process = stream.run_async(pipe_stdin=feed is not None, pipe_stdout=True, pipe_stderr=True)
+    # communicate() would reap ffmpeg and its resource usage with it, so the pipes are drained by hand
+    output = {}
+    readers = [threading.Thread(target=lambda name=name: output.__setitem__(name, getattr(process, name).read()), daemon=True)
+               for name in ('stdout', 'stderr')]
+    for reader in readers: reader.start()
+
+    if feed:
+        try:
+            feed(process.stdin)
+        except BrokenPipeError:
+            # ffmpeg stopped reading, its exit code and error output say why
+            pass
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    for reader in readers: reader.join()
+    if hasattr(os, 'wait4'):
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        cpu_time = usage.ru_utime + usage.ru_stime
+    else:
+        process.wait()
+        cpu_time = None
+    process.stdout.close()
+    process.stderr.close()
+
+    if process.returncode:
+        raise ffmpeg.Error('ffmpeg', output.get('stdout', b''), output.get('stderr', b''))
+    return cpu_time
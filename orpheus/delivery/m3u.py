@@ -0,0 +1,49 @@
+import os
+import threading
+from typing import Dict
+
+from utils.models import TrackInfo
+
+
+class M3UPlaylist:
+    """
+    Collects the entries of an m3u playlist in memory, keyed by their position in
+    the playlist, so tracks finishing out of order still end up in playlist order.
+    The file is written in one go by flush(), through a temporary file that
+    replaces the playlist, so readers never see a half written playlist.
+    """
+
+    def __init__(self, location: str, extended: bool = False, absolute_paths: bool = True):
+        self.location = location
+        self.extended = extended
+        self.absolute_paths = absolute_paths
+        self._entries: Dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    def add(self, index: int, track_info: TrackInfo, track_location: str):
+        entry = ''
+        if self.extended:
+            # if no duration exists default to -1
+            duration = track_info.duration if track_info.duration else -1
+            entry += f'#EXTINF:{duration}, {track_info.artists[0]} - {track_info.name}\n'
+
+        if self.absolute_paths:
+            entry += f'{os.path.abspath(track_location)}\n'
+        else:
+            # relative to the folder of the playlist
+            entry += f'{os.path.relpath(track_location, os.path.dirname(self.location))}\n'
+
+        # an extra new line separates the entries of the extended format
+        if self.extended: entry += '\n'
+
+        with self._lock:
+            self._entries[index] = entry
+
+    def flush(self):
+        with self._lock:
+            content = ('#EXTM3U\n\n' if self.extended else '') + ''.join(self._entries[index] for index in sorted(self._entries))
+
+        temporary_location = f'{self.location}.{os.getpid()}.tmp'
+        with open(temporary_location, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(temporary_location, self.location)
@@ -0,0 +1,43 @@
+import threading
+from concurrent.futures import Future
+from typing import Callable, Dict, Hashable, TypeVar
+
+T = TypeVar('T')
+
+
+class SingleFlightMemo:
+    """
+    Job-scoped memo where concurrent calls for the same key share a single
+    computation: the first caller computes, the others wait for its result.
+    Failures are passed to the waiting callers but not remembered, so a
+    later call tries again.
+    """
+
+    def __init__(self):
+        self._futures: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, compute: Callable[[], T]) -> T:
+        with self._lock:
+            future = self._futures.get(key)
+            owner = future is None
+            if owner:
+                future = self._futures[key] = Future()
+
+        if owner:
+            try:
+                future.set_result(compute())
+            except BaseException as e:
+                with self._lock:
+                    self._futures.pop(key, None)
+                future.set_exception(e)
+                raise
+        return future.result()
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._futures
+
+    def clear(self):
+        with self._lock:
+            self._futures.clear()
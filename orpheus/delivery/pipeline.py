@@ -1,5 +1,5 @@
 from dataclasses import dataclass, field
-from typing import Dict
+from typing import Dict, Optional
 
 from orpheus.services import brain, EventType, Event
 from .queue import delivery_queue
@@ -10,6 +10,7 @@ class DeliveryTelemetry(Event):
     job_id: str = ""
     status: str = "pending"
     service: str = ""
+    stage: str = ""
     metadata: Dict[str, str] = field(default_factory=dict)
 
     def __init__(self, **kwargs):
@@ -18,6 +19,7 @@ class DeliveryTelemetry(Event):
         self.job_id = kwargs.get("job_id", "")
         self.status = kwargs.get("status", "pending")
         self.service = kwargs.get("service", "")
+        self.stage = kwargs.get("stage", "")
         self.metadata.update(metadata)
 
 
@@ -46,6 +48,17 @@ class DeliveryPipeline:
         )
         brain.record_event(event)
 
+    def stage_transition(self, job_id: Optional[str], service: str, stage: str, status: str, **metadata):
+        """Records a track entering or leaving one of the download stages (resolve, fetch_audio, ..., finalize)."""
+        event = DeliveryTelemetry(
+            job_id=job_id or "",
+            status=status,
+            service=service,
+            stage=stage,
+            metadata={"stage": stage, **{key: str(value) for key, value in metadata.items()}},
+        )
+        brain.record_event(event)
+
     def submit(self, fn, *args, **kwargs):
         return delivery_queue.submit(fn, *args, **kwargs)
 
@@ -0,0 +1,124 @@
+import json
+import re
+import unicodedata
+from dataclasses import asdict, dataclass, field
+from typing import Dict, Hashable, List, Optional, Set
+
+from utils.models import AlbumInfo, TrackInfo
+
+
+def recording_key(track_info: TrackInfo) -> Optional[Hashable]:
+    """
+    Identifies a recording across releases (standard and deluxe editions, compilations):
+    by ISRC, or by main artist, normalised title and duration when the service has no ISRC.
+    """
+    isrc = track_info.tags.isrc if track_info.tags else None
+    if isrc:
+        return 'isrc', isrc.strip().upper()
+    if not track_info.name or not track_info.duration:
+        return None
+    artist = track_info.artists[0] if track_info.artists else ''
+    return 'title', _normalise(artist), _normalise(track_info.name), int(round(track_info.duration))
+
+
+def _normalise(text: str) -> str:
+    text = unicodedata.normalize('NFKD', text).casefold()
+    return re.sub(r'[\W_]+', ' ', text).strip()
+
+
+@dataclass
+class PlannedAlbum:
+    album_id: str
+    album_info: AlbumInfo
+    # Tracks of the album already planned on an earlier album, skipped when downloading this one
+    duplicate_tracks: Set[str] = field(default_factory=set)
+
+
+@dataclass
+class ArtistPlan:
+    """What download_artist is going to fetch, worked out before the first track is downloaded."""
+
+    albums: List[PlannedAlbum] = field(default_factory=list)
+    tracks: List[str] = field(default_factory=list)  # Separate tracks not on any planned album
+    # Only the recordings are kept, track info can carry download links that expire before the track's turn
+    recording_keys: Dict[str, Hashable] = field(default_factory=dict)
+    # Unless the module flags its track info as static, then the downloads reuse it
+    track_infos: Dict[str, TrackInfo] = field(default_factory=dict)
+    skipped_albums: int = 0
+    skipped_tracks: int = 0
+
+    def track_info(self, track_id) -> Optional[TrackInfo]:
+        return self.track_infos.get(str(track_id))
+
+
+@dataclass
+class PlannedTrack:
+    track_id: str
+    service: str
+    name: str = ''
+    artists: List[str] = field(default_factory=list)
+    location: Optional[str] = None  # Final file, None for tracks that won't be downloaded
+    exists: bool = False
+    skip_reason: Optional[str] = None
+    size: Optional[int] = None
+    size_source: Optional[str] = None  # 'content-length', 'file' or 'bitrate'
+
+
+@dataclass
+class PlannedJob:
+    service: str
+    media_type: str
+    media_id: str
+    extra_kwargs: dict = field(default_factory=dict)
+    tracks: List[PlannedTrack] = field(default_factory=list)
+
+
+@dataclass
+class DownloadPlan:
+    """
+    Outcome of a dry run: every track a job would download with its final location and
+    estimated size. Saved as JSON, and executing it runs the planned jobs for real.
+    """
+
+    output_path: str
+    third_party_modules: Dict[str, Optional[str]] = field(default_factory=dict)
+    separate_download_module: str = 'default'
+    jobs: List[PlannedJob] = field(default_factory=list)
+    bytes_per_second: Optional[float] = None  # Recent throughput of a single download
+    parallel_downloads: int = 1
+
+    @property
+    def tracks(self) -> List[PlannedTrack]:
+        return [track for job in self.jobs for track in job.tracks]
+
+    def summary(self) -> dict:
+        pending = [track for track in self.tracks if track.location and not track.exists]
+        total_bytes = sum(track.size or 0 for track in pending)
+        rate = (self.bytes_per_second or 0) * max(1, self.parallel_downloads)
+        return {
+            'tracks': len(self.tracks),
+            'existing': sum(track.exists for track in self.tracks),
+            'skipped': sum(1 for track in self.tracks if not track.location and not track.exists),
+            'to_download': len(pending),
+            'unknown_size': sum(1 for track in pending if track.size is None),
+            'total_bytes': total_bytes,
+            'estimated_seconds': round(total_bytes / rate) if rate else None,
+        }
+
+    def to_dict(self) -> dict:
+        return {'version': 1, **asdict(self), 'summary': self.summary()}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'DownloadPlan':
+        jobs = [PlannedJob(**{**job, 'tracks': [PlannedTrack(**track) for track in job.get('tracks', [])]}) for job in data.get('jobs', [])]
+        fields = {key: data[key] for key in ('output_path', 'third_party_modules', 'separate_download_module', 'bytes_per_second', 'parallel_downloads') if key in data}
+        return cls(jobs=jobs, **fields)
+
+    def save(self, location: str):
+        with open(location, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, indent=4)
+
+    @classmethod
+    def load(cls, location: str) -> 'DownloadPlan':
+        with open(location, 'r', encoding='utf-8') as f:
+            return cls.from_dict(json.load(f))
@@ -0,0 +1,92 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from .context import TrackContext
+
+
+class MetadataPrefetcher:
+    """
+    Resolves track metadata (TrackInfo and TrackDownloadInfo) for the next
+    `depth` tracks of a job while the current track is transferring, so API
+    round-trips overlap with audio downloads instead of running between them.
+
+    With `fetch_batch`, a track outside the batches fetched so far has its
+    TrackInfo fetched together with the next `batch_size - 1` tracks in one call,
+    so batches follow the lookahead instead of covering the whole job up front.
+    """
+
+    def __init__(self, resolve: Callable[[TrackContext], None], contexts: List[TrackContext], depth: int = 0,
+                 fetch_batch: Optional[Callable[[List[TrackContext]], None]] = None, batch_size: int = 0):
+        self._resolve = resolve
+        self._contexts = contexts
+        self._positions = {id(context): position for position, context in enumerate(contexts)}
+        self.depth = max(0, int(depth or 0))
+        self._futures: Dict[int, Optional[Future]] = {}
+        self._lock = threading.Lock()
+        self._fetch_batch = fetch_batch
+        self.batch_size = max(1, int(batch_size or 1))
+        self._batched = set()
+        # Held while a batch is fetched, so tracks in it wait for it instead of fetching their own
+        self._batch_lock = threading.Lock()
+        self._cancelled = False
+        self._executor: Optional[ThreadPoolExecutor] = None
+        if self.depth:
+            self._executor = ThreadPoolExecutor(max_workers=self.depth, thread_name_prefix='orpheus-prefetch')
+
+    def _schedule_after(self, position: int):
+        # Caller holds the lock
+        if not self._executor or self._cancelled:
+            return
+        for ahead in range(position + 1, min(position + 1 + self.depth, len(self._contexts))):
+            if ahead not in self._futures:
+                self._futures[ahead] = self._executor.submit(self._resolve_at, ahead)
+
+    def _fetch_batch_from(self, position: int):
+        if not self._fetch_batch:
+            return
+        with self._batch_lock:
+            if position not in self._batched:
+                # Parallel downloads can get here out of order, the batch still starts at the earliest track left
+                start = next((ahead for ahead in range(max(0, position - self.batch_size + 1), position) if ahead not in self._batched), position)
+                window = range(start, min(start + self.batch_size, len(self._contexts)))
+                self._fetch_batch([self._contexts[ahead] for ahead in window if ahead not in self._batched])
+                self._batched.update(window)
+
+    def _resolve_at(self, position: int):
+        self._fetch_batch_from(position)
+        self._resolve(self._contexts[position])
+
+    def resolve(self, context: TrackContext):
+        """Waits for the prefetched resolution of `context`, or resolves it inline, and queues the lookahead."""
+        position = self._positions.get(id(context))
+        if position is None:
+            return self._resolve(context)
+
+        # The batch of this track is fetched before the lookahead would start the next one
+        self._fetch_batch_from(position)
+        with self._lock:
+            future = self._futures.get(position)
+            if future is None:
+                self._futures[position] = None  # claimed inline, never prefetch it
+            self._schedule_after(position)
+
+        if future is None:
+            self._resolve_at(position)
+        else:
+            future.result()
+
+    def cancel(self):
+        with self._lock:
+            self._cancelled = True
+            for future in self._futures.values():
+                if future: future.cancel()
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.cancel()
+        return False
@@ -0,0 +1,49 @@
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from utils.models import CodecEnum, ContainerEnum, codec_data
+
+
+@dataclass
+class OutputProfile:
+    """
+    One of the copies every track is delivered as, like a lossless archive next to a
+    lossy copy for mobile. path_format is relative to the download path and takes the
+    track's format variables plus {profile} and {path}, the track's usual location.
+    """
+
+    name: str
+    codec: CodecEnum
+    path_format: str = '{profile}/{path}'
+    flags: dict = field(default_factory=dict)  # ffmpeg options like conversion_flags, for example {"b:a": "160k"}
+
+    @classmethod
+    def from_settings(cls, name: str, settings) -> 'OutputProfile':
+        # A profile can be just its codec name
+        if isinstance(settings, str): settings = {'codec': settings}
+        return cls(
+            name=name,
+            codec=CodecEnum[settings['codec'].upper()],
+            path_format=settings.get('path_format', cls.path_format),
+            flags=dict(settings.get('flags', {})),
+        )
+
+
+def load_output_profiles(settings: dict) -> List[OutputProfile]:
+    return [OutputProfile.from_settings(name, profile) for name, profile in settings.items()]
+
+
+@dataclass
+class ConversionOutput:
+    """A file ffmpeg writes from a downloaded track, several of them share a single decode."""
+
+    location: str
+    codec: CodecEnum
+    flags: dict = field(default_factory=dict)
+    copy: bool = False  # The audio is copied as it is, only the container may change
+    metadata: dict = field(default_factory=dict)  # Tags ffmpeg writes with the file
+    cover: Optional[str] = None  # Cover ffmpeg embeds as an attached picture
+
+    @property
+    def container(self) -> ContainerEnum:
+        return codec_data[self.codec].container
@@ -1,5 +1,5 @@
 import threading
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Callable, Optional
 
 
@@ -19,4 +19,41 @@ class DeliveryQueue:
         self.executor.shutdown(wait=wait)
 
 
+class JobWorkerPool:
+    """
+    Bounded worker pool scoped to a single download job (album, playlist or
+    artist). With one worker, submitted work runs inline so the sequential
+    behaviour, including exception propagation, stays exactly as before.
+    """
+
+    def __init__(self, max_workers: int = 1, thread_name_prefix: str = 'orpheus-job'):
+        self.max_workers = max(1, int(max_workers or 1))
+        self.executor: Optional[ThreadPoolExecutor] = None
+        if self.max_workers > 1:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=thread_name_prefix)
+
+    @property
+    def concurrent(self) -> bool:
+        return self.executor is not None
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        if self.executor:
+            return self.executor.submit(fn, *args, **kwargs)
+        future = Future()
+        future.set_result(fn(*args, **kwargs))
+        return future
+
+    def shutdown(self, cancel_pending: bool = False):
+        if self.executor:
+            self.executor.shutdown(wait=not cancel_pending, cancel_futures=cancel_pending)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # On errors (including ^C) drop queued tracks instead of starting them
+        self.shutdown(cancel_pending=exc_type is not None)
+        return False
+
+
 delivery_queue = DeliveryQueue()
@@ -0,0 +1,117 @@
+import queue
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+
+@dataclass
+class PipelineStage:
+    name: str
+    handler: Callable[[Any], None]
+    workers: int = 1
+
+
+_STOP = object()
+
+
+class StagedPipeline:
+    """
+    Runs items through a fixed sequence of stages connected by bounded
+    queues. Every stage has its own worker threads, so I/O-bound and
+    CPU-bound stages of different items overlap while each item still
+    passes through the stages in order. An item leaves the pipeline early
+    once `is_finished(item)` is true (skipped or failed tracks).
+    """
+
+    def __init__(self, stages: List[PipelineStage], queue_size: int = 2,
+                 is_finished: Optional[Callable[[Any], bool]] = None, thread_name_prefix: str = 'orpheus-stage'):
+        if not stages:
+            raise ValueError('A pipeline needs at least one stage')
+        self.stages = [PipelineStage(stage.name, stage.handler, max(1, int(stage.workers or 1))) for stage in stages]
+        self.queue_size = max(1, int(queue_size or 1))
+        self.is_finished = is_finished or (lambda item: False)
+        self.thread_name_prefix = thread_name_prefix
+
+    def run(self, items: Iterable[Any]) -> Iterator[Any]:
+        """
+        Feeds `items` into the pipeline and yields them back in input order once
+        they have left it. The first stage error is raised when its item is
+        reached; queued items are dropped instead of being started.
+        """
+        items = list(items)
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        done: Dict[int, threading.Event] = {id(item): threading.Event() for item in items}
+        errors: Dict[int, BaseException] = {}
+        cancelled = set()
+        first_error: List[BaseException] = []
+        abort = threading.Event()
+        lock = threading.Lock()
+        remaining_workers = [stage.workers for stage in self.stages]
+
+        def fail(item, error: BaseException):
+            with lock:
+                errors[id(item)] = error
+                if not first_error: first_error.append(error)
+            abort.set()
+
+        def feed():
+            for item in items:
+                if abort.is_set():
+                    cancelled.add(id(item))
+                    done[id(item)].set()
+                    continue
+                queues[0].put(item)
+            for _ in range(self.stages[0].workers):
+                queues[0].put(_STOP)
+
+        def work(index: int):
+            stage = self.stages[index]
+            is_last = index == len(self.stages) - 1
+            while True:
+                item = queues[index].get()
+                if item is _STOP:
+                    break
+                if not abort.is_set():
+                    try:
+                        stage.handler(item)
+                    except BaseException as e:
+                        fail(item, e)
+                    else:
+                        if is_last or self.is_finished(item):
+                            done[id(item)].set()
+                            continue
+                        if not abort.is_set():
+                            queues[index + 1].put(item)
+                            continue
+                if id(item) not in errors:
+                    cancelled.add(id(item))
+                done[id(item)].set()
+
+            # The last worker of a stage tells the next stage that nothing else is coming
+            with lock:
+                remaining_workers[index] -= 1
+                last_worker = remaining_workers[index] == 0
+            if last_worker and not is_last:
+                for _ in range(self.stages[index + 1].workers):
+                    queues[index + 1].put(_STOP)
+
+        threads = [threading.Thread(target=feed, name=f'{self.thread_name_prefix}-feed', daemon=True)]
+        for index, stage in enumerate(self.stages):
+            threads += [threading.Thread(target=work, args=(index,), name=f'{self.thread_name_prefix}-{stage.name}-{worker}', daemon=True)
+                        for worker in range(stage.workers)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            for item in items:
+                done[id(item)].wait()
+                if id(item) in errors:
+                    raise errors[id(item)]
+                if id(item) in cancelled:
+                    raise first_error[0]
+                yield item
+            for thread in threads:
+                thread.join()
+        finally:
+            # Covers errors, ^C in the caller and generators closed early
+            abort.set()
@@ -1 +1,147 @@
-# Will be used for CLI commands in orpheus.py
\ No newline at end of file
+# Library maintenance behind CLI commands in orpheus.py
+import hashlib
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterator, List, Optional, Set
+
+from orpheus.tagging import TAGGED_EXTENSIONS, read_tags, tag_file
+
+
+def find_tagged_files(root: str) -> Iterator[str]:
+    """Every file below root tag_file can tag, in a stable order so a checkpointed run resumes where it stopped."""
+    for directory, directories, files in os.walk(root):
+        directories.sort()
+        for name in sorted(files):
+            if name.rsplit('.', 1)[-1].lower() in TAGGED_EXTENSIONS:
+                yield os.path.join(directory, name)
+
+
+def retag_file(location: str, padding: Dict[str, int]) -> tuple:
+    """
+    Tags a file again with the tags it has, under the current conventions of tag_file.
+    Returns (location, outcome, error), outcome being 'retagged', 'unchanged' or 'failed'.
+    """
+    container = TAGGED_EXTENSIONS[location.rsplit('.', 1)[-1].lower()]
+    try:
+        modified = os.stat(location).st_mtime_ns
+        track_info, credits_list, embedded_lyrics = read_tags(location, container)
+        # Covers stay where they are, tag_file only touches them when given one
+        tag_file(location, None, track_info, credits_list, embedded_lyrics, container, padding=padding.get(container.name))
+        return location, 'unchanged' if os.stat(location).st_mtime_ns == modified else 'retagged', None
+    except Exception as e:
+        return location, 'failed', f'{type(e).__name__}: {e}'
+
+
+def _retag_batch(locations: List[str], padding: Dict[str, int]) -> List[tuple]:
+    # One task per batch keeps the pool's overhead per file low on large libraries
+    return [retag_file(location, padding) for location in locations]
+
+
+class RetagCheckpoint:
+    """
+    Files a retag run has finished, one path per line, appended as batches complete so an
+    interrupted run skips them when started again. Removed once a run gets through everything.
+    """
+
+    def __init__(self, location: str):
+        self.location = location
+        self.done: Set[str] = set()
+        if os.path.exists(location):
+            with open(location, 'r', encoding='utf-8') as f:
+                self.done = {line.rstrip('\n') for line in f if line.strip()}
+        self._file = None
+
+    def record(self, locations: List[str]):
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.location) or '.', exist_ok=True)
+            self._file = open(self.location, 'a', encoding='utf-8')
+        self._file.writelines(f'{location}\n' for location in locations)
+        self._file.flush()
+        self.done.update(locations)
+
+    def close(self, finished: bool = False):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if finished and os.path.exists(self.location):
+            os.remove(self.location)
+
+
+def retag_checkpoint_location(data_folder: str, root: str) -> str:
+    # One checkpoint per library, so runs over different trees don't skip each other's files
+    return os.path.join(data_folder, 'retag', hashlib.sha256(os.path.abspath(root).encode('utf-8')).hexdigest()[:16] + '.txt')
+
+
+@dataclass
+class RetagReport:
+    files: int = 0  # Files found, including ones an earlier run already did
+    resumed: int = 0
+    retagged: int = 0
+    unchanged: int = 0
+    failures: Dict[str, str] = field(default_factory=dict)  # Location to error
+    seconds: float = 0.0
+
+    @property
+    def processed(self) -> int:
+        return self.retagged + self.unchanged + len(self.failures)
+
+    @property
+    def files_per_second(self) -> float:
+        return self.processed / self.seconds if self.seconds else 0.0
+
+
+def retag_library(root: str, checkpoint: RetagCheckpoint, padding: Dict[str, int] = None, workers: int = 0, batch_size: int = 64,
+                  progress: Optional[Callable[[RetagReport], None]] = None, progress_interval: float = 2.0) -> RetagReport:
+    """
+    Retags every file below root on a process pool of workers (0 for one per CPU), since reading and
+    writing tags is mostly Python work held by the GIL. progress gets the report every progress_interval seconds.
+    """
+    padding = padding or {}
+    workers = workers or os.cpu_count() or 1
+    started = last_progress = time.perf_counter()
+    report = RetagReport()
+
+    pending = []
+    for location in find_tagged_files(root):
+        report.files += 1
+        if location in checkpoint.done:
+            report.resumed += 1
+        else:
+            pending.append(location)
+    batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+
+    def collect(results):
+        nonlocal last_progress
+        for location, outcome, error in results:
+            if outcome == 'failed':
+                report.failures[location] = error
+            else:
+                setattr(report, outcome, getattr(report, outcome) + 1)
+        # Failed files aren't recorded, the next run tries them again
+        checkpoint.record([location for location, outcome, _ in results if outcome != 'failed'])
+        report.seconds = time.perf_counter() - started
+        if progress and time.perf_counter() - last_progress >= progress_interval:
+            last_progress = time.perf_counter()
+            progress(report)
+
+    try:
+        if workers == 1:
+            for batch in batches:
+                collect(_retag_batch(batch, padding))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                # A few batches per worker in flight, instead of hundreds of thousands of queued futures
+                batches = iter(batches)
+                running = set()
+                for batch in batches:
+                    running.add(pool.submit(_retag_batch, batch, padding))
+                    if len(running) >= workers * 2:
+                        done, running = wait(running, return_when=FIRST_COMPLETED)
+                        for future in done: collect(future.result())
+                for future in running: collect(future.result())
+    finally:
+        report.seconds = time.perf_counter() - started
+        checkpoint.close(finished=report.resumed + report.processed == report.files and not report.failures)
+    return report
@@ -1,5 +1,5 @@
 from abc import ABC, abstractmethod
-from typing import Any, Dict, Iterable, Optional
+from typing import Any, Dict, Iterable, List, Optional
 
 from utils.models import DownloadTypeEnum, MediaIdentification, TrackInfo, AlbumInfo, PlaylistInfo, ArtistInfo, Tags
 
@@ -12,6 +12,9 @@ class DownloadModule(ABC):
     """
 
     service_name: str
+    # Most ids a single get_tracks_info call takes, and so how far ahead of its download track info is fetched.
+    # 0 batches the tracks prefetched ahead of the download
+    tracks_info_batch_size: int = 0
 
     @abstractmethod
     def search(self, query_type: DownloadTypeEnum, query: str, track_info: Optional[TrackInfo] = None,
@@ -26,6 +29,13 @@ class DownloadModule(ABC):
     def get_track_download(self, track_id: str, **kwargs) -> Any:
         raise NotImplementedError
 
+    def get_tracks_info(self, track_ids: List[str], quality_tier, codec_options, **kwargs) -> Dict[str, TrackInfo]:
+        """
+        Optional batch form of get_track_info for services with a bulk endpoint, returning the TrackInfo of
+        each id by its string form. Tracks left out of the result are fetched with get_track_info instead.
+        """
+        raise NotImplementedError
+
     def get_album_info(self, album_id: str, **kwargs) -> AlbumInfo:
         raise NotImplementedError
 
@@ -45,6 +55,12 @@ class DownloadModule(ABC):
         return {}
 
 
+def supports_batch_track_info(module: Any) -> bool:
+    # Modules that don't inherit the contract count if they define the method themselves
+    method = getattr(module, 'get_tracks_info', None)
+    return callable(method) and getattr(method, '__func__', method) is not DownloadModule.get_tracks_info
+
+
 def has_contract_methods(module: Any) -> Dict[str, bool]:
     required_methods = [
         'get_track_info',
@@ -62,5 +78,6 @@ def has_contract_methods(module: Any) -> Dict[str, bool]:
     return {
         'missing_required': bool(missing_required),
         'missing_optional': bool(missing_optional),
-        'has_contract': isinstance(module, DownloadModule)
+        'has_contract': isinstance(module, DownloadModule),
+        'batch_track_info': supports_batch_track_info(module)
     }
@@ -1,4 +1,7 @@
-import logging, os, ffmpeg, sys
+import logging, os, ffmpeg, sys, threading, time
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from typing import Optional
 import shutil
 import unicodedata
 from dataclasses import asdict
@@ -6,10 +9,18 @@ from time import strftime, gmtime
 
 from ffmpeg import Error
 
-from orpheus.tagging import tag_file
+from orpheus.tagging import FFMPEG_COVER_CONTAINERS, ffmpeg_metadata, tag_file
 from orpheus.services.metadata import metadata_normalizer
+from orpheus.services.metadata_cache import MetadataCache
+from orpheus.services.track_index import TrackIndex
+from orpheus.modules.base import supports_batch_track_info
+from orpheus.delivery.conversion import run_ffmpeg
+from orpheus.delivery import ArtistPlan, ConversionOutput, JobWorkerPool, M3UPlaylist, MetadataPrefetcher, PipelineStage, PlannedAlbum, PlannedTrack, SingleFlightMemo, StagedPipeline, TrackContext, delivery_pipeline, load_output_profiles, recording_key
 from utils.models import *
 from utils.utils import *
+from utils.cover_cache import cover_cache
+from utils.cover_similarity import CoverMatcher
+from utils.network import network_manager
 from utils.exceptions import *
 
 
@@ -33,37 +44,201 @@ class Downloader:
         self.download_mode = None
         self.service = None
         self.service_name = None
+        self.job_id = None
+        self.search_memo = SingleFlightMemo()
+        self.album_memo = SingleFlightMemo()
+        self.track_index: Optional[TrackIndex] = None
+        self.metadata_cache: Optional[MetadataCache] = None
+        # A dry run resolves tracks and collects them in planned_tracks instead of downloading anything
+        self.dry_run = False
+        self.planned_tracks: list[PlannedTrack] = []
         self.module_list = module_controls['module_list']
         self.module_settings = module_controls['module_settings']
         self.loaded_modules = module_controls['loaded_modules']
         self.load_module = module_controls['module_loader']
         self.global_settings = settings
+        # Non-experimental encoders ffmpeg pointed to, by codec
+        self.conversion_encoders = {}
+        # ffmpeg runs in its own process, threads only wait for it, so one per core keeps every core busy
+        self.conversion_pool = ThreadPoolExecutor(int(self._performance_setting('conversion_workers', 0) or os.cpu_count() or 1),
+                                                  thread_name_prefix='orpheus-convert')
+        # mutagen mostly waits on the disk, and for Ogg/Opus covers PIL only reads the image header, so threads do
+        self.tagging_pool = ThreadPoolExecutor(max(1, int(self._performance_setting('tagging_workers', 2) or 1)), thread_name_prefix='orpheus-tag')
+        # Covers, lyrics, credits and album extras are fetched on their own threads while the audio downloads
+        self.asset_pool = ThreadPoolExecutor(max(1, int(self._performance_setting('asset_workers', 4) or 1)), thread_name_prefix='orpheus-assets')
+        # Set on ^C, tracks being downloaded check it between stages
+        self.stopped = threading.Event()
+        self.tag_failures: list[str] = []
+        self._tag_failures_lock = threading.Lock()
 
         self.oprinter = oprinter
         self.print = self.oprinter.oprint
         self.set_indent_number = self.oprinter.set_indent_number
 
-    def search_by_tags(self, module_name, track_info: TrackInfo):
-        return self.loaded_modules[module_name].search(DownloadTypeEnum.track, f'{track_info.name} {" ".join(track_info.artists)}', track_info=track_info)
-
-    def _add_track_m3u_playlist(self, m3u_playlist: str, track_info: TrackInfo, track_location: str):
-        if self.global_settings['playlist']['extended_m3u']:
-            with open(m3u_playlist, 'a', encoding='utf-8') as f:
-                # if no duration exists default to -1
-                duration = track_info.duration if track_info.duration else -1
-                # write the extended track header
-                f.write(f'#EXTINF:{duration}, {track_info.artists[0]} - {track_info.name}\n')
-
-        with open(m3u_playlist, 'a', encoding='utf-8') as f:
-            if self.global_settings['playlist']['paths_m3u'] == "absolute":
-                # add the absolute paths to the playlist
-                f.write(f'{os.path.abspath(track_location)}\n')
-            else:
-                # add the relative paths to the playlist by subtracting the track_location with the m3u_path
-                f.write(f'{os.path.relpath(track_location, os.path.dirname(m3u_playlist))}\n')
+    def start_job(self, job_id: str):
+        # Memoised lookups only live for one job
+        self.job_id = job_id
+        self.search_memo = SingleFlightMemo()
+        self.album_memo = SingleFlightMemo()
+        self.tag_failures = []
+
+    def module_service(self, module_name):
+        # Metadata calls go through the disk cache when it is enabled
+        module = self.loaded_modules[module_name]
+        return self.metadata_cache.wrap(module_name, module) if self.metadata_cache else module
+
+    def _performance_setting(self, setting: str, default):
+        return self.global_settings.get('performance', {}).get(setting, default)
+
+    def _create_track_context(self, track_id, indent_level=1, **request) -> TrackContext:
+        return TrackContext(
+            service = self.service,
+            service_name = self.service_name,
+            download_mode = self.download_mode,
+            track_id = track_id,
+            indent_level = indent_level,
+            **request
+        )
 
-            # add an extra new line to the extended format
-            f.write('\n') if self.global_settings['playlist']['extended_m3u'] else None
+    def _run_track_jobs(self, contexts: list, resolve=None, on_track_done=None, prefetch=True):
+        if self.dry_run:
+            # Nothing is downloaded, so a plan can have every track's info fetched at once
+            self._prefetch_track_infos(contexts)
+            return self._plan_track_jobs(contexts, resolve)
+        try:
+            if self._performance_setting('staged_pipeline', False):
+                return self._run_staged_track_jobs(contexts, resolve, on_track_done)
+
+            prefetch_depth = self._performance_setting('metadata_prefetch_depth', 0) if prefetch else 0
+            with JobWorkerPool(self._performance_setting('max_parallel_tracks', 1)) as pool, \
+                    MetadataPrefetcher(partial(self._run_track_stage, 'resolve', resolve or self._resolve_track), contexts, prefetch_depth,
+                                       *self._track_info_batches(contexts, prefetch_depth)) as prefetcher:
+                for context in contexts:
+                    context.show_progress = not pool.concurrent
+                futures = [pool.submit(self._download_track_job, context, position, len(contexts), prefetcher, pool.concurrent)
+                           for position, context in enumerate(contexts, start=1)]
+
+                # Collect in job order so callers see tracks in order even if they finish out of order
+                for future, context in zip(futures, contexts):
+                    future.result()
+                    self._wait_for_post_processing(context)
+                    if on_track_done: on_track_done(context)
+        except (KeyboardInterrupt, SystemExit):
+            # ^C, which a track downloading on this thread turns into SystemExit
+            self.stop()
+            raise
+
+    def stop(self):
+        """Stops the job: tracks in progress end after their current stage, queued conversions, tagging and assets are dropped."""
+        self.stopped.set()
+        for pool in (self.conversion_pool, self.tagging_pool, self.asset_pool):
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def _run_staged_track_jobs(self, contexts: list, resolve=None, on_track_done=None):
+        positions = {id(context): position for position, context in enumerate(contexts, start=1)}
+        stage_workers = self._performance_setting('stage_workers', {})
+
+        def print_track_header(context: TrackContext):
+            self.set_indent_number(context.indent_level)
+            print()
+            self.print(f'Track {positions[id(context)]}/{len(contexts)}', drop_level=1)
+
+        def stage_handler(stage: str, handler):
+            def run(context: TrackContext):
+                if stage == 'fetch_audio': print_track_header(context)
+                self._run_track_stage(stage, handler, context)
+            return run
+
+        for context in contexts:
+            context.show_progress = False
+        queue_size = self._performance_setting('stage_queue_size', 2)
+        # Resolved tracks wait at most a queue ahead of the download stage
+        with MetadataPrefetcher(resolve or self._resolve_track, contexts, 0, *self._track_info_batches(contexts, queue_size)) as batches:
+            pipeline = StagedPipeline([PipelineStage(stage, stage_handler(stage, handler), stage_workers.get(stage, 1))
+                                       for stage, handler in self._track_stages(batches.resolve)],
+                                      queue_size=queue_size,
+                                      is_finished=lambda context: context.status is not None or self.stopped.is_set())
+            for context in pipeline.run(contexts):
+                if on_track_done: on_track_done(context)
+
+    def _plan_track_jobs(self, contexts: list, resolve=None):
+        with ThreadPoolExecutor(max(1, int(self._performance_setting('max_parallel_tracks', 1) or 1)), thread_name_prefix='orpheus-plan') as pool:
+            for planned_track in pool.map(partial(self._plan_track, resolve=resolve), contexts):
+                self._add_planned_track(planned_track)
+
+    def _add_planned_track(self, planned_track: PlannedTrack):
+        self.planned_tracks.append(planned_track)
+        if planned_track.exists:
+            status = 'exists'
+        elif planned_track.location:
+            status = f'{planned_track.size / 1024 ** 2:.1f} MiB' if planned_track.size is not None else 'unknown size'
+        else:
+            status = f'skipped ({planned_track.skip_reason})'
+        self.print(f'{planned_track.name or planned_track.track_id}: {status}')
+
+    def _plan_track(self, context: TrackContext, resolve=None) -> PlannedTrack:
+        """Resolves a track like a download would and estimates its size, without transferring audio."""
+        if not context.resolved:
+            (resolve or self._resolve_track)(context)
+        track_info = context.track_info
+        planned_track = PlannedTrack(str(context.track_id), context.service_name, track_info.name if track_info else '',
+                                     list(track_info.artists) if track_info else [], skip_reason=context.skip_reason)
+        if context.skip_reason not in {None, 'exists'}:
+            return planned_track
+
+        codec = context.download_info.different_codec if context.download_info and context.download_info.different_codec else track_info.codec
+        # The same rules as the conversion itself, so a refused conversion plans the file in its own codec
+        outputs = self._conversion_outputs(context, codec, warn=False)
+        planned_track.location = outputs[0].location if outputs else f'{context.track_location_name}.{codec_data[codec].container.name}'
+        planned_track.exists = context.skip_reason == 'exists'
+        if not planned_track.exists:
+            planned_track.size, planned_track.size_source = self._probe_track_size(context)
+        return planned_track
+
+    @staticmethod
+    def _probe_track_size(context: TrackContext):
+        download_info, track_info = context.download_info, context.track_info
+        try:
+            if download_info and download_info.download_type is DownloadEnum.URL:
+                response = network_manager.request('HEAD', download_info.file_url, headers=download_info.file_url_headers or {}, allow_redirects=True, timeout=30)
+                if 'content-length' in response.headers:
+                    return int(response.headers['content-length']), 'content-length'
+            elif download_info and download_info.download_type is DownloadEnum.TEMP_FILE_PATH:
+                # The module already fetched the stream into a temporary file
+                return os.path.getsize(download_info.temp_file_path), 'file'
+        except Exception as e:
+            logging.debug('Could not probe the size of track %s: %s', context.track_id, e)
+        if track_info.bitrate and track_info.duration:
+            return track_info.bitrate * 1000 // 8 * track_info.duration, 'bitrate'
+        return None, None
+
+    def search_by_tags(self, module_name, track_info: TrackInfo):
+        query = f'{track_info.name} {" ".join(track_info.artists)}'
+        # The covers, lyrics and credits lookups of a track often hit the same module with the same query
+        return self.search_memo.get((module_name, query, track_info.tags.isrc),
+                                    lambda: self.loaded_modules[module_name].search(DownloadTypeEnum.track, query, track_info=track_info))
+
+    def _lookup_track_index(self, module_name, track_info: TrackInfo, source_service, source_id, purpose='match'):
+        # Returns TrackIndex.MISS when the index is disabled or doesn't know the track
+        if not self.track_index:
+            return TrackIndex.MISS
+        cached = self.track_index.lookup(source_service, source_id, track_info.tags.isrc, module_name, purpose)
+        if cached is TrackIndex.MISS or cached is None:
+            return cached
+        return SearchResult(result_id=cached[0], extra_kwargs=cached[1])
+
+    def find_track_on_module(self, module_name, track_info: TrackInfo, source_service, source_id) -> Optional[SearchResult]:
+        """Best search result for a track on another module, remembered across runs in the track index."""
+        cached = self._lookup_track_index(module_name, track_info, source_service, source_id)
+        if cached is not TrackIndex.MISS:
+            return cached
+
+        results: list[SearchResult] = self.search_by_tags(module_name, track_info)
+        result = results[0] if results else None
+        if self.track_index:
+            self.track_index.store(source_service, source_id, track_info.tags.isrc, module_name,
+                                   result.result_id if result else None, result.extra_kwargs if result else None)
+        return result
 
     def download_playlist(self, playlist_id, custom_module=None, extra_kwargs={}):
         self.set_indent_number(1)
@@ -82,35 +257,19 @@ class Downloader:
         playlist_path = self.path + self.global_settings['formatting']['playlist_format'].format(**playlist_tags)
         # fix path byte limit
         playlist_path = fix_byte_limit(playlist_path) + '/'
-        os.makedirs(playlist_path, exist_ok=True)
-        
-        if playlist_info.cover_url:
-            self.print('Downloading playlist cover')
-            download_file(playlist_info.cover_url, f'{playlist_path}cover.{playlist_info.cover_type.name}', artwork_settings=self._get_artwork_settings())
-        
-        if playlist_info.animated_cover_url and self.global_settings['covers']['save_animated_cover']:
-            self.print('Downloading animated playlist cover')
-            download_file(playlist_info.animated_cover_url, playlist_path + 'cover.mp4', enable_progress_bar=True)
-        
-        if playlist_info.description:
-            with open(playlist_path + 'description.txt', 'w', encoding='utf-8') as f: f.write(playlist_info.description)
+        playlist_files = {}
+        if not self.dry_run:
+            os.makedirs(playlist_path, exist_ok=True)
+            playlist_files = self._download_playlist_files(playlist_path, playlist_info)
 
-        m3u_playlist_path = None
-        if self.global_settings['playlist']['save_m3u']:
+        m3u_playlist = None
+        if self.global_settings['playlist']['save_m3u'] and not self.dry_run:
             if self.global_settings['playlist']['paths_m3u'] not in {"absolute", "relative"}:
                 raise ValueError(f'Invalid value for paths_m3u: "{self.global_settings["playlist"]["paths_m3u"]}",'
                                  f' must be either "absolute" or "relative"')
 
-            m3u_playlist_path = playlist_path + f'{playlist_tags["name"]}.m3u'
-
-            # create empty file
-            with open(m3u_playlist_path, 'w', encoding='utf-8') as f:
-                f.write('')
-
-            # if extended format add the header
-            if self.global_settings['playlist']['extended_m3u']:
-                with open(m3u_playlist_path, 'a', encoding='utf-8') as f:
-                    f.write('#EXTM3U\n\n')
+            m3u_playlist = M3UPlaylist(playlist_path + f'{playlist_tags["name"]}.m3u', extended=self.global_settings['playlist']['extended_m3u'],
+                                       absolute_paths=self.global_settings['playlist']['paths_m3u'] == "absolute")
 
         tracks_errored = set()
         if custom_module:
@@ -118,47 +277,121 @@ class Downloader:
             if ModuleModes.download not in supported_modes and ModuleModes.playlist not in supported_modes:
                 raise Exception(f'Module "{custom_module}" cannot be used to download a playlist') # TODO: replace with ModuleDoesNotSupportAbility
             self.print(f'Service used for downloading: {self.module_settings[custom_module].service_name}')
-            original_service = str(self.service_name)
             self.load_module(custom_module)
-            for index, track_id in enumerate(playlist_info.tracks, start=1):
-                self.set_indent_number(2)
-                print()
-                self.print(f'Track {index}/{number_of_tracks}', drop_level=1)
-                quality_tier = QualityEnum[self.global_settings['general']['download_quality'].upper()]
-                codec_options = CodecOptions(
-                    spatial_codecs = self.global_settings['codecs']['spatial_codecs'],
-                    proprietary_codecs = self.global_settings['codecs']['proprietary_codecs'],
-                )
-                track_info: TrackInfo = self.loaded_modules[original_service].get_track_info(track_id, quality_tier, codec_options, **playlist_info.track_extra_kwargs)
-                
-                self.service = self.loaded_modules[custom_module]
-                self.service_name = custom_module
-                results = self.search_by_tags(custom_module, track_info)
-                track_id_new = results[0].result_id if len(results) else None
-                
-                if track_id_new:
-                    self.download_track(track_id_new, album_location=playlist_path, track_index=index, number_of_tracks=number_of_tracks, indent_level=2, m3u_playlist=m3u_playlist_path, extra_kwargs=results[0].extra_kwargs)
-                else:
-                    tracks_errored.add(f'{track_info.name} - {track_info.artists[0]}')
-                    if ModuleModes.download in self.module_settings[original_service].module_supported_modes:
-                        self.service = self.loaded_modules[original_service]
-                        self.service_name = original_service
-                        self.print(f'Track {track_info.name} not found, using the original service as a fallback', drop_level=1)
-                        self.download_track(track_id, album_location=playlist_path, track_index=index, number_of_tracks=number_of_tracks, indent_level=2, m3u_playlist=m3u_playlist_path, extra_kwargs=playlist_info.track_extra_kwargs)
-                    else:
-                        self.print(f'Track {track_info.name} not found, skipping')
-        else:
-            for index, track_id in enumerate(playlist_info.tracks, start=1):
-                self.set_indent_number(2)
-                print()
-                self.print(f'Track {index}/{number_of_tracks}', drop_level=1)
-                self.download_track(track_id, album_location=playlist_path, track_index=index, number_of_tracks=number_of_tracks, indent_level=2, m3u_playlist=m3u_playlist_path, extra_kwargs=playlist_info.track_extra_kwargs)
+
+        contexts = [self._create_track_context(track_id, 2, album_location=playlist_path, track_index=index, number_of_tracks=number_of_tracks,
+                                               extra_kwargs=playlist_info.track_extra_kwargs)
+                    for index, track_id in enumerate(playlist_info.tracks, start=1)]
+
+        def add_to_m3u(context: TrackContext):
+            if m3u_playlist and context.track_location:
+                m3u_playlist.add(context.track_index, context.track_info, context.track_location)
+
+        try:
+            if custom_module:
+                # Resolving re-targets every track to the custom module and prints the search outcome, so it isn't prefetched
+                resolve = partial(self._resolve_playlist_track_with_module, custom_module=custom_module, tracks_errored=tracks_errored)
+                self._run_track_jobs(contexts, resolve, on_track_done=add_to_m3u, prefetch=False)
+            else:
+                self._run_track_jobs(contexts, on_track_done=add_to_m3u)
+        finally:
+            # Also keeps the tracks that made it when the download is interrupted
+            if m3u_playlist: m3u_playlist.flush()
+        self._wait_for_assets(playlist_files)
 
         self.set_indent_number(1)
         self.print(f'=== Playlist {playlist_info.name} downloaded ===', drop_level=1)
 
         if tracks_errored: logging.debug('Failed tracks: ' + ', '.join(tracks_errored))
 
+    def _download_track_job(self, context: TrackContext, position, job_size, prefetcher: MetadataPrefetcher = None, concurrent=False):
+        self.set_indent_number(context.indent_level)
+        print()
+        self.print(f'Track {position}/{job_size}', drop_level=1)
+        if prefetcher: prefetcher.resolve(context)
+        self._download_track(context, deferred=True, defer_tagging=concurrent)
+
+    def _track_info_options(self) -> tuple:
+        quality_tier = QualityEnum[self.global_settings['general']['download_quality'].upper()]
+        codec_options = CodecOptions(
+            spatial_codecs = self.global_settings['codecs']['spatial_codecs'],
+            proprietary_codecs = self.global_settings['codecs']['proprietary_codecs'],
+        )
+        return quality_tier, codec_options
+
+    def _get_track_info(self, service, track_id, extra_kwargs) -> TrackInfo:
+        return service.get_track_info(track_id, *self._track_info_options(), **extra_kwargs)
+
+    def _get_tracks_info(self, service, tracks: list, pool: ThreadPoolExecutor = None) -> dict:
+        """
+        Track info of (track_id, extra_kwargs) pairs by the string form of the id, fetched with get_tracks_info for services
+        with a batch method, in batches of at most their tracks_info_batch_size. Tracks missing from the result, like all of
+        them for services without one or whose batch failed, are left for get_track_info.
+        """
+        if not tracks or not supports_batch_track_info(service):
+            return {}
+        # Tracks only share a call when they share their extra_kwargs, which is usually per album or playlist
+        groups = {}
+        for track_id, extra_kwargs in tracks:
+            groups.setdefault(repr(sorted((extra_kwargs or {}).items())), (extra_kwargs or {}, []))[1].append(track_id)
+        batch_size = int(getattr(service, 'tracks_info_batch_size', 0) or 0)
+        batches = [(track_ids[start:start + (batch_size or len(track_ids))], extra_kwargs)
+                   for extra_kwargs, track_ids in groups.values() for start in range(0, len(track_ids), batch_size or len(track_ids))]
+
+        def fetch(batch):
+            track_ids, extra_kwargs = batch
+            try:
+                return service.get_tracks_info(track_ids, *self._track_info_options(), **extra_kwargs) or {}
+            except Exception as e:
+                logging.debug('Could not fetch track info of %d tracks at once, fetching them one by one: %s', len(track_ids), e)
+                return {}
+
+        track_infos = {}
+        for result in (pool.map(fetch, batches) if pool else map(fetch, batches)):
+            track_infos.update({str(track_id): track_info for track_id, track_info in result.items() if track_info})
+        return track_infos
+
+    def _track_info_batches(self, contexts: list, lookahead: int) -> tuple:
+        """
+        The batch fetch and batch size for a MetadataPrefetcher, for services with a batch method. Batches are the service's
+        tracks_info_batch_size, or cover the tracks resolved ahead, so track info isn't fetched long before its download.
+        """
+        if not contexts or not supports_batch_track_info(contexts[0].service):
+            return None, 0
+        batch_size = int(getattr(contexts[0].service, 'tracks_info_batch_size', 0) or 0) or int(lookahead or 0) + 1
+        return (self._prefetch_track_infos, batch_size) if batch_size > 1 else (None, 0)
+
+    def _prefetch_track_infos(self, contexts: list):
+        # A service with a batch method gets these tracks in a few calls instead of one call per track
+        pending = [context for context in contexts if not context.track_info and not context.resolved]
+        if not pending:
+            return
+        track_infos = self._get_tracks_info(pending[0].service, [(context.track_id, context.extra_kwargs) for context in pending])
+        for context in pending:
+            context.track_info = track_infos.get(str(context.track_id))
+
+    def _resolve_playlist_track_with_module(self, context: TrackContext, custom_module, tracks_errored: set):
+        track_info: TrackInfo = context.track_info or self._get_track_info(context.service, context.track_id, context.extra_kwargs)
+
+        result = self.find_track_on_module(custom_module, track_info, context.service_name, context.track_id)
+
+        if result:
+            # The track info of the original service doesn't apply to the custom module's track
+            context.track_info = None
+            context.service = self.module_service(custom_module)
+            context.service_name = custom_module
+            context.track_id = result.result_id
+            context.extra_kwargs = result.extra_kwargs or {}
+            self._resolve_track(context)
+        else:
+            tracks_errored.add(f'{track_info.name} - {track_info.artists[0]}')
+            if ModuleModes.download in self.module_settings[context.service_name].module_supported_modes:
+                self.print(f'Track {track_info.name} not found, using the original service as a fallback', drop_level=1)
+                self._resolve_track(context)
+            else:
+                self.print(f'Track {track_info.name} not found, skipping')
+                context.track_info, context.resolved, context.skip_reason = track_info, True, 'not_found'
+
     @staticmethod
     def _get_artist_initials_from_name(album_info: AlbumInfo) -> str:
         # Remove "the" from the inital string
@@ -185,29 +418,56 @@ class Downloader:
         album_path = path + self.global_settings['formatting']['album_format'].format(**album_tags)
         # fix path byte limit
         album_path = fix_byte_limit(album_path) + '/'
-        os.makedirs(album_path, exist_ok=True)
+        if not self.dry_run: os.makedirs(album_path, exist_ok=True)
 
         return album_path
 
-    def _download_album_files(self, album_path: str, album_info: AlbumInfo):
+    def _resolve_album(self, service, album_id, path: str) -> tuple:
+        album_info: AlbumInfo = service.get_album_info(album_id)
+        album_location = self._create_album_location(path, album_id, album_info)
+        return album_info, album_location.replace('\\', '/')
+
+    def _download_playlist_files(self, playlist_path: str, playlist_info: PlaylistInfo) -> dict:
+        # Started next to the tracks, returns the futures of the downloads by name
+        files = {}
+        if playlist_info.cover_url:
+            self.print('Downloading playlist cover')
+            files['playlist_cover'] = self._submit_asset('playlist_cover', cover_cache.save, playlist_info.cover_url,
+                                                         f'{playlist_path}cover.{playlist_info.cover_type.name}', self._get_artwork_settings())
+
+        if playlist_info.animated_cover_url and self.global_settings['covers']['save_animated_cover']:
+            self.print('Downloading animated playlist cover')
+            files['animated_playlist_cover'] = self._submit_asset('animated_playlist_cover', download_file, playlist_info.animated_cover_url, playlist_path + 'cover.mp4')
+
+        if playlist_info.description:
+            with open(playlist_path + 'description.txt', 'w', encoding='utf-8') as f: f.write(playlist_info.description)
+        return files
+
+    def _download_album_files(self, album_path: str, album_info: AlbumInfo, service_name=None) -> dict:
+        # Started next to the tracks, returns the futures of the downloads by name
+        files = {}
         if album_info.cover_url:
             self.print('Downloading album cover')
-            download_file(album_info.cover_url, f'{album_path}cover.{album_info.cover_type.name}', artwork_settings=self._get_artwork_settings())
+            files['album_cover'] = self._submit_asset('album_cover', cover_cache.save, album_info.cover_url,
+                                                      f'{album_path}cover.{album_info.cover_type.name}', self._get_artwork_settings(service_name))
 
         if album_info.animated_cover_url and self.global_settings['covers']['save_animated_cover']:
             self.print('Downloading animated album cover')
-            download_file(album_info.animated_cover_url, album_path + 'cover.mp4', enable_progress_bar=True)
+            files['animated_album_cover'] = self._submit_asset('animated_album_cover', download_file, album_info.animated_cover_url, album_path + 'cover.mp4')
 
         if album_info.description:
             with open(album_path + 'description.txt', 'w', encoding='utf-8') as f:
                 f.write(album_info.description)  # Also add support for this with singles maybe?
+        return files
 
-    def download_album(self, album_id, artist_name='', path=None, indent_level=1, extra_kwargs={}):
+    def download_album(self, album_id, artist_name='', path=None, indent_level=1, extra_kwargs={}, planned: PlannedAlbum = None, plan: ArtistPlan = None):
         self.set_indent_number(indent_level)
 
-        album_info: AlbumInfo = self.service.get_album_info(album_id, **extra_kwargs)
+        album_info: AlbumInfo = planned.album_info if planned else self.service.get_album_info(album_id, **extra_kwargs)
         if not album_info:
             return
+        duplicate_tracks = planned.duplicate_tracks if planned else set()
+        track_info = plan.track_info if plan else lambda track_id: None
         number_of_tracks = len(album_info.tracks)
         path = self.path if not path else path
 
@@ -227,29 +487,90 @@ class Downloader:
             self.print(f'Number of tracks: {number_of_tracks!s}')
             self.print(f'Service: {self.module_settings[self.service_name].service_name}')
 
-            if album_info.booklet_url and not os.path.exists(album_path + 'Booklet.pdf'):
-                self.print('Downloading booklet')
-                download_file(album_info.booklet_url, album_path + 'Booklet.pdf')
-            
-            cover_temp_location = download_to_temp(album_info.all_track_cover_jpg_url) if album_info.all_track_cover_jpg_url else ''
+            album_files = {}
+            if not self.dry_run:
+                if album_info.booklet_url and not os.path.exists(album_path + 'Booklet.pdf'):
+                    self.print('Downloading booklet')
+                    album_files['booklet'] = self._submit_asset('booklet', download_file, album_info.booklet_url, album_path + 'Booklet.pdf')
 
-            # Download booklet, animated album cover and album cover if present
-            self._download_album_files(album_path, album_info)
+                # Download booklet, animated album cover and album cover if present, while the first tracks download
+                album_files.update(self._download_album_files(album_path, album_info))
 
-            for index, track_id in enumerate(album_info.tracks, start=1):
-                self.set_indent_number(indent_level + 1)
-                print()
-                self.print(f'Track {index}/{number_of_tracks}', drop_level=1)
-                self.download_track(track_id, album_location=album_path, track_index=index, number_of_tracks=number_of_tracks, main_artist=artist_name, cover_temp_location=cover_temp_location, indent_level=indent_level+1, extra_kwargs=album_info.track_extra_kwargs)
+            # Track numbers stay those of the full album when duplicates are left out
+            self._run_track_jobs([self._create_track_context(track_id, indent_level + 1, album_location=album_path, track_index=index,
+                                                             number_of_tracks=number_of_tracks, main_artist=artist_name,
+                                                             shared_cover_url=album_info.all_track_cover_jpg_url or '',
+                                                             extra_kwargs=album_info.track_extra_kwargs, track_info=track_info(track_id))
+                                  for index, track_id in enumerate(album_info.tracks, start=1) if str(track_id) not in duplicate_tracks])
+            self._wait_for_assets(album_files)
 
             self.set_indent_number(indent_level)
             self.print(f'=== Album {album_info.name} downloaded ===', drop_level=1)
-            if cover_temp_location: silentremove(cover_temp_location)
-        elif number_of_tracks == 1:
-            self.download_track(album_info.tracks[0], album_location=path, number_of_tracks=1, main_artist=artist_name, indent_level=indent_level, extra_kwargs=album_info.track_extra_kwargs)
+        elif number_of_tracks == 1 and str(album_info.tracks[0]) not in duplicate_tracks:
+            self._download_track(self._create_track_context(album_info.tracks[0], indent_level, album_location=path, number_of_tracks=1, main_artist=artist_name,
+                                                            extra_kwargs=album_info.track_extra_kwargs, track_info=track_info(album_info.tracks[0])))
 
         return album_info.tracks
 
+    def _plan_artist(self, artist_info: ArtistInfo) -> ArtistPlan:
+        """
+        Fetches every album of the artist (and, to deduplicate them, the info of every track) concurrently, then drops
+        recordings already planned on an earlier album, e.g. the standard edition tracks of a deluxe edition.
+        Tracks fetch their info again when they download, unless the module flags its track info as static.
+        """
+        skip_duplicates = self.global_settings['artist_downloading'].get('skip_duplicate_recordings', True)
+        skip_downloaded = self.global_settings['artist_downloading']['separate_tracks_skip_downloaded']
+        plan = ArtistPlan()
+
+        with ThreadPoolExecutor(max(1, int(self._performance_setting('artist_planning_workers', 4) or 1)), thread_name_prefix='orpheus-plan') as pool:
+            album_infos = list(pool.map(lambda album_id: self.service.get_album_info(album_id, **artist_info.album_extra_kwargs), artist_info.albums))
+
+            if skip_duplicates:
+                def fetch_track_info(track):
+                    track_id, extra_kwargs = track
+                    try:
+                        return self._get_track_info(self.service, track_id, extra_kwargs)
+                    except Exception as e:
+                        # Not deduplicated, the download reports the error
+                        logging.debug('Could not plan track %s: %s', track_id, e)
+                        return None
+
+                tracks = [(track_id, album_info.track_extra_kwargs) for album_info in album_infos if album_info for track_id in album_info.tracks]
+                if skip_downloaded:
+                    tracks += [(track_id, artist_info.track_extra_kwargs) for track_id in artist_info.tracks]
+                track_infos = self._get_tracks_info(self.service, tracks, pool)
+                tracks = [track for track in tracks if str(track[0]) not in track_infos]
+                for (track_id, _), track_info in zip(tracks, pool.map(fetch_track_info, tracks)):
+                    if track_info: track_infos[str(track_id)] = track_info
+                plan.recording_keys = {track_id: recording_key(track_info) for track_id, track_info in track_infos.items()}
+                if ModuleFlags.static_track_info in self.module_settings[self.service_name].flags:
+                    plan.track_infos = track_infos
+
+        planned_ids, planned_recordings = set(), set()
+
+        def is_duplicate(track_id) -> bool:
+            # Plans the track unless it (or the same recording) is planned already
+            key = plan.recording_keys.get(str(track_id)) if skip_duplicates else None
+            if str(track_id) in planned_ids or (key and key in planned_recordings):
+                return True
+            planned_ids.add(str(track_id))
+            if key: planned_recordings.add(key)
+            return False
+
+        for album_id, album_info in zip(artist_info.albums, album_infos):
+            if not album_info:
+                continue
+            duplicates = {str(track_id) for track_id in album_info.tracks if is_duplicate(track_id)}
+            planned = PlannedAlbum(album_id, album_info, duplicates if skip_duplicates else set())
+            if album_info.tracks and len(planned.duplicate_tracks) == len(album_info.tracks):
+                plan.skipped_albums += 1
+            else:
+                plan.albums.append(planned)
+
+        plan.tracks = [track_id for track_id in artist_info.tracks if not (skip_downloaded and is_duplicate(track_id))]
+        plan.skipped_tracks = len(artist_info.tracks) - len(plan.tracks)
+        return plan
+
     def download_artist(self, artist_id, extra_kwargs={}):
         artist_info: ArtistInfo = self.service.get_artist_info(artist_id, self.global_settings['artist_downloading']['return_credited_albums'], **extra_kwargs)
         artist_name = artist_info.name
@@ -265,47 +586,62 @@ class Downloader:
         self.print(f'Service: {self.module_settings[self.service_name].service_name}')
         artist_path = self.path + sanitise_name(artist_name) + '/'
 
+        self.print('Planning discography')
+        plan = self._plan_artist(artist_info)
+
         self.set_indent_number(2)
-        tracks_downloaded = []
-        for index, album_id in enumerate(artist_info.albums, start=1):
+        for index, planned in enumerate(plan.albums, start=1):
             print()
-            self.print(f'Album {index}/{number_of_albums}', drop_level=1)
-            tracks_downloaded += self.download_album(album_id, artist_name=artist_name, path=artist_path, indent_level=2, extra_kwargs=artist_info.album_extra_kwargs)
+            self.print(f'Album {index}/{len(plan.albums)}', drop_level=1)
+            self.download_album(planned.album_id, artist_name=artist_name, path=artist_path, indent_level=2, planned=planned, plan=plan)
 
         self.set_indent_number(2)
-        skip_tracks = self.global_settings['artist_downloading']['separate_tracks_skip_downloaded']
-        tracks_to_download = [i for i in artist_info.tracks if (i not in tracks_downloaded and skip_tracks) or not skip_tracks]
-        number_of_tracks_new = len(tracks_to_download)
-        for index, track_id in enumerate(tracks_to_download, start=1):
-            print()
-            self.print(f'Track {index}/{number_of_tracks_new}', drop_level=1)
-            self.download_track(track_id, album_location=artist_path, main_artist=artist_name, number_of_tracks=1, indent_level=2, extra_kwargs=artist_info.track_extra_kwargs)
+        self._run_track_jobs([self._create_track_context(track_id, 2, album_location=artist_path, main_artist=artist_name, number_of_tracks=1,
+                                                         extra_kwargs=artist_info.track_extra_kwargs, track_info=plan.track_info(track_id))
+                              for track_id in plan.tracks])
 
         self.set_indent_number(1)
-        tracks_skipped = number_of_tracks - number_of_tracks_new
-        if tracks_skipped > 0: self.print(f'Tracks skipped: {tracks_skipped!s}', drop_level=1)
+        if plan.skipped_albums > 0: self.print(f'Albums skipped: {plan.skipped_albums!s}', drop_level=1)
+        if plan.skipped_tracks > 0: self.print(f'Tracks skipped: {plan.skipped_tracks!s}', drop_level=1)
         self.print(f'=== Artist {artist_name} downloaded ===', drop_level=1)
 
-    def download_track(self, track_id, album_location='', main_artist='', track_index=0, number_of_tracks=0, cover_temp_location='', indent_level=1, m3u_playlist=None, extra_kwargs={}):
-        quality_tier = QualityEnum[self.global_settings['general']['download_quality'].upper()]
-        codec_options = CodecOptions(
-            spatial_codecs = self.global_settings['codecs']['spatial_codecs'],
-            proprietary_codecs = self.global_settings['codecs']['proprietary_codecs'],
-        )
-        track_info: TrackInfo = self.service.get_track_info(track_id, quality_tier, codec_options, **extra_kwargs)
+    def download_track(self, track_id, album_location='', main_artist='', track_index=0, number_of_tracks=0, cover_temp_location='', indent_level=1, m3u_playlist: M3UPlaylist = None, extra_kwargs={}):
+        context = self._create_track_context(track_id, indent_level, album_location=album_location, main_artist=main_artist, track_index=track_index,
+                                             number_of_tracks=number_of_tracks, cover_temp_location=cover_temp_location, extra_kwargs=extra_kwargs)
+        self._download_track(context)
+
+        # Add the playlist track to the m3u playlist, written once the caller flushes it
+        if m3u_playlist and context.track_location:
+            m3u_playlist.add(track_index, context.track_info, context.track_location)
+
+    def _resolve_track(self, context: TrackContext):
+        """
+        Fetches the metadata of a track and works out its final location, without printing or transferring audio,
+        so it can run ahead of time on a prefetch thread. The outcome is stored on the context.
+        """
+        service, download_mode = context.service, context.download_mode
+        # Track info fetched in a batch along the prefetch lookahead, or by the artist planner for static track info
+        track_info: TrackInfo = context.track_info or self._get_track_info(service, context.track_id, context.extra_kwargs)
+        context.track_info, context.resolved = track_info, True
         normalized_track = metadata_normalizer.normalize_track(track_info)
         logging.debug('Normalized track metadata: %s', normalized_track.metadata)
         
-        if main_artist.lower() not in [i.lower() for i in track_info.artists] and self.global_settings['advanced']['ignore_different_artists'] and self.download_mode is DownloadTypeEnum.artist:
-           self.print('Track is not from the correct artist, skipping', drop_level=1)
-           return
+        if context.main_artist.lower() not in [i.lower() for i in track_info.artists] and self.global_settings['advanced']['ignore_different_artists'] and download_mode is DownloadTypeEnum.artist:
+            context.skip_reason = 'artist'
+            return
 
         if not self.global_settings['formatting']['force_album_format']:
-            if track_index:
-                track_info.tags.track_number = track_index
-            if number_of_tracks:
-                track_info.tags.total_tracks = number_of_tracks
-        zfill_number = len(str(track_info.tags.total_tracks)) if self.download_mode is not DownloadTypeEnum.track else 1
+            if context.track_index:
+                track_info.tags.track_number = context.track_index
+            if context.number_of_tracks:
+                track_info.tags.total_tracks = context.number_of_tracks
+
+        # Check if track_info returns error, the track will not be downloaded
+        if track_info.error:
+            context.skip_reason = 'error'
+            return
+
+        zfill_number = len(str(track_info.tags.total_tracks)) if download_mode is not DownloadTypeEnum.track else 1
         zfill_lambda = lambda input : sanitise_name(str(input)).zfill(zfill_number) if input is not None else None
 
         # Separate copy of tags for formatting purposes
@@ -313,45 +649,20 @@ class Downloader:
         track_tags = {k: (zfill_lambda(v) if zfill_enabled and k in zfill_list else sanitise_name(v)) for k, v in {**asdict(track_info.tags), **asdict(track_info)}.items()}
         track_tags['explicit'] = ' [E]' if track_info.explicit else ''
         track_tags['artist'] = sanitise_name(track_info.artists[0])  # if len(track_info.artists) == 1 else 'Various Artists'
-        codec = track_info.codec
-
-        self.set_indent_number(indent_level)
-        self.print(f'=== Downloading track {track_info.name} ({track_id}) ===', drop_level=1)
-
-        if self.download_mode is not DownloadTypeEnum.album and track_info.album: self.print(f'Album: {track_info.album} ({track_info.album_id})')
-        if self.download_mode is not DownloadTypeEnum.artist: self.print(f'Artists: {", ".join(track_info.artists)} ({track_info.artist_id})')
-        if track_info.release_year: self.print(f'Release year: {track_info.release_year!s}')
-        if track_info.duration: self.print(f'Duration: {beauty_format_seconds(track_info.duration)}')
-        if self.download_mode is DownloadTypeEnum.track: self.print(f'Service: {self.module_settings[self.service_name].service_name}')
-
-        to_print = 'Codec: ' + codec_data[codec].pretty_name
-        if track_info.bitrate: to_print += f', bitrate: {track_info.bitrate!s}kbps'
-        if track_info.bit_depth: to_print += f', bit depth: {track_info.bit_depth!s}bit'
-        if track_info.sample_rate: to_print += f', sample rate: {track_info.sample_rate!s}kHz'
-        self.print(to_print)
 
-        # Check if track_info returns error, display it and return this function to not download the track
-        if track_info.error:
-            self.print(track_info.error)
-            self.print(f'=== Track {track_id} failed ===', drop_level=1)
-            return
-
-        album_location = album_location.replace('\\', '/')
+        album_location = context.album_location.replace('\\', '/')
 
         # Ignores "single_full_path_format" and just downloads every track as an album
-        if self.global_settings['formatting']['force_album_format'] and self.download_mode in {
+        if self.global_settings['formatting']['force_album_format'] and download_mode in {
             DownloadTypeEnum.track, DownloadTypeEnum.playlist}:
-            # Fetch every needed album_info tag and create an album_location
-            album_info: AlbumInfo = self.service.get_album_info(track_info.album_id)
             # Save the playlist path to save all the albums in the playlist path
             path = self.path if album_location == '' else album_location
-            album_location = self._create_album_location(path, track_info.album_id, album_info)
-            album_location = album_location.replace('\\', '/')
-
-            # Download booklet, animated album cover and album cover if present
-            self._download_album_files(album_location, album_info)
+            # Fetch every needed album_info tag and create an album_location, once per album of the job
+            album_info, album_location = self.album_memo.get((context.service_name, track_info.album_id, path),
+                                                             partial(self._resolve_album, service, track_info.album_id, path))
+            context.album_info, context.album_location = album_info, album_location
 
-        if self.download_mode is DownloadTypeEnum.track and not self.global_settings['formatting']['force_album_format']:  # Python 3.10 can't become popular sooner, ugh
+        if download_mode is DownloadTypeEnum.track and not self.global_settings['formatting']['force_album_format']:  # Python 3.10 can't become popular sooner, ugh
             track_location_name = self.path + self.global_settings['formatting']['single_full_path_format'].format(**track_tags)
         elif track_info.tags.total_tracks == 1 and not self.global_settings['formatting']['force_album_format']:
             track_location_name = album_location + self.global_settings['formatting']['single_full_path_format'].format(**track_tags)
@@ -360,40 +671,181 @@ class Downloader:
             track_location_name = album_location + self.global_settings['formatting']['track_filename_format'].format(**track_tags)
         # fix file byte limit
         track_location_name = fix_byte_limit(track_location_name)
-        os.makedirs(track_location_name[:track_location_name.rfind('/')], exist_ok=True)
+
+        try:
+            profiles = load_output_profiles(self.global_settings['advanced'].get('output_profiles', {}))
+        except:
+            profiles = None
+        if profiles:
+            # Every profile gets its own location, the track's files like lyrics go with the first one
+            path = os.path.relpath(track_location_name, self.path).replace('\\', '/')
+            context.output_profiles = [(profile, fix_byte_limit(self.path + profile.path_format.format(profile=profile.name, path=path, **track_tags)))
+                                       for profile in profiles]
+            track_location_name = context.output_profiles[0][1]
+        else:
+            context.output_profiles = profiles
+
+        if not self.dry_run:
+            for location_name in {track_location_name, *(location_name for _, location_name in context.output_profiles or [])}:
+                os.makedirs(location_name[:location_name.rfind('/')], exist_ok=True)
+        context.track_location_name = track_location_name
 
         try:
             conversions = {CodecEnum[k.upper()]: CodecEnum[v.upper()] for k, v in self.global_settings['advanced']['codec_conversions'].items()}
         except:
-            conversions = {}
+            conversions = None
+        context.conversions = conversions
+
+        # Conversions that aren't allowed leave the track in its own codec, and so under its own extension
+        check_locations = [output.location for output in self._conversion_outputs(context, track_info.codec, warn=False)] \
+            or [f'{track_location_name}.{codec_data[track_info.codec].container.name}']
+
+        if all(os.path.isfile(check_location) for check_location in check_locations) and not self.global_settings['advanced']['ignore_existing_files']:
+            context.skip_reason = 'exists'
+            return
+
+        try:
+            context.download_info = service.get_track_download(**track_info.download_extra_kwargs)
+        except Exception as e:
+            # Raised again when the track is actually downloaded, so failures are reported in order
+            context.download_error = e
+
+    def _track_stages(self, resolve=None) -> list:
+        return [
+            ('resolve', resolve or self._resolve_track),
+            ('fetch_audio', self._fetch_track_audio),
+            ('fetch_assets', self._fetch_track_assets),
+            ('convert', self._convert_track),
+            ('tag', self._tag_track),
+            ('finalize', self._finalize_track),
+        ]
+
+    def _run_track_stage(self, stage: str, handler, context: TrackContext):
+        self.set_indent_number(context.indent_level)
+        delivery_pipeline.stage_transition(self.job_id, context.service_name, stage, 'started', track_id=context.track_id)
+        start = time.perf_counter()
+        try:
+            handler(context)
+        except BaseException:
+            delivery_pipeline.stage_transition(self.job_id, context.service_name, stage, 'failed', track_id=context.track_id)
+            raise
+        # Stages can add measurements of their own, like the CPU time of a conversion
+        metrics, context.stage_metrics = context.stage_metrics, {}
+        delivery_pipeline.stage_transition(self.job_id, context.service_name, stage, context.status or 'finished',
+                                           track_id=context.track_id, duration=f'{time.perf_counter() - start:.3f}', **metrics)
+        if metrics: logging.debug('Track %s %s: %s', context.track_id, stage, metrics)
+
+    def _post_processing_pool(self, stage: str, context: TrackContext, defer_tagging: bool) -> Optional[ThreadPoolExecutor]:
+        if stage == 'convert' and self._needs_conversion(context): return self.conversion_pool
+        # Tracks of a sequential job are tagged where they were converted, after their download and in job order
+        if stage == 'tag' and defer_tagging: return self.tagging_pool
+        return None
+
+    def _download_track(self, context: TrackContext, deferred=False, start=0, defer_tagging=False):
+        if self.dry_run:
+            return self._add_planned_track(self._plan_track(context))
+        stages = self._track_stages()
+        for position, (stage, handler) in enumerate(stages[start:], start=start):
+            if stage == 'resolve' and context.resolved: continue
+            if context.status or self.stopped.is_set(): break
+            # The stage a pool was handed runs right away, later stages may move on to the next pool
+            pool = self._post_processing_pool(stage, context, defer_tagging) if deferred and position > start else None
+            if pool:
+                # Converting and tagging move to their pools, so this worker can start the next download
+                context.post_process = pool.submit(self._post_process_track, context, position, time.perf_counter(), defer_tagging)
+                return
+            self._run_track_stage(stage, handler, context)
+
+    def _post_process_track(self, context: TrackContext, position: int, submitted: float, defer_tagging: bool):
+        context.stage_metrics['queue_wait'] = f'{time.perf_counter() - submitted:.3f}'
+        self._download_track(context, deferred=True, start=position, defer_tagging=defer_tagging)
+
+    def _wait_for_post_processing(self, context: TrackContext):
+        # A conversion hands the track on to the tagging pool, which replaces post_process
+        while context.post_process:
+            future, context.post_process = context.post_process, None
+            future.result()
+
+    def _fetch_track_audio(self, context: TrackContext):
+        service_name, download_mode = context.service_name, context.download_mode
+        track_id, track_info = context.track_id, context.track_info
+
+        if context.skip_reason == 'not_found':
+            context.status = 'skipped'
+            return
+
+        if context.skip_reason == 'artist':
+           self.print('Track is not from the correct artist, skipping', drop_level=1)
+           context.status = 'skipped'
+           return
+
+        codec = track_info.codec
+
+        self.print(f'=== Downloading track {track_info.name} ({track_id}) ===', drop_level=1)
+
+        if download_mode is not DownloadTypeEnum.album and track_info.album: self.print(f'Album: {track_info.album} ({track_info.album_id})')
+        if download_mode is not DownloadTypeEnum.artist: self.print(f'Artists: {", ".join(track_info.artists)} ({track_info.artist_id})')
+        if track_info.release_year: self.print(f'Release year: {track_info.release_year!s}')
+        if track_info.duration: self.print(f'Duration: {beauty_format_seconds(track_info.duration)}')
+        if download_mode is DownloadTypeEnum.track: self.print(f'Service: {self.module_settings[service_name].service_name}')
+
+        to_print = 'Codec: ' + codec_data[codec].pretty_name
+        if track_info.bitrate: to_print += f', bitrate: {track_info.bitrate!s}kbps'
+        if track_info.bit_depth: to_print += f', bit depth: {track_info.bit_depth!s}bit'
+        if track_info.sample_rate: to_print += f', sample rate: {track_info.sample_rate!s}kHz'
+        self.print(to_print)
+
+        # Check if track_info returns error, display it and return this function to not download the track
+        if context.skip_reason == 'error':
+            self.print(track_info.error)
+            self.print(f'=== Track {track_id} failed ===', drop_level=1)
+            context.status = 'failed'
+            return
+
+        # Download animated album cover and album cover if present, the track waits for them before tagging. Tracks
+        # of the same album share the downloads, which are only started by the first of them in the job
+        album_files = self.album_memo.get(('files', context.service_name, context.album_location),
+                                          partial(self._download_album_files, context.album_location, context.album_info, service_name)) \
+            if context.album_info else {}
+
+        if context.conversions is None:
+            context.conversions = {}
             self.print('Warning: codec_conversions setting is invalid!')
-        
+        if context.output_profiles is None:
+            context.output_profiles = []
+            self.print('Warning: output_profiles setting is invalid!')
+
+        track_location_name = context.track_location_name
         container = codec_data[codec].container
         track_location = f'{track_location_name}.{container.name}'
 
-        check_codec = conversions[track_info.codec] if track_info.codec in conversions else track_info.codec
-        check_location = f'{track_location_name}.{codec_data[check_codec].container.name}'
-
-        if os.path.isfile(check_location) and not self.global_settings['advanced']['ignore_existing_files']:
+        if context.skip_reason == 'exists':
             self.print('Track file already exists')
 
             # also make sure to add already existing tracks to the m3u playlist
-            if m3u_playlist:
-                self._add_track_m3u_playlist(m3u_playlist, track_info, track_location)
+            context.track_location = track_location
 
             self.print(f'=== Track {track_id} skipped ===', drop_level=1)
+            context.status = 'skipped'
             return
 
         if track_info.description:
             with open(track_location_name + '.txt', 'w', encoding='utf-8') as f: f.write(track_info.description)
 
+        self._start_track_assets(context, album_files)
+
         # Begin process
         print()
         self.print("Downloading track file")
         try:
-            download_info: TrackDownloadInfo = self.service.get_track_download(**track_info.download_extra_kwargs)
-            download_file(download_info.file_url, track_location, headers=download_info.file_url_headers, enable_progress_bar=True, indent_level=self.oprinter.indent_number) \
-                if download_info.download_type is DownloadEnum.URL else shutil.move(download_info.temp_file_path, track_location)
+            if context.download_error: raise context.download_error
+            download_info: TrackDownloadInfo = context.download_info
+            context.codec, context.container = codec, container
+            if self._streams_conversion(context, download_info) and self._stream_conversion(context, download_info):
+                container, track_location = context.container, context.audio_location
+            else:
+                download_file(download_info.file_url, track_location, headers=download_info.file_url_headers, enable_progress_bar=context.show_progress, indent_level=self.oprinter.indent_number) \
+                    if download_info.download_type is DownloadEnum.URL else shutil.move(download_info.temp_file_path, track_location)
 
             # check if get_track_download returns a different codec, for example ffmpeg failed
             if download_info.different_codec:
@@ -408,78 +860,145 @@ class Downloader:
             self.print('^C pressed, exiting')
             sys.exit(0)
         except Exception:
+            # Lookups that haven't started yet are no longer needed
+            for future in context.assets.values(): future.cancel()
             if self.global_settings['advanced']['debug_mode']: raise
             self.print('Warning: Track download failed: ' + str(sys.exc_info()[1]))
             self.print(f'=== Track {track_id} failed ===', drop_level=1)
+            context.status = 'failed'
             return
 
-        delete_cover = False
-        if not cover_temp_location:
-            cover_temp_location = create_temp_filename()
-            delete_cover = True
-            covers_module_name = self.third_party_modules[ModuleModes.covers]
-            covers_module_name = covers_module_name if covers_module_name != self.service_name else None
-            if covers_module_name: print()
-            self.print('Downloading artwork' + ((' with ' + covers_module_name) if covers_module_name else ''))
-            
-            jpg_cover_options = CoverOptions(file_type=ImageFileTypeEnum.jpg, resolution=self.global_settings['covers']['main_resolution'], \
-                compression=CoverCompressionEnum[self.global_settings['covers']['main_compression'].lower()])
-            ext_cover_options = CoverOptions(file_type=ImageFileTypeEnum[self.global_settings['covers']['external_format']], \
-                resolution=self.global_settings['covers']['external_resolution'], \
-                compression=CoverCompressionEnum[self.global_settings['covers']['external_compression'].lower()])
-            
-            if covers_module_name:
-                default_temp = download_to_temp(track_info.cover_url)
-                test_cover_options = CoverOptions(file_type=ImageFileTypeEnum.jpg, resolution=get_image_resolution(default_temp), compression=CoverCompressionEnum.high)
-                cover_module = self.loaded_modules[covers_module_name]
-                rms_threshold = self.global_settings['advanced']['cover_variance_threshold']
-
-                results: list[SearchResult] = self.search_by_tags(covers_module_name, track_info)
-                self.print('Covers to test: ' + str(len(results)))
-                attempted_urls = []
-                for i, r in enumerate(results, start=1):
-                    test_cover_info: CoverInfo = cover_module.get_track_cover(r.result_id, test_cover_options, **r.extra_kwargs)
-                    if test_cover_info.url not in attempted_urls:
-                        attempted_urls.append(test_cover_info.url)
-                        test_temp = download_to_temp(test_cover_info.url)
-                        rms = compare_images(default_temp, test_temp)
-                        silentremove(test_temp)
-                        self.print(f'Attempt {i} RMS: {rms!s}') # The smaller the root mean square, the closer the image is to the desired one
-                        if rms < rms_threshold:
-                            self.print('Match found below threshold ' + str(rms_threshold))
-                            jpg_cover_info: CoverInfo = cover_module.get_track_cover(r.result_id, jpg_cover_options, **r.extra_kwargs)
-                            download_file(jpg_cover_info.url, cover_temp_location, artwork_settings=self._get_artwork_settings(covers_module_name))
-                            silentremove(default_temp)
-                            if self.global_settings['covers']['save_external']:
-                                ext_cover_info: CoverInfo = cover_module.get_track_cover(r.result_id, ext_cover_options, **r.extra_kwargs)
-                                download_file(ext_cover_info.url, f'{track_location_name}.{ext_cover_info.file_type.name}', artwork_settings=self._get_artwork_settings(covers_module_name, is_external=True))
-                            break
-                else:
-                    self.print('Third-party module could not find cover, using fallback')
-                    shutil.move(default_temp, cover_temp_location)
+        context.codec, context.container, context.audio_location = codec, container, track_location
+
+    def _submit_asset(self, name: str, fetch, *args) -> Future:
+        return self.asset_pool.submit(self._fetch_asset, name, self.oprinter.indent_number, fetch, *args)
+
+    def _fetch_asset(self, name: str, indent_number: int, fetch, *args) -> tuple:
+        # Returns (value, error), so one failed lookup leaves the track and its other assets alone.
+        # Prints with the indentation of the thread that submitted it, which is kept per thread
+        self.oprinter.indent_number = indent_number
+        try:
+            return fetch(*args), None
+        except Exception as e:
+            self.print(f'Warning: {name.replace("_", " ")} could not be retrieved: {e}')
+            return None, e
+
+    def _wait_for_assets(self, assets: dict) -> tuple:
+        # Returns the values of the assets that were fetched, by name, and the names of those that failed
+        values, failed = {}, []
+        for name, future in assets.items():
+            value, error = future.result()
+            if error:
+                if self.global_settings['advanced']['debug_mode']: raise error
+                failed.append(name)
             else:
-                download_file(track_info.cover_url, cover_temp_location, artwork_settings=self._get_artwork_settings())
-                if self.global_settings['covers']['save_external'] and ModuleModes.covers in self.module_settings[self.service_name].module_supported_modes:
-                    ext_cover_info: CoverInfo = self.service.get_track_cover(track_id, ext_cover_options, **track_info.cover_extra_kwargs)
-                    download_file(ext_cover_info.url, f'{track_location_name}.{ext_cover_info.file_type.name}', artwork_settings=self._get_artwork_settings(is_external=True))
+                values[name] = value
+        return values, failed
 
-        if track_info.animated_cover_url and self.global_settings['covers']['save_animated_cover']:
-            self.print('Downloading animated cover')
-            download_file(track_info.animated_cover_url, track_location_name + '_cover.mp4', enable_progress_bar=True)
+    def _start_track_assets(self, context: TrackContext, album_files: dict = None):
+        # Artwork, lyrics and credits are fetched next to the audio transfer and each other, fetch_assets waits for them
+        if context.assets is not None:
+            return
+        fetchers = {'lyrics': self._fetch_track_lyrics, 'credits': self._fetch_track_credits}
+        if not context.cover_temp_location: fetchers['cover'] = self._fetch_track_cover
+        if context.track_info.animated_cover_url and self.global_settings['covers']['save_animated_cover']:
+            fetchers['animated_cover'] = self._fetch_track_animated_cover
+        context.assets = {**(album_files or {}), **{name: self._submit_asset(name, fetch, context) for name, fetch in fetchers.items()}}
+
+    def _fetch_track_assets(self, context: TrackContext):
+        self._start_track_assets(context)
+        values, failed = self._wait_for_assets(context.assets)
+        if 'cover' in values: context.cover_temp_location = values['cover']
+        if 'lyrics' in values: context.embedded_lyrics = values['lyrics']
+        if 'credits' in values: context.credits_list = values['credits']
+        context.assets = {}
+        # A failed lookup only costs the track that asset, it is reported with the stage
+        if failed: context.stage_metrics['failed_assets'] = ','.join(failed)
+
+    def _fetch_track_cover(self, context: TrackContext) -> str:
+        service, service_name = context.service, context.service_name
+        track_id, track_info, track_location_name = context.track_id, context.track_info, context.track_location_name
+
+        if context.shared_cover_url:
+            # Every track of the album has the same cover, only the first track downloads it
+            return cover_cache.get(context.shared_cover_url)
+
+        covers_module_name = self.third_party_modules[ModuleModes.covers]
+        covers_module_name = covers_module_name if covers_module_name != service_name else None
+        self.print('Downloading artwork' + ((' with ' + covers_module_name) if covers_module_name else ''))
+
+        jpg_cover_options = CoverOptions(file_type=ImageFileTypeEnum.jpg, resolution=self.global_settings['covers']['main_resolution'], \
+            compression=CoverCompressionEnum[self.global_settings['covers']['main_compression'].lower()])
+        ext_cover_options = CoverOptions(file_type=ImageFileTypeEnum[self.global_settings['covers']['external_format']], \
+            resolution=self.global_settings['covers']['external_resolution'], \
+            compression=CoverCompressionEnum[self.global_settings['covers']['external_compression'].lower()])
+
+        if not covers_module_name:
+            cover_temp_location = cover_cache.get(track_info.cover_url, self._get_artwork_settings(service_name))
+            if self.global_settings['covers']['save_external'] and ModuleModes.covers in self.module_settings[service_name].module_supported_modes:
+                ext_cover_info: CoverInfo = service.get_track_cover(track_id, ext_cover_options, **track_info.cover_extra_kwargs)
+                cover_cache.save(ext_cover_info.url, f'{track_location_name}.{ext_cover_info.file_type.name}', self._get_artwork_settings(service_name, is_external=True))
+            return cover_temp_location
+
+        default_temp = cover_cache.get(track_info.cover_url)
+        # Decoded once, candidates only need to be fetched at the small size they are compared at
+        cover_matcher = CoverMatcher(default_temp)
+        test_cover_options = CoverOptions(file_type=ImageFileTypeEnum.jpg, resolution=cover_matcher.candidate_resolution, compression=CoverCompressionEnum.high)
+        cover_module = self.loaded_modules[covers_module_name]
+        rms_threshold = self.global_settings['advanced']['cover_variance_threshold']
+
+        # Kept apart from find_track_on_module's matches, the candidate whose cover matched can be any search result
+        cached_cover = self._lookup_track_index(covers_module_name, track_info, service_name, track_id, 'cover')
+        if cached_cover is TrackIndex.MISS:
+            results: list[SearchResult] = self.search_by_tags(covers_module_name, track_info)
+            if not results and self.track_index:
+                self.track_index.store(service_name, track_id, track_info.tags.isrc, covers_module_name, purpose='cover')
+        else:
+            # The candidate that matched last time is tested on its own instead of searching again
+            results = [cached_cover] if cached_cover else []
+        self.print('Covers to test: ' + str(len(results)))
+        attempted_urls = []
+        for i, r, test_cover_url, rms in self._evaluate_cover_candidates(cover_module, results, test_cover_options, cover_matcher, rms_threshold):
+            if test_cover_url not in attempted_urls:
+                attempted_urls.append(test_cover_url)
+                self.print(f'Attempt {i} RMS: {rms!s}') # The smaller the root mean square, the closer the image is to the desired one
+                if rms < rms_threshold:
+                    self.print('Match found below threshold ' + str(rms_threshold))
+                    jpg_cover_info: CoverInfo = cover_module.get_track_cover(r.result_id, jpg_cover_options, **r.extra_kwargs)
+                    cover_temp_location = cover_cache.get(jpg_cover_info.url, self._get_artwork_settings(covers_module_name))
+                    if self.global_settings['covers']['save_external']:
+                        ext_cover_info: CoverInfo = cover_module.get_track_cover(r.result_id, ext_cover_options, **r.extra_kwargs)
+                        cover_cache.save(ext_cover_info.url, f'{track_location_name}.{ext_cover_info.file_type.name}', self._get_artwork_settings(covers_module_name, is_external=True))
+                    if self.track_index:
+                        self.track_index.store(service_name, track_id, track_info.tags.isrc, covers_module_name, r.result_id, r.extra_kwargs, 'cover')
+                    return cover_temp_location
+
+        if cached_cover and cached_cover is not TrackIndex.MISS:
+            self.track_index.forget(service_name, track_id, track_info.tags.isrc, covers_module_name, 'cover')
+        self.print('Third-party module could not find cover, using fallback')
+        return default_temp
+
+    def _fetch_track_animated_cover(self, context: TrackContext):
+        self.print('Downloading animated cover')
+        # No progress bar, it would run into the one of the audio download
+        download_file(context.track_info.animated_cover_url, context.track_location_name + '_cover.mp4')
+
+    def _fetch_track_lyrics(self, context: TrackContext) -> str:
+        service, service_name = context.service, context.service_name
+        track_id, track_info, track_location_name = context.track_id, context.track_info, context.track_location_name
 
-        # Get lyrics
         embedded_lyrics = ''
         if self.global_settings['lyrics']['embed_lyrics'] or self.global_settings['lyrics']['save_synced_lyrics']:
             lyrics_info = LyricsInfo()
-            if self.third_party_modules[ModuleModes.lyrics] and self.third_party_modules[ModuleModes.lyrics] != self.service_name:
+            if self.third_party_modules[ModuleModes.lyrics] and self.third_party_modules[ModuleModes.lyrics] != service_name:
                 lyrics_module_name = self.third_party_modules[ModuleModes.lyrics]
                 self.print('Retrieving lyrics with ' + lyrics_module_name)
                 lyrics_module = self.loaded_modules[lyrics_module_name]
 
-                if lyrics_module_name != self.service_name:
-                    results: list[SearchResult] = self.search_by_tags(lyrics_module_name, track_info)
-                    lyrics_track_id = results[0].result_id if len(results) else None
-                    extra_kwargs = results[0].extra_kwargs if len(results) else None
+                if lyrics_module_name != service_name:
+                    result = self.find_track_on_module(lyrics_module_name, track_info, service_name, track_id)
+                    lyrics_track_id = result.result_id if result else None
+                    extra_kwargs = (result.extra_kwargs or {}) if result else None
                 else:
                     lyrics_track_id = track_id
                     extra_kwargs = {}
@@ -492,8 +1011,8 @@ class Downloader:
                     #     self.print('Lyrics module could not find any lyrics.')
                 else:
                     self.print('Lyrics module could not find any lyrics.')
-            elif ModuleModes.lyrics in self.module_settings[self.service_name].module_supported_modes:
-                lyrics_info: LyricsInfo = self.service.get_track_lyrics(track_id, **track_info.lyrics_extra_kwargs)
+            elif ModuleModes.lyrics in self.module_settings[service_name].module_supported_modes:
+                lyrics_info: LyricsInfo = service.get_track_lyrics(track_id, **track_info.lyrics_extra_kwargs)
                 # if lyrics_info.embedded or lyrics_info.synced:
                 #     self.print('Lyrics retrieved')
                 # else:
@@ -510,18 +1029,22 @@ class Downloader:
                 if not os.path.isfile(lrc_location):
                     with open(lrc_location, 'w', encoding='utf-8') as f:
                         f.write(lyrics_info.synced)
+        return embedded_lyrics
+
+    def _fetch_track_credits(self, context: TrackContext) -> list:
+        service, service_name = context.service, context.service_name
+        track_id, track_info = context.track_id, context.track_info
 
-        # Get credits
         credits_list = []
-        if self.third_party_modules[ModuleModes.credits] and self.third_party_modules[ModuleModes.credits] != self.service_name:
+        if self.third_party_modules[ModuleModes.credits] and self.third_party_modules[ModuleModes.credits] != service_name:
             credits_module_name = self.third_party_modules[ModuleModes.credits]
             self.print('Retrieving credits with ' + credits_module_name)
             credits_module = self.loaded_modules[credits_module_name]
 
-            if credits_module_name != self.service_name:
-                results: list[SearchResult] = self.search_by_tags(credits_module_name, track_info)
-                credits_track_id = results[0].result_id if len(results) else None
-                extra_kwargs = results[0].extra_kwargs if len(results) else None
+            if credits_module_name != service_name:
+                result = self.find_track_on_module(credits_module_name, track_info, service_name, track_id)
+                credits_track_id = result.result_id if result else None
+                extra_kwargs = (result.extra_kwargs or {}) if result else None
             else:
                 credits_track_id = track_id
                 extra_kwargs = {}
@@ -534,108 +1057,246 @@ class Downloader:
                 #     self.print('Credits module could not find any credits.')
             # else:
             #     self.print('Credits module could not find any credits.')
-        elif ModuleModes.credits in self.module_settings[self.service_name].module_supported_modes:
+        elif ModuleModes.credits in self.module_settings[service_name].module_supported_modes:
             self.print('Retrieving credits')
-            credits_list = self.service.get_track_credits(track_id, **track_info.credits_extra_kwargs)
+            credits_list = service.get_track_credits(track_id, **track_info.credits_extra_kwargs)
             # if credits_list:
             #     self.print('Credits retrieved')
             # else:
             #     self.print('No credits available')
-        
-        # Do conversions
-        old_track_location, old_container = None, None
-        if codec in conversions:
-            old_codec_data = codec_data[codec]
-            new_codec = conversions[codec]
-            new_codec_data = codec_data[new_codec]
-            self.print(f'Converting to {new_codec_data.pretty_name}')
-                
-            if old_codec_data.spatial or new_codec_data.spatial:
-                self.print('Warning: converting spacial formats is not allowed, skipping')
-            elif not old_codec_data.lossless and new_codec_data.lossless and not self.global_settings['advanced']['enable_undesirable_conversions']:
-                self.print('Warning: Undesirable lossy-to-lossless conversion detected, skipping')
-            elif (not old_codec_data.lossless and not new_codec_data.lossless) and not self.global_settings['advanced']['enable_undesirable_conversions']:
-                self.print('Warning: Undesirable lossy-to-lossy conversion detected, skipping')
+        return credits_list
+
+    def _conversion_target(self, codec: CodecEnum, conversions: dict, warn=True) -> Optional[CodecEnum]:
+        """The codec a track gets converted to, None without a conversion for its codec or when the conversion isn't allowed."""
+        if not conversions or codec not in conversions: return None
+        report = self.print if warn else lambda *args, **kwargs: None
+        old_codec_data = codec_data[codec]
+        new_codec = conversions[codec]
+        new_codec_data = codec_data[new_codec]
+        report(f'Converting to {new_codec_data.pretty_name}')
+
+        if old_codec_data.spatial or new_codec_data.spatial:
+            report('Warning: converting spacial formats is not allowed, skipping')
+            return None
+        elif not old_codec_data.lossless and new_codec_data.lossless and not self.global_settings['advanced']['enable_undesirable_conversions']:
+            report('Warning: Undesirable lossy-to-lossless conversion detected, skipping')
+            return None
+        elif (not old_codec_data.lossless and not new_codec_data.lossless) and not self.global_settings['advanced']['enable_undesirable_conversions']:
+            report('Warning: Undesirable lossy-to-lossy conversion detected, skipping')
+            return None
+
+        if not old_codec_data.lossless and new_codec_data.lossless:
+            report('Warning: Undesirable lossy-to-lossless conversion')
+        elif not old_codec_data.lossless and not new_codec_data.lossless:
+            report('Warning: Undesirable lossy-to-lossy conversion')
+        return new_codec
+
+    def _conversion_flags(self, codec: CodecEnum) -> dict:
+        try:
+            conversion_flags = {CodecEnum[k.upper()]:v for k,v in self.global_settings['advanced']['conversion_flags'].items()}
+        except:
+            conversion_flags = {}
+            self.print('Warning: conversion_flags setting is invalid, using defaults')
+        return conversion_flags[codec] if codec in conversion_flags else {}
+
+    def _encoder(self, codec: CodecEnum) -> str:
+        return self.conversion_encoders.get(codec, codec.name.lower())
+
+    def _conversion_outputs(self, context: TrackContext, codec: CodecEnum, warn=True) -> list[ConversionOutput]:
+        """The files converted from a track in codec: one per output profile, or the codec_conversions target."""
+        if context.output_profiles:
+            outputs = []
+            for profile, location_name in context.output_profiles:
+                # Profiles asking for a conversion that isn't allowed get the track in its own codec
+                target = profile.codec if profile.codec == codec else self._conversion_target(codec, {codec: profile.codec}, warn) or codec
+                flags = {**self._conversion_flags(target), **profile.flags}
+                outputs.append(ConversionOutput(f'{location_name}.{codec_data[target].container.name}', target, flags, copy=target == codec and not profile.flags))
+            return outputs
+
+        new_codec = self._conversion_target(codec, context.conversions, warn)
+        if not new_codec: return []
+        return [ConversionOutput(f'{context.track_location_name}.{codec_data[new_codec].container.name}', new_codec, self._conversion_flags(new_codec))]
+
+    def _encode(self, source: str, outputs: list[ConversionOutput], feed=None) -> Optional[float]:
+        """
+        Writes every output from a single ffmpeg run, so the source is decoded once however many outputs there are.
+        Returns ffmpeg's CPU time and raises ffmpeg.Error when it fails.
+        """
+        stream: ffmpeg = ffmpeg.input(source, hide_banner=None, y=None)
+        covers = {output.cover: ffmpeg.input(output.cover) for output in outputs if output.cover}
+        streams = []
+        for output in outputs:
+            options = {'acodec': 'copy'} if output.copy else {'acodec': self._encoder(output.codec), **output.flags}
+            if output.metadata:
+                # bitexact keeps ffmpeg from adding encoder tags that tag_file would remove again
+                options.update({f'metadata:g:{index}': f'{key}={value}' for index, (key, value) in enumerate(output.metadata.items())})
+                options.update({'fflags': '+bitexact', 'flags:a': '+bitexact'})
+                if output.container is ContainerEnum.mp3: options.update({'id3v2_version': 3, 'write_id3v1': 1})
+            if output.cover:
+                # The picture type and description tag_file gives the cover, ffmpeg writes "Other" and none otherwise
+                streams.append(ffmpeg.output(stream['a'], covers[output.cover]['v'], output.location, **options,
+                                             **{'c:v': 'copy', 'disposition:v': 'attached_pic', 'metadata:s:v': 'comment=Cover (front)',
+                                                'metadata:s:v:0': 'title=Cover'}, loglevel='error'))
             else:
-                if not old_codec_data.lossless and new_codec_data.lossless:
-                    self.print('Warning: Undesirable lossy-to-lossless conversion')
-                elif not old_codec_data.lossless and not new_codec_data.lossless:
-                    self.print('Warning: Undesirable lossy-to-lossy conversion')
-
-                try:
-                    conversion_flags = {CodecEnum[k.upper()]:v for k,v in self.global_settings['advanced']['conversion_flags'].items()}
-                except:
-                    conversion_flags = {}
-                    self.print('Warning: conversion_flags setting is invalid, using defaults')
-                
-                conv_flags = conversion_flags[new_codec] if new_codec in conversion_flags else {}
-                temp_track_location = f'{create_temp_filename()}.{new_codec_data.container.name}'
-                new_track_location = f'{track_location_name}.{new_codec_data.container.name}'
-                
-                stream: ffmpeg = ffmpeg.input(track_location, hide_banner=None, y=None)
-                # capture_stderr is required for the error output to be captured
-                try:
-                    # capture_stderr is required for the error output to be captured
-                    stream.output(
-                        temp_track_location,
-                        acodec=new_codec.name.lower(),
-                        **conv_flags,
-                        loglevel='error'
-                    ).run(capture_stdout=True, capture_stderr=True)
-                except Error as e:
-                    error_msg = e.stderr.decode('utf-8')
-                    # get the error message from ffmpeg and search foe the non-experimental encoder
-                    encoder = re.search(r"(?<=non experimental encoder ')[^']+", error_msg)
-                    if encoder:
-                        self.print(f'Encoder {new_codec.name.lower()} is experimental, trying {encoder.group(0)}')
-                        # try to use the non-experimental encoder
-                        stream.output(
-                            temp_track_location,
-                            acodec=encoder.group(0),
-                            **conv_flags,
-                            loglevel='error'
-                        ).run()
-                    else:
-                        # raise any other occurring error
-                        raise Exception(f'ffmpeg error converting to {new_codec.name.lower()}:\n{error_msg}')
-
-                # remove file if it requires an overwrite, maybe os.replace would work too?
-                if track_location == new_track_location:
-                    silentremove(track_location)
-                    # just needed so it won't get deleted
-                    track_location = temp_track_location
-
-                # move temp_file to new_track_location and delete temp file
-                shutil.move(temp_track_location, new_track_location)
-                silentremove(temp_track_location)
+                streams.append(stream.output(output.location, **options, loglevel='error'))
+        try:
+            # the error output is captured to look for the non-experimental encoder
+            return run_ffmpeg(ffmpeg.merge_outputs(*streams) if len(streams) > 1 else streams[0], feed)
+        except Error as e:
+            error_msg = e.stderr.decode('utf-8')
+            # get the error message from ffmpeg and search for the non-experimental encoder
+            fallback = re.search(r"(?<=non experimental encoder ')[^']+", error_msg)
+            experimental = re.search(r"encoder '([^']+)' is experimental", error_msg)
+            codec = next((output.codec for output in outputs if not output.copy and (not experimental or self._encoder(output.codec) == experimental.group(1))), None)
+            if not fallback or not codec or fallback.group(0) == self._encoder(codec): raise
+            self.print(f'Encoder {self._encoder(codec)} is experimental, trying {fallback.group(0)}')
+            # remembered, so later tracks don't run into the experimental encoder first
+            self.conversion_encoders[codec] = fallback.group(0)
+            # a fed input was used up by the failed attempt
+            if feed: raise
+            return self._encode(source, outputs)
+
+    def _embedded_tags(self, context: TrackContext, container: ContainerEnum):
+        # The tags and cover ffmpeg can write itself, so tagging doesn't rewrite the file. A streamed
+        # conversion runs before the lyrics, credits and cover are fetched, those are left to tagging
+        cover = context.cover_temp_location if self.global_settings['covers']['embed_cover'] else None
+        if not cover or container not in FFMPEG_COVER_CONTAINERS or os.path.getsize(cover) >= 16 * 1024 ** 2:
+            cover = None
+        return ffmpeg_metadata(context.track_info, context.credits_list, context.embedded_lyrics, container), cover
+
+    def _write_outputs(self, context: TrackContext, source: str, outputs: list[ConversionOutput], feed=None):
+        # ffmpeg writes to temporary files, which replace the outputs once all of them are done
+        temp_outputs = [ConversionOutput(f'{create_temp_filename()}.{output.container.name}', output.codec, output.flags, output.copy,
+                                         *self._embedded_tags(context, output.container)) for output in outputs]
+        try:
+            cpu_time = self._encode(source, temp_outputs, feed)
+        except BaseException:
+            for output in temp_outputs: silentremove(output.location)
+            raise
+        if cpu_time is not None: context.stage_metrics['cpu_time'] = f'{cpu_time:.3f}'
+
+        for output, temp_output in zip(outputs, temp_outputs):
+            # remove file if it requires an overwrite, maybe os.replace would work too?
+            if output.location == source: silentremove(source)
+            shutil.move(temp_output.location, output.location)
+
+        context.container, context.audio_location = outputs[0].container, outputs[0].location
+        context.extra_outputs = [(output.location, output.container) for output in outputs[1:]]
+        context.converted = True
+
+    def _stream_conversion(self, context: TrackContext, download_info: TrackDownloadInfo) -> bool:
+        """
+        Feeds the download straight into ffmpeg, so only the converted files are written.
+        Returns False when ffmpeg can't convert the stream, like an MP4 with its index
+        at the end, and the track has to be downloaded first.
+        """
+        feed = partial(stream_file, download_info.file_url, headers=download_info.file_url_headers,
+                       enable_progress_bar=context.show_progress, indent_level=self.oprinter.indent_number)
+        try:
+            self._write_outputs(context, 'pipe:', self._conversion_outputs(context, context.codec), feed)
+        except Error as e:
+            error_msg = e.stderr.decode('utf-8').strip()
+            self.print('Streaming conversion failed, downloading the track first' + (f': {error_msg}' if error_msg else ''))
+            return False
+        return True
+
+    def _streams_conversion(self, context: TrackContext, download_info: TrackDownloadInfo) -> bool:
+        # The original never touches the disk, so it can't be kept, and a module changing the codec would change the conversion
+        return bool(self._performance_setting('streaming_conversion', False)
+                    and download_info.download_type is DownloadEnum.URL and not download_info.different_codec
+                    and not self.global_settings['advanced']['conversion_keep_original']
+                    and self._conversion_outputs(context, context.codec, warn=False))
+
+    def _needs_conversion(self, context: TrackContext) -> bool:
+        return not context.converted and bool(context.output_profiles or context.conversions and context.codec in context.conversions)
+
+    def _convert_track(self, context: TrackContext):
+        codec, container = context.codec, context.container
+        track_location = context.audio_location
 
+        # Do conversions
+        old_track_location, old_container = None, None
+        outputs = self._conversion_outputs(context, codec) if not context.converted else []
+        if outputs:
+            try:
+                self._write_outputs(context, track_location, outputs)
+            except Error as e:
+                # raise any other occurring error
+                encoders = ', '.join(dict.fromkeys('copy' if output.copy else self._encoder(output.codec) for output in outputs))
+                raise Exception(f'ffmpeg error converting to {encoders}:\n{e.stderr.decode("utf-8")}')
+
+            # unless one of the outputs replaced it
+            if track_location not in [output.location for output in outputs]:
                 if self.global_settings['advanced']['conversion_keep_original']:
                     old_track_location = track_location
                     old_container = container
                 else:
                     silentremove(track_location)
 
-                container = new_codec_data.container    
-                track_location = new_track_location
+        context.old_track_location, context.old_container = old_track_location, old_container
 
-        # Add the playlist track to the m3u playlist
-        if m3u_playlist:
-            self._add_track_m3u_playlist(m3u_playlist, track_info, track_location)
+    def _tag_padding(self, container: ContainerEnum) -> Optional[int]:
+        # Bytes kept free after the tags, so later tag changes don't rewrite the audio
+        padding_kb = self._performance_setting('tag_padding_kb', {}).get(container.name)
+        return int(float(padding_kb) * 1024) if padding_kb is not None else None
 
+    def _tag_track(self, context: TrackContext):
         # Finally tag file
+        cover_location = context.cover_temp_location if self.global_settings['covers']['embed_cover'] else None
         self.print('Tagging file')
+        files = [(context.audio_location, context.container), *context.extra_outputs]
+        if context.old_track_location: files.append((context.old_track_location, context.old_container))
         try:
-            tag_file(track_location, cover_temp_location if self.global_settings['covers']['embed_cover'] else None,
-                     track_info, credits_list, embedded_lyrics, container)
-            if old_track_location:
-                tag_file(old_track_location, cover_temp_location if self.global_settings['covers']['embed_cover'] else None,
-                         track_info, credits_list, embedded_lyrics, old_container)
+            for location, container in files:
+                tag_file(location, cover_location, context.track_info, context.credits_list, context.embedded_lyrics, container,
+                         padding=self._tag_padding(container))
         except TagSavingFailure:
             self.print('Tagging failed, tags saved to text file')
-        if delete_cover:
-            silentremove(cover_temp_location)
-        
-        self.print(f'=== Track {track_id} downloaded ===', drop_level=1)
+            # Reported with the tag stage and in the job's result
+            context.stage_metrics['error'] = TagSavingFailure.__name__
+            with self._tag_failures_lock:
+                self.tag_failures.append(str(context.track_id))
+
+    def _finalize_track(self, context: TrackContext):
+        # The track has its final location, so it can be added to the m3u playlist
+        context.track_location = context.audio_location
+        context.status = 'downloaded'
+        self.print(f'=== Track {context.track_id} downloaded ===', drop_level=1)
+
+    def _evaluate_cover_candidates(self, cover_module, results: list, test_cover_options: CoverOptions, cover_matcher: CoverMatcher, rms_threshold):
+        """
+        Fetches and scores the cover candidates on a small pool and yields (rank, result, url, rms) in ranking order.
+        Once a candidate is under the threshold, lower ranked candidates are no longer fetched. Candidates that
+        fail to download or can't be read are left out, like covers that don't match.
+        """
+        cutoff, lock = [len(results)], threading.Lock()
+
+        def evaluate(rank, result: SearchResult):
+            if rank > cutoff[0]: return None
+            try:
+                test_cover_info: CoverInfo = cover_module.get_track_cover(result.result_id, test_cover_options, **result.extra_kwargs)
+                if rank > cutoff[0]: return None
+                test_temp = download_to_temp(test_cover_info.url)
+                try:
+                    rms = cover_matcher.rms(test_temp)
+                finally:
+                    silentremove(test_temp)
+            except Exception as e:
+                logging.debug('Could not test cover candidate %s: %s', result.result_id, e)
+                return None
+            if rms < rms_threshold:
+                with lock: cutoff[0] = min(cutoff[0], rank)
+            return test_cover_info.url, rms
+
+        executor = ThreadPoolExecutor(max_workers=max(1, int(self._performance_setting('cover_candidate_workers', 4) or 1)), thread_name_prefix='orpheus-cover')
+        try:
+            futures = [executor.submit(evaluate, rank, result) for rank, result in enumerate(results, start=1)]
+            for rank, (result, future) in enumerate(zip(results, futures), start=1):
+                # Ranks past the cutoff are only skipped after a higher ranked match, which the caller stops at
+                evaluation = future.result()
+                if evaluation: yield (rank, result, *evaluation)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
 
     def _get_artwork_settings(self, module_name = None, is_external = False):
         if not module_name:
@@ -1,7 +1,9 @@
 from .brain import OrpheusBrain, brain
 from .registry import ServiceRegistry, service_registry
 from .sessions import SessionManager, session_manager
-from .events import Event, NetworkEvent, LoginEvent, CLIEvent, EventType
+from .events import Event, NetworkEvent, LoginEvent, CLIEvent, CacheEvent, EventType
+from .metadata_cache import MetadataCache, CachedModule
+from .track_index import TrackIndex
 
 __all__ = [
     "OrpheusBrain",
@@ -14,5 +16,9 @@ __all__ = [
     "NetworkEvent",
     "LoginEvent",
     "CLIEvent",
+    "CacheEvent",
     "EventType",
+    "TrackIndex",
+    "MetadataCache",
+    "CachedModule",
 ]
@@ -9,6 +9,7 @@ class EventType(Enum):
     LOGIN = auto()
     CLI = auto()
     DELIVERY = auto()
+    CACHE = auto()
 
 
 @dataclass
@@ -58,3 +59,21 @@ class CLIEvent(Event):
         super().__init__(type=EventType.CLI, metadata=metadata)
         self.command = kwargs.get("command")
         self.context = kwargs.get("context")
+
+
+@dataclass
+class CacheEvent(Event):
+    cache: Optional[str] = None
+    service: Optional[str] = None
+    hits: int = 0
+    misses: int = 0
+    hit_rate: float = 0.0
+
+    def __init__(self, **kwargs):
+        metadata = kwargs.pop("metadata", {})
+        super().__init__(type=EventType.CACHE, metadata=metadata)
+        self.cache = kwargs.get("cache")
+        self.service = kwargs.get("service")
+        self.hits = kwargs.get("hits", 0)
+        self.misses = kwargs.get("misses", 0)
+        self.hit_rate = kwargs.get("hit_rate", 0.0)
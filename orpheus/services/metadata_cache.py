@@ -0,0 +1,255 @@
+import hashlib
+import os
+import pickle
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from typing import Callable, Dict
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+from .brain import brain
+from .events import CacheEvent
+
+_MISS = object()
+
+
+class MetadataCache:
+    """
+    Disk cache for module metadata calls (get_track_info, get_album_info,
+    get_playlist_info, get_artist_info), so retrying a batch doesn't ask the
+    service again for metadata fetched minutes earlier.
+
+    Every entry is one zlib-compressed pickle in `directory`, replaced
+    atomically, so readers never need the lock. Writers and eviction hold an
+    exclusive lock on `directory/.lock`, which makes the cache safe to share
+    between several Orpheus processes. Once the directory grows past
+    `max_bytes` the least recently used entries are removed.
+    """
+
+    METHODS = {
+        'get_track_info': 'track',
+        'get_album_info': 'album',
+        'get_playlist_info': 'playlist',
+        'get_artist_info': 'artist',
+    }
+
+    def __init__(self, directory: str, ttls: Dict[str, float] = None, max_bytes: int = 256 * 1024 * 1024):
+        self.directory = directory
+        # Seconds per metadata kind, kinds without a TTL aren't cached
+        self.ttls = dict(ttls or {})
+        self.max_bytes = max_bytes
+        self._thread_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats: Dict[tuple, int] = {}
+        os.makedirs(directory, exist_ok=True)
+        self._size = self._directory_size()
+
+    @staticmethod
+    def key(service: str, method: str, args: tuple, kwargs: dict) -> str:
+        # Covers the id, quality tier and codec options as well as any module specific extra_kwargs
+        call = repr((service, method, args, sorted(kwargs.items())))
+        return hashlib.sha256(call.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def _entries(self):
+        # (path, size, mtime) of every entry, skipping the lock file and ones removed meanwhile
+        entries = []
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if entry.name.startswith('.') or not entry.is_file():
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _directory_size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    @contextmanager
+    def _locked(self):
+        with self._thread_lock, open(os.path.join(self.directory, '.lock'), 'a+b') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+                else:
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def _count(self, service: str, stat: str):
+        with self._stats_lock:
+            self._stats[(service, stat)] = self._stats.get((service, stat), 0) + 1
+
+    def _load(self, key: str, ttl: float):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                stored, value = pickle.loads(zlib.decompress(f.read()))
+        except FileNotFoundError:
+            return _MISS
+        except Exception:
+            # Corrupt or written by an incompatible version
+            self._remove(path)
+            return _MISS
+        if time.time() - stored > ttl:
+            return _MISS
+        try:
+            # The file's mtime tracks last use for eviction, the TTL uses the stored time
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def _store(self, key: str, value):
+        try:
+            data = zlib.compress(pickle.dumps((time.time(), value), protocol=pickle.HIGHEST_PROTOCOL))
+        except Exception:
+            # Modules may return objects that can't be pickled, those are just not cached
+            return
+        path = self._path(key)
+        temporary_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with self._locked():
+            try:
+                with open(temporary_path, 'wb') as f:
+                    f.write(data)
+                os.replace(temporary_path, path)
+            except OSError:
+                self._remove(temporary_path)
+                return
+            self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        # Caller holds the lock. Other processes write too, so the size is recounted from disk
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        size = sum(entry_size for _, entry_size, _ in entries)
+        target = self.max_bytes * 0.9
+        for path, entry_size, _ in entries:
+            if size <= target:
+                break
+            size -= entry_size
+            self._remove(path)
+        self._size = size
+
+    def call(self, service: str, method: str, function: Callable, *args, **kwargs):
+        """Returns the cached result of function(*args, **kwargs), calling it on a miss or once the entry expired."""
+        ttl = self.ttls.get(self.METHODS.get(method))
+        if not ttl:
+            return function(*args, **kwargs)
+
+        key = self.key(service, method, args, kwargs)
+        cached = self._load(key, ttl)
+        if cached is not _MISS:
+            self._count(service, 'hits')
+            return cached
+
+        self._count(service, 'misses')
+        value = function(*args, **kwargs)
+        self._store(key, value)
+        return value
+
+    def call_batch(self, service: str, function: Callable, track_ids: list, *args, **kwargs) -> dict:
+        """
+        get_tracks_info through the entries of get_track_info: cached tracks are served from the cache, the rest are
+        fetched with one call of function and stored one by one, so later single lookups find them too.
+        """
+        ttl = self.ttls.get(self.METHODS['get_track_info'])
+        if not ttl:
+            return function(track_ids, *args, **kwargs)
+
+        keys = {track_id: self.key(service, 'get_track_info', (track_id, *args), kwargs) for track_id in track_ids}
+        results, missing = {}, []
+        for track_id, key in keys.items():
+            cached = self._load(key, ttl)
+            if cached is _MISS:
+                missing.append(track_id)
+            else:
+                self._count(service, 'hits')
+                results[str(track_id)] = cached
+
+        if missing:
+            for _ in missing: self._count(service, 'misses')
+            fetched = {str(track_id): track_info for track_id, track_info in function(missing, *args, **kwargs).items()}
+            for track_id in missing:
+                if str(track_id) in fetched:
+                    self._store(keys[track_id], fetched[str(track_id)])
+            results.update(fetched)
+        return results
+
+    def wrap(self, service: str, module):
+        return CachedModule(module, service, self)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        with self._stats_lock:
+            stats: Dict[str, Dict[str, int]] = {}
+            for (service, stat), count in self._stats.items():
+                stats.setdefault(service, {'hits': 0, 'misses': 0})[stat] = count
+            return stats
+
+    def report(self):
+        """Sends the hit rates of this run to the brain, one event per service."""
+        for service, stats in self.stats().items():
+            lookups = stats['hits'] + stats['misses']
+            hit_rate = stats['hits'] / lookups if lookups else 0.0
+            brain.record_event(CacheEvent(
+                cache='metadata',
+                service=service,
+                hits=stats['hits'],
+                misses=stats['misses'],
+                hit_rate=hit_rate,
+                metadata={'cache': 'metadata', 'service': service, 'hits': str(stats['hits']),
+                          'misses': str(stats['misses']), 'hit_rate': f'{hit_rate:.2f}'},
+            ))
+
+
+class CachedModule:
+    """Proxy for a loaded module that serves its metadata calls from a MetadataCache."""
+
+    def __init__(self, module, service: str, cache: MetadataCache):
+        self._module = module
+        self._service = service
+        self._cache = cache
+
+    def __getattr__(self, name):
+        attribute = getattr(self._module, name)
+        if name == 'get_tracks_info':
+            # Imported here, the module contract imports the models, which import utils and with it this package
+            from orpheus.modules.base import supports_batch_track_info
+            if not supports_batch_track_info(self._module):
+                return attribute
+
+            def cached_batch(track_ids, *args, **kwargs):
+                return self._cache.call_batch(self._service, attribute, track_ids, *args, **kwargs)
+            return cached_batch
+        if name not in MetadataCache.METHODS or not callable(attribute):
+            return attribute
+
+        def cached(*args, **kwargs):
+            return self._cache.call(self._service, name, attribute, *args, **kwargs)
+        return cached
+
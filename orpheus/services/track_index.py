@@ -0,0 +1,98 @@
+import json
+import sqlite3
+import threading
+import time
+from typing import Optional, Tuple, Union
+
+
+class TrackIndex:
+    """
+    Persistent map of (source service, track id, ISRC) to the matching result on
+    another service, so playlist re-syncs and third-party lyrics, credits and
+    cover lookups don't repeat the same remote search on every run. Searches
+    that found nothing are remembered too, for a shorter time. purpose keeps
+    lookups that pick their result differently apart: a cover match is the
+    candidate whose artwork matched, not necessarily the top search result.
+    """
+
+    MISS = object()
+
+    def __init__(self, location: str, ttl: float = 30 * 86400, negative_ttl: float = 86400):
+        self.location = location
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(location, timeout=30, check_same_thread=False)
+        with self._lock, self._connection:
+            # WAL lets several Orpheus processes read while one writes
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            columns = {row[1]: row[2] for row in self._connection.execute('PRAGMA table_info(track_map)')}
+            if columns and ('purpose' not in columns or columns['result_id']):
+                # Indexes from before purpose mixed cover matches with search matches, and turned every result id into
+                # text. They are rebuilt as tracks come up
+                self._connection.execute('DROP TABLE track_map')
+            self._connection.execute('''
+                CREATE TABLE IF NOT EXISTS track_map (
+                    source_service TEXT NOT NULL,
+                    source_id TEXT NOT NULL,
+                    isrc TEXT NOT NULL,
+                    target_service TEXT NOT NULL,
+                    purpose TEXT NOT NULL,
+                    result_id,  -- No type, so ids come back as the int or str the module gave
+                    extra_kwargs TEXT,
+                    updated REAL NOT NULL,
+                    PRIMARY KEY (source_service, source_id, isrc, target_service, purpose)
+                )
+            ''')
+
+    def lookup(self, source_service: str, source_id, isrc: Optional[str], target_service: str,
+               purpose: str = 'match') -> Union[object, None, Tuple[Union[int, str], dict]]:
+        """
+        Returns (result_id, extra_kwargs) for a known match, None if the track is known
+        not to exist on the target service, or TrackIndex.MISS if it has to be searched.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT result_id, extra_kwargs, updated FROM track_map WHERE source_service = ? AND source_id = ? AND isrc = ? AND target_service = ? AND purpose = ?',
+                (source_service, str(source_id), isrc or '', target_service, purpose)
+            ).fetchone()
+        if not row:
+            return self.MISS
+        result_id, extra_kwargs, updated = row
+        if time.time() - updated > (self.ttl if result_id is not None else self.negative_ttl):
+            return self.MISS
+        return (result_id, json.loads(extra_kwargs) if extra_kwargs else {}) if result_id is not None else None
+
+    def store(self, source_service: str, source_id, isrc: Optional[str], target_service: str, result_id=None, extra_kwargs: dict = None,
+              purpose: str = 'match'):
+        """Remembers a match, or with result_id None that the search found nothing."""
+        try:
+            serialised_kwargs = json.dumps(extra_kwargs) if extra_kwargs else None
+        except (TypeError, ValueError):
+            # Modules may pass objects in extra_kwargs that can't be persisted, search again next time
+            return
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO track_map VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (source_service, str(source_id), isrc or '', target_service, purpose, None if result_id is None else result_id if isinstance(result_id, (int, str)) else str(result_id), serialised_kwargs, time.time())
+            )
+
+    def forget(self, source_service: str, source_id, isrc: Optional[str], target_service: str, purpose: str = 'match'):
+        with self._lock, self._connection:
+            self._connection.execute(
+                'DELETE FROM track_map WHERE source_service = ? AND source_id = ? AND isrc = ? AND target_service = ? AND purpose = ?',
+                (source_service, str(source_id), isrc or '', target_service, purpose)
+            )
+
+    def prune(self):
+        """Drops expired entries."""
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                'DELETE FROM track_map WHERE updated < ? OR (result_id IS NULL AND updated < ?)',
+                (now - self.ttl, now - self.negative_ttl)
+            )
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
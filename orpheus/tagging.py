@@ -1,26 +1,131 @@
 import base64
+import copy
+import io
 import logging
 from dataclasses import asdict
 
 from PIL import Image
+from mutagen import PaddingInfo
 from mutagen.easyid3 import EasyID3
 from mutagen.easymp4 import EasyMP4
 from mutagen.flac import FLAC, Picture
-from mutagen.id3 import PictureType, APIC, USLT, TDAT, COMM, TPUB
+from mutagen.id3 import ID3, ID3NoHeaderError, Encoding, PictureType, APIC, USLT, TDAT, TDRC, COMM, TPUB
 from mutagen.mp3 import EasyMP3
-from mutagen.mp4 import MP4Cover
+from mutagen.mp4 import MP4, MP4Cover
 from mutagen.mp4 import MP4Tags
 from mutagen.oggopus import OggOpus
 from mutagen.oggvorbis import OggVorbis
 
+from utils.cover_cache import cover_cache
 from utils.exceptions import *
-from utils.models import ContainerEnum, TrackInfo
+from utils.models import CodecEnum, ContainerEnum, CreditsInfo, Tags, TrackInfo
 
 # Needed for Windows tagging support
 MP4Tags._padding = 0
 
+# Containers whose ffmpeg muxer embeds a cover passed as an attached picture
+FFMPEG_COVER_CONTAINERS = {ContainerEnum.flac, ContainerEnum.mp3}
+# Names ffmpeg's ID3 muxer maps to standard frames instead of TXXX frames
+_FFMPEG_ID3_NAMES = {'album', 'album_artist', 'album-sort', 'artist', 'artist-sort', 'comment', 'composer', 'copyright', 'date',
+                     'disc', 'encoded_by', 'encoder', 'genre', 'language', 'lyrics', 'performer', 'publisher', 'title', 'title-sort', 'track'}
+VORBIS_CONTAINERS = {ContainerEnum.flac, ContainerEnum.ogg, ContainerEnum.opus}
+# Containers tag_file can tag, by file extension
+TAGGED_EXTENSIONS = {'flac': ContainerEnum.flac, 'opus': ContainerEnum.opus, 'ogg': ContainerEnum.ogg,
+                     'm4a': ContainerEnum.m4a, 'mp3': ContainerEnum.mp3}
 
-def tag_file(file_path: str, image_path: str, track_info: TrackInfo, credits_list: list, embedded_lyrics: str, container: ContainerEnum):
+
+def ffmpeg_metadata(track_info: TrackInfo, credits_list: list, embedded_lyrics: str, container: ContainerEnum) -> dict:
+    """
+    The tags tag_file writes that ffmpeg can write while converting, under the names its muxer
+    for container maps to the same fields. A converted file then usually comes out of ffmpeg
+    with its tags, and tag_file finds nothing left to change.
+    """
+    tags = track_info.tags
+    metadata = {'title': track_info.name, 'album': track_info.album, 'artist': ', '.join(track_info.artists)}
+    date = tags.release_date or (str(track_info.release_year) if track_info.release_year else None)
+
+    if container in VORBIS_CONTAINERS:
+        # Vorbis comments keep the names they are given, the ones tag_file uses
+        metadata.update({
+            'albumartist': tags.album_artist,
+            'tracknumber': tags.track_number,
+            'discnumber': tags.disc_number,
+            'totaltracks': tags.total_tracks,
+            'totaldiscs': tags.total_discs,
+            'date': date,
+            'copyright': tags.copyright,
+            'Rating': None if track_info.explicit is None else 'Explicit' if track_info.explicit else 'Clean',
+            'genre': ', '.join(tags.genres or []),
+            'isrc': tags.isrc,
+            'UPC': tags.upc,
+            'lyrics': embedded_lyrics,
+        })
+        if container != ContainerEnum.opus: metadata['Label'] = tags.label
+        if container != ContainerEnum.opus: metadata.update(tags.extra_tags)
+        for credit in credits_list or []:
+            metadata[credit.type] = ', '.join(credit.names)
+        if tags.replay_gain and tags.replay_peak:
+            metadata.update({'REPLAYGAIN_TRACK_GAIN': tags.replay_gain, 'REPLAYGAIN_TRACK_PEAK': tags.replay_peak})
+    else:
+        track = f'{tags.track_number}/{tags.total_tracks}' if tags.track_number and tags.total_tracks else tags.track_number
+        disc = f'{tags.disc_number}/{tags.total_discs}' if tags.disc_number and tags.total_discs else tags.disc_number
+        metadata.update({'album_artist': tags.album_artist, 'track': track, 'disc': disc, 'genre': ', '.join(tags.genres or []),
+                         'copyright': tags.copyright})
+        if container == ContainerEnum.mp3:
+            # ID3v2.3 gets the date split into year and day, like tag_file does. Other names become TXXX frames
+            metadata.update({'date': date, 'publisher': tags.label, 'TSRC': tags.isrc, 'BARCODE': tags.upc,
+                             'Rating': None if track_info.explicit is None else 'Explicit' if track_info.explicit else 'Clean'})
+            for credit in credits_list or []:
+                # ffmpeg writes these names to standard frames, and a TXXX frame only holds several names apart
+                if credit.type.lower() not in _FFMPEG_ID3_NAMES and len(credit.names) == 1:
+                    metadata[credit.type] = credit.names[0]
+        elif container == ContainerEnum.m4a:
+            metadata.update({'date': date, 'comment': tags.comment, 'description': tags.description, 'lyrics': embedded_lyrics})
+
+    return {key: str(value) for key, value in metadata.items() if value is not None and value != ''}
+
+
+def _tag_state(tagger, container: ContainerEnum):
+    # Compared before and after tag_file sets the tags, to skip saving a file that already has them
+    if tagger.tags is None:
+        return None
+    if container == ContainerEnum.mp3:
+        # Frames tag_file sets under a plain frame id replace the ones read under their hash key. The text encoding
+        # is left out, ffmpeg writes Latin-1 where it can and mutagen converts UTF-8 to UTF-16 for ID3v2.3 anyway
+        frames = {getattr(frame, 'HashKey', key): frame for key, frame in tagger.tags._EasyID3__id3._DictProxy__dict.items()}
+        year = str(frames['TDRC'].text[0]) if 'TDRC' in frames and frames['TDRC'].text else ''
+        if 'TDAT' in frames and len(year) == 4 and len(str(frames['TDAT'])) == 4:
+            # Saved as ID3v2.3 these are TYER and TDAT, which mutagen reads back as a single TDRC
+            day_month = str(frames.pop('TDAT'))
+            frames['TDRC'] = TDRC(encoding=Encoding.UTF8, text=f'{year}-{day_month[2:]}-{day_month[:2]}')
+        return sorted((key, _without_encoding(frame)) for key, frame in frames.items())
+    if container == ContainerEnum.m4a:
+        return sorted((key, repr(value)) for key, value in tagger.tags._EasyMP4Tags__mp4.items())
+    state = sorted((key.lower(), value) for key, value in tagger.tags)
+    if container == ContainerEnum.flac:
+        state += sorted((picture.type, picture.mime, picture.data) for picture in tagger.pictures)
+    return state
+
+
+def _without_encoding(frame) -> str:
+    if not hasattr(frame, 'encoding'):
+        return repr(frame)
+    frame = copy.copy(frame)
+    frame.encoding = Encoding.UTF8
+    return repr(frame)
+
+
+def _reserve_padding(reserve: int):
+    def padding(info: PaddingInfo) -> int:
+        # Tags that still fit keep the padding they have, so only the metadata is written. When
+        # the file has to be rewritten anyway, it gets room for later changes like lyrics or a new cover
+        return info.padding if info.padding >= 0 else reserve
+    return padding
+
+
+def tag_file(file_path: str, image_path: str, track_info: TrackInfo, credits_list: list, embedded_lyrics: str, container: ContainerEnum,
+             padding: int = None):
+    """Tags the file, with padding bytes reserved for later tag changes whenever the file has to be rewritten."""
     if container == ContainerEnum.flac:
         tagger = FLAC(file_path)
     elif container == ContainerEnum.opus:
@@ -53,6 +158,7 @@ def tag_file(file_path: str, image_path: str, track_info: TrackInfo, credits_lis
         tagger.RegisterTextKey('lyrics', '\xa9lyr') if embedded_lyrics else None
     else:
         raise Exception('Unknown container for tagging')
+    initial_state = _tag_state(tagger, container)
 
     # Remove all useless MPEG-DASH ffmpeg tags
     if tagger.tags is not None:
@@ -97,7 +203,7 @@ def tag_file(file_path: str, image_path: str, track_info: TrackInfo, credits_lis
             tagger['date'] = str(track_info.release_year)
         else:
             tagger['date'] = track_info.tags.release_date
-    else:
+    elif track_info.release_year:
         tagger['date'] = str(track_info.release_year)
 
     if track_info.tags.copyright:tagger['copyright'] = track_info.tags.copyright
@@ -192,8 +298,7 @@ def tag_file(file_path: str, image_path: str, track_info: TrackInfo, credits_lis
 
     # only embed the cover when embed_cover is set to True
     if image_path:
-        with open(image_path, 'rb') as c:
-            data = c.read()
+        data = cover_cache.read(image_path)
         picture = Picture()
         picture.data = data
 
@@ -202,7 +307,9 @@ def tag_file(file_path: str, image_path: str, track_info: TrackInfo, credits_lis
             if container == ContainerEnum.flac:
                 picture.type = PictureType.COVER_FRONT
                 picture.mime = u'image/jpeg'
-                tagger.add_picture(picture)
+                # ffmpeg may have embedded the same cover already
+                if not any(existing.type == PictureType.COVER_FRONT and existing.data == data for existing in tagger.pictures):
+                    tagger.add_picture(picture)
             elif container == ContainerEnum.m4a:
                 tagger['covr'] = [MP4Cover(data, imageformat=MP4Cover.FORMAT_JPEG)]
             elif container == ContainerEnum.mp3:
@@ -216,7 +323,7 @@ def tag_file(file_path: str, image_path: str, track_info: TrackInfo, credits_lis
                 )
             # If you want to have a cover in only a few applications, then this technically works for Opus
             elif container in {ContainerEnum.ogg, ContainerEnum.opus}:
-                im = Image.open(image_path)
+                im = Image.open(io.BytesIO(data))
                 width, height = im.size
                 picture.type = 17
                 picture.desc = u'Cover Art'
@@ -230,8 +337,13 @@ def tag_file(file_path: str, image_path: str, track_info: TrackInfo, credits_lis
             print(f'\tCover file size is too large, only {(picture._MAX_SIZE / 1024 ** 2):.2f}MB are allowed. Track '
                   f'will not have cover saved.')
 
+    # Nothing changed, like for a file ffmpeg already wrote with these tags, so it isn't rewritten
+    if initial_state is not None and _tag_state(tagger, container) == initial_state:
+        return
+
     try:
-        tagger.save(file_path, v1=2, v2_version=3, v23_sep=None) if container == ContainerEnum.mp3 else tagger.save()
+        padding_func = _reserve_padding(padding) if padding is not None else None
+        tagger.save(file_path, v1=2, v2_version=3, v23_sep=None, padding=padding_func) if container == ContainerEnum.mp3 else tagger.save(padding=padding_func)
     except:
         logging.debug('Tagging failed.')
         tag_text = '\n'.join((f'{k}: {v}' for k, v in asdict(track_info.tags).items() if v and k != 'credits' and k != 'lyrics'))
@@ -239,3 +351,155 @@ def tag_file(file_path: str, image_path: str, track_info: TrackInfo, credits_lis
         tag_text += '\n\nlyrics:\n    ' + '\n    '.join(embedded_lyrics.split('\n')) if embedded_lyrics else ''
         open(file_path.rsplit('.', 1)[0] + '_tags.txt', 'w', encoding='utf-8').write(tag_text)
         raise TagSavingFailure
+
+
+# Tags read_tags maps back onto TrackInfo, everything else a file carries is read as credits
+_VORBIS_FIELDS = {'title', 'album', 'albumartist', 'artist', 'tracknumber', 'discnumber', 'totaltracks', 'totaldiscs', 'date',
+                  'copyright', 'rating', 'genre', 'isrc', 'upc', 'label', 'lyrics', 'replaygain_track_gain', 'replaygain_track_peak',
+                  'metadata_block_picture', 'encoder', 'major_brand', 'minor_version', 'compatible_brands'}
+_ID3_IGNORED_TXXX = {'compatible_brands', 'major_brand', 'minor_version'}
+_CONTAINER_CODECS = {ContainerEnum.flac: CodecEnum.FLAC, ContainerEnum.opus: CodecEnum.OPUS, ContainerEnum.ogg: CodecEnum.VORBIS,
+                     ContainerEnum.m4a: CodecEnum.AAC, ContainerEnum.mp3: CodecEnum.MP3}
+_MP4_FREEFORM = '----:com.apple.itunes:'
+
+
+def _number_pair(value) -> tuple:
+    # '3/12' or '3' as written for track and disc numbers
+    number, _, total = str(value).partition('/')
+    return int(number) if number.strip().isdigit() else None, int(total) if total.strip().isdigit() else None
+
+
+def _split_date(date: str) -> tuple:
+    # (release_date, release_year) from a YYYY-MM-DD or YYYY date
+    date = (date or '').strip()
+    release_year = int(date[:4]) if date[:4].isdigit() else None
+    return (date[:10] if len(date) >= 10 else None), release_year
+
+
+def _read_vorbis(tags, track_info: TrackInfo, credits_list: list) -> str:
+    values = {}
+    for key, value in tags:
+        values.setdefault(key.lower(), []).append(value)
+    first = lambda key: values[key][0] if key in values else None
+
+    track_info.name = first('title') or ''
+    track_info.album = first('album') or ''
+    track_info.artists = values.get('artist', [])
+    track_info.tags.album_artist = first('albumartist')
+    track_info.tags.track_number, total_tracks = _number_pair(first('tracknumber')) if 'tracknumber' in values else (None, None)
+    track_info.tags.disc_number, total_discs = _number_pair(first('discnumber')) if 'discnumber' in values else (None, None)
+    track_info.tags.total_tracks = _number_pair(first('totaltracks'))[0] if 'totaltracks' in values else total_tracks
+    track_info.tags.total_discs = _number_pair(first('totaldiscs'))[0] if 'totaldiscs' in values else total_discs
+    track_info.tags.release_date, track_info.release_year = _split_date(first('date'))
+    track_info.tags.copyright = first('copyright')
+    track_info.explicit = {'explicit': True, 'clean': False}.get((first('rating') or '').lower())
+    track_info.tags.genres = values.get('genre')
+    track_info.tags.isrc = first('isrc')
+    track_info.tags.upc = first('upc')
+    track_info.tags.label = first('label')
+    track_info.tags.replay_gain = first('replaygain_track_gain')
+    track_info.tags.replay_peak = first('replaygain_track_peak')
+
+    # Credits and extra tags keep the case they were written with
+    for key in dict.fromkeys(key for key, _ in tags):
+        names = values.pop(key.lower(), None) if key.lower() not in _VORBIS_FIELDS else None
+        if names: credits_list.append(CreditsInfo(key, names))
+    return first('lyrics') or ''
+
+
+def _read_id3(tags: ID3, track_info: TrackInfo, credits_list: list) -> str:
+    text = lambda frame_id: list(tags[frame_id].text) if frame_id in tags else []
+    first = lambda frame_id: str(text(frame_id)[0]) if text(frame_id) else None
+
+    track_info.name = first('TIT2') or ''
+    track_info.album = first('TALB') or ''
+    track_info.artists = [str(artist) for artist in text('TPE1')]
+    track_info.tags.album_artist = first('TPE2')
+    track_info.tags.track_number, track_info.tags.total_tracks = _number_pair(first('TRCK')) if 'TRCK' in tags else (None, None)
+    track_info.tags.disc_number, track_info.tags.total_discs = _number_pair(first('TPOS')) if 'TPOS' in tags else (None, None)
+    track_info.tags.release_date, track_info.release_year = _split_date(first('TDRC'))
+    if not track_info.tags.release_date and track_info.release_year and len(first('TDAT') or '') == 4:
+        # ID3v2.3 keeps the day and month apart from the year, as DDMM
+        day_month = first('TDAT')
+        track_info.tags.release_date = f'{track_info.release_year:04d}-{day_month[2:]}-{day_month[:2]}'
+    track_info.tags.copyright = first('TCOP')
+    track_info.tags.genres = [str(genre) for genre in text('TCON')] or None
+    track_info.tags.isrc = first('TSRC')
+    track_info.tags.label = first('TPUB')
+    comments = tags.getall('COMM')
+    track_info.tags.comment = str(comments[0].text[0]) if comments and comments[0].text else None
+
+    for frame in tags.getall('TXXX'):
+        value = str(frame.text[0]) if frame.text else None
+        if frame.desc == 'Rating':
+            track_info.explicit = {'explicit': True, 'clean': False}.get((value or '').lower())
+        elif frame.desc == 'BARCODE':
+            track_info.tags.upc = value
+        elif frame.desc.upper() == 'REPLAYGAIN_TRACK_GAIN':
+            track_info.tags.replay_gain = value
+        elif frame.desc.upper() == 'REPLAYGAIN_TRACK_PEAK':
+            track_info.tags.replay_peak = value
+        elif frame.desc not in _ID3_IGNORED_TXXX:
+            credits_list.append(CreditsInfo(frame.desc, [str(name) for name in frame.text]))
+
+    lyrics = tags.getall('USLT')
+    return lyrics[0].text if lyrics else ''
+
+
+def _read_mp4(tags, track_info: TrackInfo, credits_list: list) -> str:
+    decode = lambda value: value.decode('utf-8', 'replace') if isinstance(value, bytes) else str(value)
+    first = lambda key: decode(tags[key][0]) if tags.get(key) else None
+
+    track_info.name = first('\xa9nam') or ''
+    track_info.album = first('\xa9alb') or ''
+    track_info.artists = [decode(artist) for artist in tags.get('\xa9ART', [])]
+    track_info.tags.album_artist = first('aART')
+    if tags.get('trkn'): track_info.tags.track_number, track_info.tags.total_tracks = (number or None for number in tags['trkn'][0])
+    if tags.get('disk'): track_info.tags.disc_number, track_info.tags.total_discs = (number or None for number in tags['disk'][0])
+    track_info.tags.release_date, track_info.release_year = _split_date(first('\xa9day'))
+    track_info.tags.copyright = first('cprt')
+    if tags.get('rtng'):
+        rating = tags['rtng'][0]
+        rating = rating[0] if isinstance(rating, bytes) else rating
+        track_info.explicit = {1: True, 2: False}.get(rating)
+    track_info.tags.genres = [decode(genre) for genre in tags.get('\xa9gen', [])] or None
+    track_info.tags.label = first('\xa9pub')
+    track_info.tags.description = first('desc')
+    track_info.tags.comment = first('\xa9cmt')
+
+    for key, values in tags.items():
+        if not key.startswith(_MP4_FREEFORM):
+            continue
+        name = key[len(_MP4_FREEFORM):]
+        if name == 'ISRC':
+            track_info.tags.isrc = decode(values[0])
+        elif name == 'UPC':
+            track_info.tags.upc = decode(values[0])
+        else:
+            credits_list.append(CreditsInfo(name, [decode(value) for value in values]))
+    return first('\xa9lyr') or ''
+
+
+def read_tags(file_path: str, container: ContainerEnum) -> tuple:
+    """
+    Reads the tags tag_file wrote back into (track_info, credits_list, embedded_lyrics), so a file can be
+    tagged again with them. Tags tag_file has no field for come back as credits, which it writes as they were.
+    """
+    track_info = TrackInfo(name='', album='', album_id='', artists=[], tags=Tags(), codec=_CONTAINER_CODECS[container],
+                           cover_url='', release_year=None)
+    credits_list = []
+
+    if container == ContainerEnum.mp3:
+        try:
+            embedded_lyrics = _read_id3(ID3(file_path), track_info, credits_list)
+        except ID3NoHeaderError:
+            embedded_lyrics = ''
+    else:
+        tagger = {ContainerEnum.flac: FLAC, ContainerEnum.opus: OggOpus, ContainerEnum.ogg: OggVorbis, ContainerEnum.m4a: MP4}[container](file_path)
+        if tagger.tags is None:
+            embedded_lyrics = ''
+        elif container == ContainerEnum.m4a:
+            embedded_lyrics = _read_mp4(tagger.tags, track_info, credits_list)
+        else:
+            embedded_lyrics = _read_vorbis(tagger.tags, track_info, credits_list)
+    return track_info, credits_list, embedded_lyrics
@@ -1,23 +1,52 @@
+import io
+import itertools
 import os
+import shutil
 import tempfile
+import threading
+import time
 import unittest
 from types import SimpleNamespace
 from unittest.mock import patch
 
-from orpheus.core import Orpheus
+import ffmpeg
+from mutagen.flac import FLAC, Picture
+from PIL import Image
+
+from orpheus.core import Orpheus, orpheus_core_download
 from utils.models import (
+    AlbumInfo,
+    ArtistInfo,
     CodecEnum,
+    CoverInfo,
+    CreditsInfo,
     DownloadEnum,
     DownloadTypeEnum,
+    ImageFileTypeEnum,
+    LyricsInfo,
+    MediaIdentification,
+    ModuleFlags,
     ModuleInformation,
     ModuleModes,
     Oprinter,
+    PlaylistInfo,
+    SearchResult,
     Tags,
     TrackInfo,
     TrackDownloadInfo,
+    codec_data,
 )
+from orpheus.delivery import ConversionOutput, DownloadPlan, PlannedJob
 from orpheus.music_downloader import Downloader
-from orpheus.tagging import tag_file, ContainerEnum
+from orpheus.services import EventType, TrackIndex, brain
+from utils import cover_similarity
+from utils.cover_cache import CoverCache, cover_cache
+from utils.cover_similarity import CoverMatcher
+from utils.exceptions import TagSavingFailure
+from utils.utils import compare_images
+from orpheus.tagging import FFMPEG_COVER_CONTAINERS, tag_file, ffmpeg_metadata, read_tags, ContainerEnum
+from orpheus.housekeeping import RetagCheckpoint, retag_library
+from orpheus.modules.base import DownloadModule, has_contract_methods, supports_batch_track_info
 
 
 class FakeService:
@@ -41,6 +70,84 @@ class FakeService:
         return []
 
 
+def build_global_settings():
+    return {
+        "general": {"download_quality": "hifi"},
+        "codecs": {"spatial_codecs": False, "proprietary_codecs": False},
+        "formatting": {
+            "force_album_format": False,
+            "single_full_path_format": "{name}",
+            "track_filename_format": "{track_number}. {name}",
+            "album_format": "{name}",
+            "playlist_format": "{name}",
+            "enable_zfill": False,
+        },
+        "covers": {
+            "embed_cover": False,
+            "main_compression": "high",
+            "main_resolution": 1400,
+            "save_external": False,
+            "external_format": "jpg",
+            "external_compression": "low",
+            "external_resolution": 3000,
+            "save_animated_cover": False,
+        },
+        "lyrics": {
+            "embed_lyrics": False,
+            "embed_synced_lyrics": False,
+            "save_synced_lyrics": False,
+        },
+        "playlist": {
+            "save_m3u": False,
+            "paths_m3u": "absolute",
+            "extended_m3u": False,
+        },
+        "module_defaults": {
+            "lyrics": "default",
+            "covers": "default",
+            "credits": "default",
+        },
+        "advanced": {
+            "ignore_different_artists": True,
+            "codec_conversions": {"mp3": "aac"},
+            "conversion_flags": {},
+            "conversion_keep_original": False,
+            "cover_variance_threshold": 8,
+            "debug_mode": False,
+            "disable_subscription_checks": False,
+            "enable_undesirable_conversions": False,
+            "ignore_existing_files": False,
+        },
+    }
+
+
+class FakeModuleTestCase(unittest.TestCase):
+    """Base for tests downloading from a fake "test" module into a temporary directory."""
+
+    def set_up_downloader(self, service, settings, download_mode):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.service = service
+        module_controls = {
+            "module_list": ["test"],
+            "module_settings": {"test": ModuleInformation(service_name="Test Service", module_supported_modes=ModuleModes.download)},
+            "loaded_modules": {"test": service},
+            "module_loader": lambda name: None,
+        }
+        self.downloader = Downloader(settings, module_controls, Oprinter(), self.tempdir.name)
+        self.downloader.download_mode = download_mode
+        self.downloader.third_party_modules = {ModuleModes.covers: None, ModuleModes.lyrics: None, ModuleModes.credits: None}
+        self.downloader.service = service
+        self.downloader.service_name = "test"
+        for patcher in (patch.object(cover_cache, "directory", os.path.join(self.tempdir.name, "covers")),
+                        patch("utils.cover_cache.download_file", DownloaderConversionTests._fake_download_file)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(cover_cache.clear)
+        self.addCleanup(self.downloader.conversion_pool.shutdown)
+        self.addCleanup(self.downloader.tagging_pool.shutdown)
+
+
 class DownloaderConversionTests(unittest.TestCase):
     def setUp(self):
         from utils.models import TrackInfo
@@ -77,53 +184,7 @@ class DownloaderConversionTests(unittest.TestCase):
             service_name="Test Service",
             module_supported_modes=ModuleModes.download,
         )
-        self.global_settings = {
-            "general": {"download_quality": "hifi"},
-            "codecs": {"spatial_codecs": False, "proprietary_codecs": False},
-            "formatting": {
-                "force_album_format": False,
-                "single_full_path_format": "{name}",
-                "track_filename_format": "{track_number}. {name}",
-                "album_format": "{name}",
-                "enable_zfill": False,
-            },
-            "covers": {
-                "embed_cover": False,
-                "main_compression": "high",
-                "main_resolution": 1400,
-                "save_external": False,
-                "external_format": "jpg",
-                "external_compression": "low",
-                "external_resolution": 3000,
-                "save_animated_cover": False,
-            },
-            "lyrics": {
-                "embed_lyrics": False,
-                "embed_synced_lyrics": False,
-                "save_synced_lyrics": False,
-            },
-            "playlist": {
-                "save_m3u": False,
-                "paths_m3u": "absolute",
-                "extended_m3u": False,
-            },
-            "module_defaults": {
-                "lyrics": "default",
-                "covers": "default",
-                "credits": "default",
-            },
-            "advanced": {
-                "ignore_different_artists": True,
-                "codec_conversions": {"mp3": "aac"},
-                "conversion_flags": {},
-                "conversion_keep_original": False,
-                "cover_variance_threshold": 8,
-                "debug_mode": False,
-                "disable_subscription_checks": False,
-                "enable_undesirable_conversions": False,
-                "ignore_existing_files": False,
-            },
-        }
+        self.global_settings = build_global_settings()
         module_controls = {
             "module_list": [],
             "module_settings": {"test": module_info},
@@ -169,6 +230,853 @@ class DownloaderConversionTests(unittest.TestCase):
             )
 
 
+class FakeAssetService(FakeService):
+    def __init__(self, track_info, lyrics):
+        super().__init__(track_info)
+        self._lyrics = lyrics
+
+    def get_track_lyrics(self, *args, **kwargs):
+        return self._lyrics()
+
+    def get_track_credits(self, *args, **kwargs):
+        return [CreditsInfo("composer", ["Someone"])]
+
+
+class DownloaderAssetTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.track_info = TrackInfo(name="Test Track", album="Test Album", album_id="album123", artists=["Test Artist"],
+                                    tags=Tags(track_number=1, total_tracks=1), codec=CodecEnum.FLAC, cover_url="", release_year=2024)
+        self.global_settings = build_global_settings()
+        self.global_settings["lyrics"]["embed_lyrics"] = True
+        self.lyrics_started = threading.Event()
+        self.audio_started = threading.Event()
+
+    def build_downloader(self, lyrics):
+        module_info = ModuleInformation(service_name="Test Service", module_supported_modes=ModuleModes.download | ModuleModes.lyrics | ModuleModes.credits)
+        service = FakeAssetService(self.track_info, lyrics)
+        downloader = Downloader(self.global_settings, {"module_list": [], "module_settings": {"test": module_info}, "loaded_modules": {"test": service},
+                                                       "module_loader": lambda name: None}, Oprinter(), self.tempdir.name)
+        self.addCleanup(downloader.asset_pool.shutdown)
+        downloader.download_mode = DownloadTypeEnum.track
+        downloader.third_party_modules = {ModuleModes.covers: None, ModuleModes.lyrics: None, ModuleModes.credits: None}
+        downloader.service, downloader.service_name = service, "test"
+        return downloader
+
+    def download(self, downloader):
+        tagged = []
+
+        def fake_download_file(url, file_location, **kwargs):
+            self.audio_started.set()
+            # Only returns once the lyrics lookup started, which it can't if assets wait for the audio
+            self.assertTrue(self.lyrics_started.wait(5))
+            with open(file_location, "wb") as fh:
+                fh.write(b"audio")
+
+        with patch("orpheus.music_downloader.download_file", fake_download_file), \
+                patch("orpheus.music_downloader.tag_file", lambda *args, **kwargs: tagged.append(args)):
+            downloader.download_track("track123", cover_temp_location="cover.jpg")
+        return tagged
+
+    def test_lyrics_are_fetched_while_the_audio_downloads(self):
+        def lyrics():
+            self.lyrics_started.set()
+            self.assertTrue(self.audio_started.wait(5))
+            return SimpleNamespace(embedded="La la la", synced=None)
+
+        tagged = self.download(self.build_downloader(lyrics))
+        self.assertEqual(len(tagged), 1)
+        self.assertEqual(tagged[0][4], "La la la")
+        self.assertEqual(tagged[0][3], [CreditsInfo("composer", ["Someone"])])
+
+    def test_failed_lyrics_lookup_leaves_the_track_alone(self):
+        def lyrics():
+            self.lyrics_started.set()
+            raise ConnectionError("lyrics service unavailable")
+
+        stages = []
+        with patch("orpheus.music_downloader.delivery_pipeline.stage_transition", lambda *args, **kwargs: stages.append((args[2], args[3], kwargs))):
+            tagged = self.download(self.build_downloader(lyrics))
+        self.assertEqual(len(tagged), 1)
+        self.assertEqual(tagged[0][4], "")
+        self.assertEqual(tagged[0][3], [CreditsInfo("composer", ["Someone"])])
+        self.assertIn(("fetch_assets", "finished"), [(stage, state) for stage, state, metrics in stages if metrics.get("failed_assets") == "lyrics"])
+        self.assertIn(("finalize", "downloaded"), [(stage, state) for stage, state, _ in stages])
+
+
+class FakePlaylistService:
+    def __init__(self, track_ids):
+        self.track_ids = track_ids
+        # Every track must be in flight at once for the downloads to get past the barrier
+        self.barrier = threading.Barrier(len(track_ids), timeout=5)
+
+    def get_playlist_info(self, playlist_id, **kwargs):
+        return PlaylistInfo(name="Mix", creator="Someone", tracks=list(self.track_ids), release_year=2024)
+
+    def get_track_info(self, track_id, quality_tier, codec_options, **extra_kwargs):
+        return TrackInfo(
+            name=f"Song {track_id}",
+            album="Album",
+            album_id="album",
+            artists=["Artist"],
+            tags=Tags(),
+            codec=CodecEnum.MP3,
+            cover_url="",
+            release_year=2024,
+            download_extra_kwargs={"track_id": track_id},
+        )
+
+    def get_track_download(self, track_id):
+        self.barrier.wait()
+        # Later tracks finish first
+        time.sleep(0.02 * (len(self.track_ids) - self.track_ids.index(track_id)))
+        return TrackDownloadInfo(download_type=DownloadEnum.URL, file_url=f"https://example.invalid/{track_id}")
+
+
+class DownloaderConcurrencyTests(FakeModuleTestCase):
+    def setUp(self):
+        settings = build_global_settings()
+        settings["advanced"]["codec_conversions"] = {}
+        settings["playlist"]["save_m3u"] = True
+        settings["performance"] = {"max_parallel_tracks": 4}
+        self.set_up_downloader(FakePlaylistService(["a", "b", "c", "d"]), settings, DownloadTypeEnum.playlist)
+
+    def test_parallel_playlist_keeps_track_numbers_and_m3u_order(self):
+        tagged = {}
+
+        def fake_tag_file(file_path, image_path, track_info, *args, **kwargs):
+            tagged[track_info.name] = track_info.tags.track_number
+
+        with patch("orpheus.music_downloader.download_file", DownloaderConversionTests._fake_download_file), \
+                patch("orpheus.music_downloader.tag_file", fake_tag_file), \
+                patch("orpheus.music_downloader.silentremove"):
+            self.downloader.download_playlist("playlist1")
+
+        self.assertEqual(tagged, {"Song a": 1, "Song b": 2, "Song c": 3, "Song d": 4})
+        with open(os.path.join(self.tempdir.name, "Mix", "Mix.m3u"), encoding="utf-8") as fh:
+            entries = [os.path.basename(line.strip()) for line in fh if line.strip()]
+        self.assertEqual(entries, ["1. Song a.mp3", "2. Song b.mp3", "3. Song c.mp3", "4. Song d.mp3"])
+
+    def test_interrupt_stops_tracks_in_progress(self):
+        self.downloader.global_settings["performance"] = {"max_parallel_tracks": 2}
+        interrupted = threading.Event()
+        downloads, tagged = [], []
+
+        def fake_download_file(url, file_location, **kwargs):
+            downloads.append(url.rsplit("/", 1)[1])
+            if "Song a" not in file_location:
+                # Still downloading when ^C is pressed
+                interrupted.wait(timeout=5)
+            DownloaderConversionTests._fake_download_file(url, file_location, **kwargs)
+
+        def interrupt(context):
+            interrupted.set()
+            raise KeyboardInterrupt
+
+        self.service.get_track_download = lambda track_id: TrackDownloadInfo(download_type=DownloadEnum.URL, file_url=f"https://example.invalid/{track_id}")
+        self.downloader._wait_for_post_processing = interrupt
+        with patch("orpheus.music_downloader.download_file", fake_download_file), \
+                patch("orpheus.music_downloader.tag_file", lambda file_path, *args, **kwargs: tagged.append(file_path)):
+            with self.assertRaises(KeyboardInterrupt):
+                self.downloader.download_playlist("playlist1")
+            for thread in threading.enumerate():
+                if thread.name.startswith("orpheus-job"): thread.join(timeout=5)
+
+        # The other worker may have taken the next track by then, the last one never starts
+        self.assertIn("b", downloads)
+        self.assertNotIn("d", downloads)
+        self.assertFalse([file_path for file_path in tagged if "Song a" not in file_path])
+        self.assertTrue(self.downloader.tagging_pool._shutdown)
+
+    def test_metadata_prefetch_overlaps_with_audio_transfer(self):
+        self.downloader.global_settings["performance"] = {"max_parallel_tracks": 1, "metadata_prefetch_depth": 2}
+        resolved_during_transfer = {}
+        next_resolved = threading.Event()
+
+        def get_track_download(track_id):
+            if track_id == "b":
+                next_resolved.set()
+            return TrackDownloadInfo(download_type=DownloadEnum.URL, file_url=f"https://example.invalid/{track_id}")
+
+        def fake_download_file(url, file_location, *args, **kwargs):
+            if url.endswith("/a"):
+                resolved_during_transfer["b"] = next_resolved.wait(timeout=5)
+            DownloaderConversionTests._fake_download_file(url, file_location)
+
+        self.service.get_track_download = get_track_download
+        with patch("orpheus.music_downloader.download_file", fake_download_file), \
+                patch("orpheus.music_downloader.tag_file"), \
+                patch("orpheus.music_downloader.silentremove"):
+            self.downloader.download_playlist("playlist1")
+
+        self.assertEqual(resolved_during_transfer, {"b": True})
+        for track_id in ["a", "b", "c", "d"]:
+            self.assertTrue(os.path.isfile(os.path.join(self.tempdir.name, "Mix", f"{'abcd'.index(track_id) + 1}. Song {track_id}.mp3")))
+
+    def test_staged_pipeline_emits_stage_transitions_in_playlist_order(self):
+        self.downloader.global_settings["performance"] = {
+            "staged_pipeline": True,
+            "stage_workers": {"resolve": 4, "fetch_audio": 2, "tag": 2},
+            "stage_queue_size": 1,
+        }
+        self.downloader.job_id = "test-playlist-1"
+        events = []
+        brain.subscribe(EventType.DELIVERY, events.append)
+        self.addCleanup(brain._subscribers[EventType.DELIVERY].remove, events.append)
+
+        with patch("orpheus.music_downloader.download_file", DownloaderConversionTests._fake_download_file), \
+                patch("orpheus.music_downloader.tag_file"), \
+                patch("orpheus.music_downloader.silentremove"):
+            self.downloader.download_playlist("playlist1")
+
+        with open(os.path.join(self.tempdir.name, "Mix", "Mix.m3u"), encoding="utf-8") as fh:
+            entries = [os.path.basename(line.strip()) for line in fh if line.strip()]
+        self.assertEqual(entries, ["1. Song a.mp3", "2. Song b.mp3", "3. Song c.mp3", "4. Song d.mp3"])
+
+        transitions = [(event.metadata["track_id"], event.stage, event.status) for event in events if event.job_id == "test-playlist-1"]
+        for track_id in ["a", "b", "c", "d"]:
+            stages = [(stage, status) for event_track, stage, status in transitions if event_track == track_id]
+            self.assertEqual(stages[0], ("resolve", "started"))
+            self.assertEqual(stages[-1], ("finalize", "downloaded"))
+            self.assertEqual(len(stages), 12)
+
+    def test_forced_album_format_resolves_each_album_once_per_job(self):
+        self.downloader.global_settings["formatting"]["force_album_format"] = True
+        album_lookups, cover_saves = [], []
+
+        def get_album_info(album_id, **kwargs):
+            album_lookups.append(album_id)
+            # Slow enough for the other tracks to ask for the album meanwhile
+            time.sleep(0.05)
+            return AlbumInfo(name="Album", artist="Artist", tracks=list(self.service.track_ids), release_year=2024, cover_url="https://example.invalid/cover")
+
+        self.service.get_album_info = get_album_info
+        with patch("orpheus.music_downloader.download_file", DownloaderConversionTests._fake_download_file), \
+                patch("orpheus.music_downloader.tag_file"), \
+                patch("orpheus.music_downloader.silentremove"), \
+                patch.object(cover_cache, "save", lambda url, destination, *args, **kwargs: cover_saves.append(destination)):
+            self.downloader.start_job("forced-album")
+            self.downloader.download_playlist("playlist1")
+
+        self.assertEqual(album_lookups, ["album"])
+        self.assertEqual([os.path.abspath(destination) for destination in cover_saves], [os.path.join(os.path.abspath(self.tempdir.name), "Mix", "Album", "cover.jpg")])
+        self.assertEqual(sorted(name.split(". ", 1)[1] for name in os.listdir(os.path.join(self.tempdir.name, "Mix", "Album")) if name.endswith(".mp3")),
+                         ["Song a.mp3", "Song b.mp3", "Song c.mp3", "Song d.mp3"])
+
+        # The next job looks the album up again
+        self.downloader.start_job("forced-album-again")
+        self.downloader.dry_run = True
+        self.downloader.download_playlist("playlist1")
+        self.assertEqual(album_lookups, ["album", "album"])
+
+    def test_batch_track_info_replaces_per_track_lookups(self):
+        batches = []
+
+        def get_tracks_info(track_ids, quality_tier, codec_options, **kwargs):
+            batches.append(list(track_ids))
+            if len(batches) == 1:
+                raise ConnectionError("bulk endpoint unavailable")
+            return {track_id: FakePlaylistService.get_track_info(self.service, track_id, quality_tier, codec_options) for track_id in track_ids}
+
+        single_lookups = []
+        get_track_info = self.service.get_track_info
+        self.service.get_track_info = lambda track_id, *args, **kwargs: single_lookups.append(track_id) or get_track_info(track_id, *args, **kwargs)
+        self.service.get_tracks_info, self.service.tracks_info_batch_size = get_tracks_info, 3
+        with patch("orpheus.music_downloader.download_file", DownloaderConversionTests._fake_download_file), \
+                patch("orpheus.music_downloader.tag_file"), \
+                patch("orpheus.music_downloader.silentremove"):
+            self.downloader.download_playlist("playlist1")
+
+        # The failed batch falls back to one lookup per track, the other one needs none
+        self.assertEqual(batches, [["a", "b", "c"], ["d"]])
+        self.assertEqual(sorted(single_lookups), ["a", "b", "c"])
+        for track_id in ["a", "b", "c", "d"]:
+            self.assertTrue(os.path.isfile(os.path.join(self.tempdir.name, "Mix", f"{'abcd'.index(track_id) + 1}. Song {track_id}.mp3")))
+
+    def test_batch_track_info_follows_the_prefetch_lookahead(self):
+        self.service.track_ids = list("abcdef")
+        self.downloader.global_settings["performance"] = {"max_parallel_tracks": 1, "metadata_prefetch_depth": 1}
+        downloads, batches = [], []
+
+        def get_tracks_info(track_ids, quality_tier, codec_options, **kwargs):
+            # How many downloads had started when the batch was fetched
+            batches.append((list(track_ids), len(downloads)))
+            return {track_id: FakePlaylistService.get_track_info(self.service, track_id, quality_tier, codec_options) for track_id in track_ids}
+
+        def fake_download_file(url, file_location, **kwargs):
+            downloads.append(url.rsplit("/", 1)[1])
+            DownloaderConversionTests._fake_download_file(url, file_location, **kwargs)
+
+        self.service.get_tracks_info, self.service.tracks_info_batch_size = get_tracks_info, 2
+        self.service.get_track_download = lambda track_id: TrackDownloadInfo(download_type=DownloadEnum.URL, file_url=f"https://example.invalid/{track_id}")
+        with patch("orpheus.music_downloader.download_file", fake_download_file), \
+                patch("orpheus.music_downloader.tag_file"):
+            self.downloader.download_playlist("playlist1")
+
+        self.assertEqual([track_ids for track_ids, _ in batches], [["a", "b"], ["c", "d"], ["e", "f"]])
+        for track_ids, started in batches:
+            # A batch starts at most one prefetched track past the next download
+            self.assertLessEqual(self.service.track_ids.index(track_ids[0]), started + 1)
+        self.assertEqual(downloads, self.service.track_ids)
+
+    def test_track_index_avoids_repeated_searches(self):
+        searches = []
+
+        class FakeSearchModule:
+            def search(self, query_type, query, track_info=None):
+                searches.append(query)
+                return [SearchResult(result_id="x1", extra_kwargs={"market": "us"})]
+
+        self.downloader.loaded_modules["other"] = FakeSearchModule()
+        self.downloader.track_index = TrackIndex(os.path.join(self.tempdir.name, "track_index.db"))
+        self.addCleanup(self.downloader.track_index.close)
+        track_info = self.service.get_track_info("a", None, None)
+
+        first = self.downloader.find_track_on_module("other", track_info, "test", "a")
+        # A new job starts with an empty search memo, only the index remembers the match
+        self.downloader.start_job("job2")
+        second = self.downloader.find_track_on_module("other", track_info, "test", "a")
+
+        self.assertEqual(len(searches), 1)
+        self.assertEqual((first.result_id, first.extra_kwargs), (second.result_id, second.extra_kwargs))
+
+    def test_cover_matches_are_indexed_apart_from_search_matches(self):
+        lyrics_lookups, tested_covers, matching_covers = [], [], {"x2"}
+
+        class FakeThirdPartyModule:
+            def search(self, query_type, query, track_info=None):
+                return [SearchResult(result_id="x1"), SearchResult(result_id="x2")]
+
+            def get_track_cover(self, result_id, cover_options, **kwargs):
+                return CoverInfo(url=f"https://example.invalid/{result_id}.jpg", file_type=ImageFileTypeEnum.jpg)
+
+            def get_track_lyrics(self, track_id, **kwargs):
+                lyrics_lookups.append(track_id)
+                return LyricsInfo(embedded="Lyrics")
+
+        def evaluate_cover_candidates(cover_module, results, *args):
+            tested_covers.append([r.result_id for r in results])
+            for rank, r in enumerate(results, start=1):
+                yield rank, r, r.result_id, 1 if r.result_id in matching_covers else 20
+
+        # One module serves covers and lyrics, its cover match is its second search result
+        self.downloader.loaded_modules["other"] = FakeThirdPartyModule()
+        self.downloader.module_settings["other"] = ModuleInformation(service_name="Other", module_supported_modes=ModuleModes.covers | ModuleModes.lyrics)
+        self.downloader.third_party_modules.update({ModuleModes.covers: "other", ModuleModes.lyrics: "other"})
+        self.downloader.global_settings["lyrics"]["embed_lyrics"] = True
+        self.downloader.track_index = TrackIndex(os.path.join(self.tempdir.name, "track_index.db"))
+        self.addCleanup(self.downloader.track_index.close)
+        track_info = self.service.get_track_info("a", None, None)
+        context = SimpleNamespace(service=self.service, service_name="test", track_id="a", track_info=track_info,
+                                  track_location_name=os.path.join(self.tempdir.name, "a"), shared_cover_url=None)
+
+        with patch.object(cover_cache, "get", side_effect=lambda url, *args: url), \
+                patch("orpheus.music_downloader.CoverMatcher"), \
+                patch.object(self.downloader, "_evaluate_cover_candidates", evaluate_cover_candidates):
+            self.assertEqual(self.downloader._fetch_track_cover(context), "https://example.invalid/x2.jpg")
+            self.downloader._fetch_track_lyrics(context)
+            self.downloader.start_job("job2")
+            self.downloader._fetch_track_cover(context)
+            # The cover stops matching, which forgets the cover match but not the lyrics one
+            matching_covers.clear()
+            self.downloader._fetch_track_cover(context)
+            self.downloader._fetch_track_lyrics(context)
+
+        self.assertEqual(lyrics_lookups, ["x1", "x1"])
+        self.assertEqual(tested_covers, [["x1", "x2"], ["x2"], ["x2"]])
+        self.assertIs(self.downloader._lookup_track_index("other", track_info, "test", "a", "cover"), TrackIndex.MISS)
+        self.assertEqual(self.downloader._lookup_track_index("other", track_info, "test", "a").result_id, "x1")
+
+
+class FakeArtistService:
+    # Deluxe edition repeating the standard one, by ISRC (d1) and by title and duration (d2)
+    ALBUMS = {"std": ["s1", "s2"], "deluxe": ["d1", "d2", "d3"], "single": ["x1"]}
+    RECORDINGS = {
+        "s1": ("Intro", "ISRC1"), "s2": ("Song", None), "d1": ("Intro (Remastered)", "isrc1"), "d2": ("Song", None),
+        "d3": ("Bonus", "ISRC3"), "x1": ("Bonus", "ISRC3"), "t1": ("Loose", "ISRC4"),
+    }
+
+    def __init__(self):
+        self.downloaded = []
+        self.links_issued = self.links_valid_from = 0
+
+    def get_artist_info(self, artist_id, return_credited_albums, **kwargs):
+        return ArtistInfo(name="Artist", albums=list(self.ALBUMS), tracks=["s1", "t1"])
+
+    def get_album_info(self, album_id, **kwargs):
+        return AlbumInfo(name=album_id, artist="Artist", tracks=list(self.ALBUMS[album_id]), release_year=2024)
+
+    def get_track_info(self, track_id, quality_tier, codec_options, **extra_kwargs):
+        name, isrc = self.RECORDINGS[track_id]
+        self.links_issued += 1
+        return TrackInfo(name=name, album="Album", album_id="album", artists=["Artist"], tags=Tags(isrc=isrc), codec=CodecEnum.MP3,
+                         cover_url="", release_year=2024, duration=200,
+                         download_extra_kwargs={"track_id": track_id, "link": self.links_issued})
+
+    def get_track_download(self, track_id, link):
+        # Links handed out before the previous download have expired by now
+        if link <= self.links_valid_from:
+            raise ConnectionError(f"Link {link} of {track_id} expired")
+        self.links_valid_from = self.links_issued - 1
+        self.downloaded.append(track_id)
+        return TrackDownloadInfo(download_type=DownloadEnum.URL, file_url=f"https://example.invalid/{track_id}")
+
+
+class DownloaderArtistPlanTests(FakeModuleTestCase):
+    def setUp(self):
+        settings = build_global_settings()
+        settings["advanced"]["codec_conversions"] = {}
+        settings["artist_downloading"] = {"return_credited_albums": True, "separate_tracks_skip_downloaded": True}
+        self.set_up_downloader(FakeArtistService(), settings, DownloadTypeEnum.artist)
+
+    def test_recordings_are_downloaded_once(self):
+        track_numbers = {}
+
+        def fake_tag_file(file_path, image_path, track_info, *args, **kwargs):
+            track_numbers[track_info.tags.isrc or track_info.name] = track_info.tags.track_number
+
+        with patch("orpheus.music_downloader.download_file", DownloaderConversionTests._fake_download_file), \
+                patch("orpheus.music_downloader.tag_file", fake_tag_file), \
+                patch("orpheus.music_downloader.silentremove"):
+            self.downloader.download_artist("artist1")
+
+        self.assertEqual(self.service.downloaded, ["s1", "s2", "d3", "t1"])
+        # The deluxe bonus track keeps its number on the deluxe album
+        self.assertEqual(track_numbers["ISRC3"], 3)
+
+    def test_duplicate_recordings_can_be_kept(self):
+        self.downloader.global_settings["artist_downloading"]["skip_duplicate_recordings"] = False
+        plan = self.downloader._plan_artist(self.service.get_artist_info("artist1", True))
+
+        self.assertEqual([planned.album_id for planned in plan.albums], ["std", "deluxe", "single"])
+        self.assertEqual(plan.tracks, ["t1"])
+        self.assertEqual(plan.recording_keys, {})
+        self.assertEqual(self.service.links_issued, 0)
+
+    def test_static_track_info_is_not_fetched_again(self):
+        self.downloader.module_settings["test"].flags = ModuleFlags.static_track_info
+        lookups_before_download = []
+
+        def get_track_download(track_id, link):
+            lookups_before_download.append(self.service.links_issued)
+            self.service.downloaded.append(track_id)
+            return TrackDownloadInfo(download_type=DownloadEnum.URL, file_url=f"https://example.invalid/{track_id}")
+
+        self.service.get_track_download = get_track_download
+        with patch("orpheus.music_downloader.download_file", DownloaderConversionTests._fake_download_file), \
+                patch("orpheus.music_downloader.tag_file"), \
+                patch("orpheus.music_downloader.silentremove"):
+            self.downloader.download_artist("artist1")
+
+        self.assertEqual(self.service.downloaded, ["s1", "s2", "d3", "t1"])
+        # Every lookup happened while planning
+        self.assertEqual(set(lookups_before_download), {self.service.links_issued})
+
+    def test_dry_run_plans_paths_and_sizes_without_downloading(self):
+        existing = os.path.join(self.tempdir.name, "Artist", "std", "1. Intro.mp3")
+        os.makedirs(os.path.dirname(existing))
+        open(existing, "wb").close()
+        self.downloader.dry_run = True
+        head = SimpleNamespace(headers={"content-length": "1000"})
+
+        with patch("orpheus.music_downloader.network_manager.request", return_value=head) as request, \
+                patch("orpheus.music_downloader.download_file", side_effect=AssertionError("dry run downloaded a file")):
+            self.downloader.download_artist("artist1")
+
+        planned = {track.track_id: track for track in self.downloader.planned_tracks}
+        self.assertEqual(list(planned), ["s1", "s2", "d3", "t1"])
+        self.assertTrue(planned["s1"].exists)
+        self.assertEqual(planned["s2"].location, os.path.relpath(os.path.join(self.tempdir.name, "Artist", "std", "2. Song.mp3")))
+        self.assertEqual((planned["s2"].size, planned["s2"].size_source), (1000, "content-length"))
+        self.assertEqual(request.call_args_list[0][0][:2], ("HEAD", "https://example.invalid/s2"))
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir.name, "Artist", "deluxe")))
+
+        plan = DownloadPlan(self.tempdir.name, jobs=[PlannedJob("test", "artist", "artist1", tracks=self.downloader.planned_tracks)],
+                            bytes_per_second=1000, parallel_downloads=2)
+        location = os.path.join(self.tempdir.name, "plan.json")
+        plan.save(location)
+        summary = DownloadPlan.load(location).summary()
+        self.assertEqual((summary["existing"], summary["to_download"], summary["total_bytes"], summary["estimated_seconds"]), (1, 3, 3000, 2))
+
+    def test_dry_run_plans_refused_conversions_in_the_original_codec(self):
+        # Lossy to lossless conversions are refused without enable_undesirable_conversions
+        self.downloader.global_settings["advanced"].update({"codec_conversions": {"mp3": "flac"}, "enable_undesirable_conversions": False})
+        existing = os.path.join(self.tempdir.name, "Artist", "std", "1. Intro.mp3")
+        os.makedirs(os.path.dirname(existing))
+        open(existing, "wb").close()
+        self.downloader.dry_run = True
+
+        with patch("orpheus.music_downloader.network_manager.request", return_value=SimpleNamespace(headers={})):
+            self.downloader.download_artist("artist1")
+
+        planned = {track.track_id: track for track in self.downloader.planned_tracks}
+        self.assertTrue(planned["s1"].exists)
+        self.assertEqual(planned["s2"].location, os.path.relpath(os.path.join(self.tempdir.name, "Artist", "std", "2. Song.mp3")))
+
+
+class FakeConvertingService:
+    def __init__(self, track_ids):
+        self.track_ids = track_ids
+        self.downloads_started = {track_id: threading.Event() for track_id in track_ids}
+        self.cover_url = ""
+
+    def get_playlist_info(self, playlist_id, **kwargs):
+        return PlaylistInfo(name="Mix", creator="Someone", tracks=list(self.track_ids), release_year=2024)
+
+    def get_track_info(self, track_id, quality_tier, codec_options, **extra_kwargs):
+        return TrackInfo(name=f"Song {track_id}", album="Album", album_id="album", artists=["Artist"], tags=Tags(), codec=CodecEnum.MP3,
+                         cover_url=self.cover_url, release_year=2024, download_extra_kwargs={"track_id": track_id})
+
+    def get_track_download(self, track_id):
+        self.downloads_started[track_id].set()
+        return TrackDownloadInfo(download_type=DownloadEnum.URL, file_url=f"https://example.invalid/{track_id}")
+
+
+class DownloaderConversionPoolTests(FakeModuleTestCase):
+    def setUp(self):
+        settings = build_global_settings()
+        settings["advanced"]["enable_undesirable_conversions"] = True
+        settings["performance"] = {"max_parallel_tracks": 1, "metadata_prefetch_depth": 0}
+        self.set_up_downloader(FakeConvertingService(["a", "b"]), settings, DownloadTypeEnum.playlist)
+        # ffmpeg's temporary outputs stay out of the working directory's temp folder
+        temp_names = (os.path.join(self.tempdir.name, f"temp{i}") for i in itertools.count())
+        patcher = patch("orpheus.music_downloader.create_temp_filename", lambda: next(temp_names))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_conversion_overlaps_with_next_download(self):
+        events = []
+        brain.subscribe(EventType.DELIVERY, events.append)
+        self.addCleanup(brain._subscribers[EventType.DELIVERY].remove, events.append)
+        overlapped = []
+
+        def fake_run_ffmpeg(stream, feed=None):
+            args = ffmpeg.get_args(stream)
+            if "Song a" in args[args.index("-i") + 1]:
+                # The single download worker has moved on to the next track meanwhile
+                overlapped.append(self.service.downloads_started["b"].wait(timeout=5))
+            with open(args[-1], "wb") as fh:
+                fh.write(b"converted")
+            return 0.25
+
+        with patch("orpheus.music_downloader.download_file", DownloaderConversionTests._fake_download_file), \
+                patch("orpheus.music_downloader.run_ffmpeg", fake_run_ffmpeg), \
+                patch("orpheus.music_downloader.tag_file"):
+            self.downloader.download_playlist("playlist1")
+
+        self.assertEqual(overlapped, [True])
+        self.assertTrue(os.path.isfile(os.path.join(self.tempdir.name, "Mix", "1. Song a.m4a")))
+        conversions = [event for event in events if event.stage == "convert" and event.status == "finished"]
+        self.assertEqual(len(conversions), 2)
+        self.assertEqual(conversions[0].metadata["cpu_time"], "0.250")
+        self.assertIn("queue_wait", conversions[0].metadata)
+
+    def _download_tagging_threads(self):
+        self.downloader.global_settings["advanced"]["codec_conversions"] = {}
+        tagging = []
+
+        def fake_tag_file(file_path, *args, **kwargs):
+            if "Song a" in file_path:
+                # Concurrent downloads give the next track time to start before this one is tagged
+                self.service.downloads_started["b"].wait(timeout=0 if self.downloader.global_settings["performance"]["max_parallel_tracks"] == 1 else 5)
+                tagging.append((threading.current_thread().name, self.service.downloads_started["b"].is_set()))
+
+        with patch("orpheus.music_downloader.download_file", DownloaderConversionTests._fake_download_file), \
+                patch("orpheus.music_downloader.tag_file", fake_tag_file):
+            self.downloader.download_playlist("playlist1")
+
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tempdir.name, "Mix"))), ["1. Song a.mp3", "2. Song b.mp3"])
+        return tagging
+
+    def test_sequential_tracks_are_tagged_before_the_next_download(self):
+        [(thread_name, next_started)] = self._download_tagging_threads()
+
+        self.assertFalse(thread_name.startswith("orpheus-tag"))
+        self.assertFalse(next_started)
+
+    def test_sequential_converted_tracks_are_tagged_where_they_were_converted(self):
+        threads = {}
+
+        def fake_run_ffmpeg(stream, feed=None):
+            args = ffmpeg.get_args(stream)
+            threads.setdefault("convert", threading.current_thread().name)
+            with open(args[-1], "wb") as fh:
+                fh.write(b"converted")
+            return 0.25
+
+        def fake_tag_file(file_path, *args, **kwargs):
+            threads.setdefault("tag", threading.current_thread().name)
+
+        with patch("orpheus.music_downloader.download_file", DownloaderConversionTests._fake_download_file), \
+                patch("orpheus.music_downloader.run_ffmpeg", fake_run_ffmpeg), \
+                patch("orpheus.music_downloader.tag_file", fake_tag_file):
+            self.downloader.download_playlist("playlist1")
+
+        self.assertFalse(threads["tag"].startswith("orpheus-tag"))
+        self.assertEqual(threads["tag"], threads["convert"])
+
+    def test_tagging_overlaps_with_concurrent_downloads(self):
+        self.downloader.global_settings["performance"]["max_parallel_tracks"] = 2
+        [(thread_name, next_started)] = self._download_tagging_threads()
+
+        self.assertTrue(thread_name.startswith("orpheus-tag"))
+        self.assertTrue(next_started)
+
+    def test_tag_saving_failure_is_reported(self):
+        self.downloader.global_settings["advanced"]["codec_conversions"] = {}
+        self.downloader.start_job("job1")
+        events = []
+        brain.subscribe(EventType.DELIVERY, events.append)
+        self.addCleanup(brain._subscribers[EventType.DELIVERY].remove, events.append)
+
+        def fake_tag_file(file_path, *args, **kwargs):
+            if "Song b" in file_path:
+                raise TagSavingFailure
+
+        with patch("orpheus.music_downloader.download_file", DownloaderConversionTests._fake_download_file), \
+                patch("orpheus.music_downloader.tag_file", fake_tag_file):
+            self.downloader.download_playlist("playlist1")
+
+        self.assertEqual(self.downloader.tag_failures, ["b"])
+        tagged = {event.metadata["track_id"]: event.metadata for event in events if event.stage == "tag" and event.status == "finished"}
+        self.assertEqual(tagged["b"]["error"], "TagSavingFailure")
+        self.assertNotIn("error", tagged["a"])
+
+    def _download_streaming(self, fake_run_ffmpeg):
+        self.downloader.global_settings["performance"]["streaming_conversion"] = True
+        downloaded = []
+
+        def fake_download_file(url, file_location, **kwargs):
+            downloaded.append(url)
+            DownloaderConversionTests._fake_download_file(url, file_location)
+
+        def fake_stream_file(url, f, **kwargs):
+            f.write(b"audio of " + url.encode())
+
+        with patch("orpheus.music_downloader.download_file", fake_download_file), \
+                patch("orpheus.music_downloader.stream_file", fake_stream_file), \
+                patch("orpheus.music_downloader.run_ffmpeg", fake_run_ffmpeg), \
+                patch("orpheus.music_downloader.tag_file"):
+            self.downloader.download_playlist("playlist1")
+        return downloaded
+
+    def test_streaming_conversion_only_writes_the_converted_file(self):
+        inputs = []
+
+        def fake_run_ffmpeg(stream, feed=None):
+            args = ffmpeg.get_args(stream)
+            inputs.append(args[args.index("-i") + 1])
+            source = io.BytesIO()
+            feed(source)
+            with open(args[-1], "wb") as fh:
+                fh.write(b"converted " + source.getvalue())
+
+        downloaded = self._download_streaming(fake_run_ffmpeg)
+
+        self.assertEqual(downloaded, [])
+        self.assertEqual(inputs, ["pipe:", "pipe:"])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tempdir.name, "Mix"))), ["1. Song a.m4a", "2. Song b.m4a"])
+        with open(os.path.join(self.tempdir.name, "Mix", "2. Song b.m4a"), "rb") as fh:
+            self.assertEqual(fh.read(), b"converted audio of https://example.invalid/b")
+
+    def test_output_profiles_share_one_ffmpeg_run(self):
+        self.downloader.global_settings["advanced"]["output_profiles"] = {
+            "archive": {"codec": "mp3", "path_format": "Archive/{path}"},
+            "mobile": {"codec": "aac", "flags": {"b:a": "128k"}, "path_format": "Mobile/{artist}/{name}"},
+        }
+        runs = []
+
+        def fake_run_ffmpeg(stream, feed=None):
+            args = ffmpeg.get_args(stream)
+            runs.append(args)
+            for arg in args:
+                if arg.startswith(os.path.join(self.tempdir.name, "temp")):
+                    with open(arg, "wb") as fh:
+                        fh.write(b"converted")
+
+        with patch("orpheus.music_downloader.download_file", DownloaderConversionTests._fake_download_file), \
+                patch("orpheus.music_downloader.run_ffmpeg", fake_run_ffmpeg), \
+                patch("orpheus.music_downloader.tag_file") as tag_file_mock:
+            self.downloader.download_playlist("playlist1")
+
+        self.assertEqual(len(runs), 2)
+        self.assertEqual(runs[0].count("-i"), 1)
+        self.assertIn("copy", runs[0])
+        self.assertIn("128k", runs[0])
+        for location in ("Archive/Mix/1. Song a.mp3", "Archive/Mix/2. Song b.mp3", "Mobile/Artist/Song a.m4a", "Mobile/Artist/Song b.m4a"):
+            self.assertTrue(os.path.isfile(os.path.join(self.tempdir.name, location)), location)
+        # The playlist folder only keeps the playlist's own files
+        self.assertEqual([name for name in os.listdir(os.path.join(self.tempdir.name, "Mix")) if name.endswith((".mp3", ".m4a"))], [])
+        self.assertEqual(sorted(call.args[0] for call in tag_file_mock.call_args_list),
+                         sorted(os.path.relpath(os.path.join(self.tempdir.name, location)) for location in
+                                ("Archive/Mix/1. Song a.mp3", "Archive/Mix/2. Song b.mp3", "Mobile/Artist/Song a.m4a", "Mobile/Artist/Song b.m4a")))
+
+    def test_conversion_embeds_tags_and_cover(self):
+        self.downloader.global_settings["advanced"]["codec_conversions"] = {"mp3": "flac"}
+        self.service.track_ids = ["a"]
+        self.downloader.global_settings["covers"]["embed_cover"] = True
+        self.service.cover_url = "https://example.invalid/cover.jpg"
+        runs = []
+
+        def fake_run_ffmpeg(stream, feed=None):
+            args = ffmpeg.get_args(stream)
+            runs.append(args)
+            with open(args[-1], "wb") as fh:
+                fh.write(b"converted")
+
+        with patch("orpheus.music_downloader.download_file", DownloaderConversionTests._fake_download_file), \
+                patch("orpheus.music_downloader.run_ffmpeg", fake_run_ffmpeg), \
+                patch("orpheus.music_downloader.tag_file"):
+            self.downloader.download_playlist("playlist1")
+
+        args = runs[0]
+        self.assertEqual(args.count("-i"), 2)
+        self.assertIn("title=Song a", args)
+        self.assertIn("tracknumber=1", args)
+        self.assertEqual(args[args.index("-disposition:v") + 1], "attached_pic")
+
+    def test_streaming_conversion_falls_back_to_downloading_first(self):
+        def fake_run_ffmpeg(stream, feed=None):
+            args = ffmpeg.get_args(stream)
+            if feed:
+                raise ffmpeg.Error("ffmpeg", b"", b"moov atom not found")
+            with open(args[-1], "wb") as fh:
+                fh.write(b"converted")
+
+        downloaded = self._download_streaming(fake_run_ffmpeg)
+
+        self.assertEqual(len(downloaded), 2)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tempdir.name, "Mix"))), ["1. Song a.m4a", "2. Song b.m4a"])
+
+
+class CoverCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.cache = CoverCache(os.path.join(self.tempdir.name, "covers"), max_memory_bytes=10)
+        self.downloads = []
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def fake_download_file(self, url, file_location, **kwargs):
+        self.downloads.append((url, kwargs.get("artwork_settings")))
+        time.sleep(0.01)
+        with open(file_location, "wb") as fh:
+            fh.write(url.encode())
+
+    def test_concurrent_requests_download_each_cover_once(self):
+        settings = {"resolution": 1400, "format": "jpg"}
+        with patch("utils.cover_cache.download_file", self.fake_download_file):
+            threads = [threading.Thread(target=self.cache.get, args=("https://example.com/a.jpg", settings)) for _ in range(4)]
+            for thread in threads: thread.start()
+            for thread in threads: thread.join()
+            # Different artwork settings are a different cover
+            self.cache.get("https://example.com/a.jpg", {**settings, "resolution": 3000})
+
+        self.assertEqual(len(self.downloads), 2)
+        self.assertEqual(self.cache.stats()["hits"], 3)
+        self.assertEqual(self.cache.stats()["misses"], 2)
+
+    def test_memory_tier_is_bounded_lru(self):
+        with patch("utils.cover_cache.download_file", self.fake_download_file):
+            first = self.cache.get("abcd")
+            second = self.cache.get("efghijk")
+        self.assertEqual(self.cache.read(first), b"abcd")
+        self.assertEqual(self.cache.read(first), b"abcd")
+        # Reading the second cover pushes the first one out of the 10 byte memory tier
+        self.assertEqual(self.cache.read(second), b"efghijk")
+        self.cache.read(first)
+        stats = self.cache.stats()
+        self.assertEqual((stats["memory_hits"], stats["memory_misses"]), (1, 3))
+
+
+class CoverMatcherTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.reference = os.path.join(self.tempdir.name, "reference.jpg")
+        self.recompressed = os.path.join(self.tempdir.name, "recompressed.jpg")
+        self.other = os.path.join(self.tempdir.name, "other.jpg")
+        gradient = Image.linear_gradient("L").resize((800, 800))
+        cover = Image.merge("RGB", (gradient, gradient.rotate(90), gradient.rotate(180)))
+        cover.save(self.reference, quality=95)
+        cover.resize((400, 400)).save(self.recompressed, quality=60)
+        Image.merge("RGB", (gradient.rotate(270), gradient, gradient.rotate(90))).save(self.other, quality=90)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_same_threshold_decisions_as_compare_images(self):
+        matcher = CoverMatcher(self.reference)
+        self.assertEqual(matcher.candidate_resolution, 512)
+        self.assertLess(matcher.rms(self.recompressed), 8)
+        self.assertGreater(matcher.rms(self.other), 8)
+        self.assertGreater(compare_images(self.reference, self.other), 8)
+
+    @unittest.skipIf(cover_similarity.numpy is None, "NumPy is not installed")
+    def test_numpy_and_pillow_scores_agree(self):
+        vectorised = CoverMatcher(self.reference).rms(self.other)
+        with patch.object(cover_similarity, "numpy", None):
+            fallback = CoverMatcher(self.reference).rms(self.other)
+        self.assertAlmostEqual(vectorised, fallback, places=6)
+
+
+class CoverCandidateTests(unittest.TestCase):
+    def test_candidates_are_scored_concurrently_in_ranking_order(self):
+        scores = {"c1": 20, "c2": 5, "c3": 1, "c4": 1}
+        third_scored = threading.Event()
+        fetched = []
+
+        class FakeCoverModule:
+            def get_track_cover(self, result_id, cover_options, **kwargs):
+                fetched.append(result_id)
+                return CoverInfo(url=result_id, file_type=ImageFileTypeEnum.jpg)
+
+        class FakeMatcher:
+            def rms(self, location):
+                if location in ("c1", "c2"):
+                    # A lower ranked match finishing first must not win
+                    third_scored.wait(timeout=5)
+                elif location == "c3":
+                    third_scored.set()
+                return scores[location]
+
+        downloader = Downloader(build_global_settings(), {"module_list": [], "module_settings": {}, "loaded_modules": {}, "module_loader": None}, Oprinter(), "/tmp")
+        downloader.global_settings["performance"] = {"cover_candidate_workers": 3}
+        results = [SearchResult(result_id=f"c{i}") for i in range(1, 5)]
+        with patch("orpheus.music_downloader.download_to_temp", lambda url: url), \
+                patch("orpheus.music_downloader.silentremove"):
+            evaluations = []
+            for rank, result, url, rms in downloader._evaluate_cover_candidates(FakeCoverModule(), results, None, FakeMatcher(), 8):
+                evaluations.append((rank, rms))
+                if rms < 8: break
+
+        self.assertEqual(evaluations, [(1, 20), (2, 5)])
+        self.assertTrue(third_scored.is_set())
+        self.assertNotIn("c4", fetched)
+
+    def test_failing_candidates_are_not_matches(self):
+        class FakeCoverModule:
+            def get_track_cover(self, result_id, cover_options, **kwargs):
+                if result_id == "c1": raise ConnectionError("cover service unavailable")
+                return CoverInfo(url=result_id, file_type=ImageFileTypeEnum.jpg)
+
+        class FakeMatcher:
+            def rms(self, location):
+                if location == "c2": raise OSError("cannot identify image file")
+                return 1
+
+        downloader = Downloader(build_global_settings(), {"module_list": [], "module_settings": {}, "loaded_modules": {}, "module_loader": None}, Oprinter(), "/tmp")
+        # Settings read from settings.json can hold numbers as strings
+        downloader.global_settings["performance"] = {"cover_candidate_workers": "2"}
+        results = [SearchResult(result_id=f"c{i}") for i in range(1, 4)]
+        with patch("orpheus.music_downloader.download_to_temp", lambda url: url), \
+                patch("orpheus.music_downloader.silentremove"):
+            evaluations = [(rank, rms) for rank, result, url, rms in downloader._evaluate_cover_candidates(FakeCoverModule(), results, None, FakeMatcher(), 8)]
+
+        self.assertEqual(evaluations, [(3, 1)])
+
+
 class FakeEasyID3(dict):
     def __init__(self):
         super().__init__()
@@ -245,6 +1153,222 @@ class TaggingCommentTests(unittest.TestCase):
         self.assertEqual(comm_calls[0]["text"], comment_text)
 
 
+def write_flac(location):
+    # STREAMINFO of a 44.1kHz stereo 16 bit stream followed by a stand-in for the audio frames
+    stream_info = (4096).to_bytes(2, "big") * 2 + bytes(6) + ((44100 << 44) | (1 << 41) | (15 << 36) | 44100).to_bytes(8, "big") + bytes(16)
+    with open(location, "wb") as fh:
+        fh.write(b"fLaC" + bytes([0x80, 0, 0, len(stream_info)]) + stream_info + b"\xff\xf8" + bytes(4096))
+
+
+class FfmpegTaggingTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.location = os.path.join(self.tempdir.name, "track.flac")
+        write_flac(self.location)
+        self.cover = os.path.join(self.tempdir.name, "cover.jpg")
+        Image.new("RGB", (64, 64), "red").save(self.cover)
+        self.track_info = TrackInfo(name="Song", album="Album", album_id="album", artists=["Artist"], codec=CodecEnum.FLAC, cover_url="", release_year=2024,
+                                    explicit=False, tags=Tags(album_artist="Artist", track_number=3, total_tracks=12, disc_number=1, total_discs=1,
+                                                              genres=["Pop"], isrc="USABC2400001", copyright="2024 Label", label="Label",
+                                                              extra_tags={"MOOD": "Happy"}))
+        self.credits = [CreditsInfo("composer", ["Someone"])]
+
+    def test_file_with_the_tags_ffmpeg_writes_is_not_saved_again(self):
+        # Stands in for ffmpeg writing the metadata and the attached picture
+        flac = FLAC(self.location)
+        for key, value in ffmpeg_metadata(self.track_info, self.credits, "La la la", ContainerEnum.flac).items():
+            flac[key] = value
+        picture = Picture()
+        picture.type, picture.mime, picture.data = 3, "image/jpeg", open(self.cover, "rb").read()
+        flac.add_picture(picture)
+        flac.save()
+
+        with patch.object(FLAC, "save") as save:
+            tag_file(self.location, self.cover, self.track_info, self.credits, "La la la", ContainerEnum.flac)
+        save.assert_not_called()
+
+    @unittest.skipUnless(shutil.which("ffmpeg"), "ffmpeg is not installed")
+    def test_files_ffmpeg_converted_are_not_saved_again(self):
+        source = os.path.join(self.tempdir.name, "source.wav")
+        ffmpeg.input("sine=duration=1", f="lavfi").output(source, loglevel="error").run()
+        downloader = Downloader(build_global_settings(), {"module_list": [], "module_settings": {}, "loaded_modules": {}, "module_loader": None},
+                                Oprinter(), self.tempdir.name)
+        self.track_info.tags.release_date, self.track_info.tags.upc = "2024-05-17", "0123456789012"
+        credits_list = [CreditsInfo("Producer", ["Someone"])]
+        # ffmpeg's MP4 muxer has no names for the rating, ISRC, label or the other freeform atoms, tag_file adds those
+        m4a_info = TrackInfo(name="Song", album="Album", album_id="album", artists=["Artist"], codec=CodecEnum.AAC, cover_url="", release_year=2024,
+                             tags=Tags(album_artist="Artist", track_number=3, total_tracks=12, genres=["Pop"], copyright="2024 Label",
+                                       release_date="2024-05-17"))
+        # ID3 lyrics aren't written by ffmpeg either
+        for codec, track_info, credits, lyrics, cover in ((CodecEnum.FLAC, self.track_info, credits_list, "La la la", self.cover),
+                                                          (CodecEnum.MP3, self.track_info, credits_list, "", self.cover),
+                                                          (CodecEnum.AAC, m4a_info, [], "La la la", None)):
+            with self.subTest(codec=codec.name):
+                container = codec_data[codec].container
+                location = os.path.join(self.tempdir.name, f"converted.{container.name}")
+                downloader._encode(source, [ConversionOutput(location, codec, metadata=ffmpeg_metadata(track_info, credits, lyrics, container),
+                                                             cover=cover if container in FFMPEG_COVER_CONTAINERS else None)])
+                with open(location, "rb") as fh:
+                    converted = fh.read()
+
+                tag_file(location, cover, track_info, credits, lyrics, container, padding=64 * 1024)
+                with open(location, "rb") as fh:
+                    self.assertEqual(fh.read(), converted)
+
+    def test_untagged_file_is_tagged(self):
+        tag_file(self.location, self.cover, self.track_info, self.credits, "La la la", ContainerEnum.flac)
+        flac = FLAC(self.location)
+        self.assertEqual(flac["title"], ["Song"])
+        self.assertEqual(flac["tracknumber"], ["3"])
+        self.assertEqual(flac["mood"], ["Happy"])
+        self.assertEqual(len(flac.pictures), 1)
+
+    def test_padding_keeps_later_tag_changes_in_place(self):
+        tag_file(self.location, self.cover, self.track_info, self.credits, "", ContainerEnum.flac, padding=64 * 1024)
+        size = os.path.getsize(self.location)
+        self.assertGreaterEqual(FLAC(self.location).metadata_blocks[-1].length, 60 * 1024)
+
+        # Lyrics arriving later fit into the padding, the file keeps its size and the audio isn't moved
+        with open(self.location, "rb") as fh:
+            audio = fh.read()[-4096:]
+        tag_file(self.location, self.cover, self.track_info, self.credits, "La la la\n" * 500, ContainerEnum.flac, padding=64 * 1024)
+        self.assertEqual(os.path.getsize(self.location), size)
+        with open(self.location, "rb") as fh:
+            self.assertEqual(fh.read()[-4096:], audio)
+        self.assertEqual(FLAC(self.location)["lyrics"], ["La la la\n" * 500])
+
+    def test_m4a_metadata_uses_ffmpeg_names(self):
+        metadata = ffmpeg_metadata(self.track_info, [], "", ContainerEnum.m4a)
+        self.assertEqual(metadata["track"], "3/12")
+        self.assertEqual(metadata["album_artist"], "Artist")
+        self.assertNotIn("isrc", metadata)
+
+
+class RetagTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.library = os.path.join(self.tempdir.name, "library")
+        self.track_info = TrackInfo(name="Song", album="Album", album_id="album", artists=["Artist", "Guest"], codec=CodecEnum.FLAC, cover_url="",
+                                    release_year=2024, explicit=True,
+                                    tags=Tags(album_artist="Artist", track_number=3, total_tracks=12, disc_number=1, total_discs=2, genres=["Pop"],
+                                              isrc="USABC2400001", upc="0123456789012", release_date="2024-05-17", copyright="2024 Label",
+                                              label="Label", replay_gain="-6.5", replay_peak="0.98"))
+        self.credits = [CreditsInfo("composer", ["Someone", "Someone Else"]), CreditsInfo("MOOD", ["Happy"])]
+        self.locations = []
+        for album in ("A", "B"):
+            os.makedirs(os.path.join(self.library, album))
+            for number in range(3):
+                location = os.path.join(self.library, album, f"{number}.flac")
+                write_flac(location)
+                tag_file(location, None, self.track_info, self.credits, "La la la", ContainerEnum.flac)
+                self.locations.append(location)
+        self.checkpoint_location = os.path.join(self.tempdir.name, "checkpoint.txt")
+
+    def test_tags_read_back_the_way_they_were_written(self):
+        track_info, credits_list, lyrics = read_tags(self.locations[0], ContainerEnum.flac)
+        self.assertEqual((track_info.name, track_info.album, track_info.artists), ("Song", "Album", ["Artist", "Guest"]))
+        self.assertEqual((track_info.release_year, track_info.explicit), (2024, True))
+        self.assertEqual(track_info.tags, self.track_info.tags)
+        self.assertEqual(credits_list, self.credits)
+        self.assertEqual(lyrics, "La la la")
+
+    def test_files_already_tagged_like_this_are_left_alone(self):
+        report = retag_library(self.library, RetagCheckpoint(self.checkpoint_location), workers=1)
+        self.assertEqual((report.files, report.unchanged, report.retagged, report.failures), (6, 6, 0, {}))
+        self.assertFalse(os.path.exists(self.checkpoint_location))
+
+    def test_files_get_the_current_tagging(self):
+        # A file tagged under an older convention, with the label where it used to be
+        flac = FLAC(self.locations[0])
+        del flac["label"]
+        flac["organization"] = "Label"
+        flac.save()
+        with open(os.path.join(self.library, "broken.flac"), "wb") as fh:
+            fh.write(b"not audio")
+
+        with patch("orpheus.housekeeping.read_tags", side_effect=self._read_with_label):
+            report = retag_library(self.library, RetagCheckpoint(self.checkpoint_location), workers=1)
+        self.assertEqual((report.retagged, report.unchanged), (1, 5))
+        self.assertEqual(list(report.failures), [os.path.join(self.library, "broken.flac")])
+        self.assertEqual(FLAC(self.locations[0])["label"], ["Label"])
+
+        # Finished files are checkpointed, so running again only tries the one that failed
+        with open(self.checkpoint_location, encoding="utf-8") as fh:
+            self.assertEqual(sorted(fh.read().split()), sorted(self.locations))
+        report = retag_library(self.library, RetagCheckpoint(self.checkpoint_location), workers=1)
+        self.assertEqual((report.resumed, report.processed), (6, 1))
+
+    @staticmethod
+    def _read_with_label(location, container):
+        track_info, credits_list, lyrics = read_tags(location, container)
+        for credit in [credit for credit in credits_list if credit.type == "organization"]:
+            credits_list.remove(credit)
+            track_info.tags.label = credit.names[0]
+        return track_info, credits_list, lyrics
+
+    def test_process_pool_retags_every_file(self):
+        # tag_file drops the brands ffmpeg copies from MPEG-DASH sources
+        for location in self.locations:
+            flac = FLAC(location)
+            flac["major_brand"] = "dash"
+            flac.save()
+        report = retag_library(self.library, RetagCheckpoint(self.checkpoint_location), workers=2, batch_size=2)
+        self.assertEqual((report.retagged, report.failures), (6, {}))
+        self.assertTrue(all("major_brand" not in FLAC(location) for location in self.locations))
+        self.assertEqual(FLAC(self.locations[0])["title"], ["Song"])
+
+
+class CoreDownloadTests(unittest.TestCase):
+    def test_cleanup_runs_when_a_job_fails(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        session = SimpleNamespace(
+            settings={"global": build_global_settings()},
+            module_controls={"module_list": ["test"], "module_settings": {}, "loaded_modules": {}, "module_loader": lambda name: None},
+            # Only lyrics, so the job fails before downloading anything
+            module_settings={"test": ModuleInformation(service_name="Test Service", module_supported_modes=ModuleModes.lyrics)},
+            throughput_location=os.path.join(tempdir.name, "throughput.json"),
+            track_index_location=os.path.join(tempdir.name, "track_index.db"),
+        )
+        downloaders = []
+
+        def create_downloader(*args):
+            downloaders.append(Downloader(*args))
+            return downloaders[-1]
+
+        with patch("orpheus.core.Downloader", create_downloader), \
+                patch("orpheus.core.transfer_stats") as stats, \
+                patch.object(cover_cache, "clear") as clear_covers:
+            with self.assertRaises(Exception):
+                orpheus_core_download(session, {"test": [MediaIdentification(DownloadTypeEnum.track, "1")]}, {}, "default", tempdir.name)
+
+        stats.save.assert_called_once_with(session.throughput_location)
+        clear_covers.assert_called_once()
+        for pool in (downloaders[0].conversion_pool, downloaders[0].tagging_pool, downloaders[0].asset_pool):
+            self.assertTrue(pool._shutdown)
+
+
+class ModuleContractTests(unittest.TestCase):
+    def test_batch_track_info_support_is_reported(self):
+        class SingleModule(DownloadModule):
+            search = get_track_info = get_track_download = lambda self, *args, **kwargs: None
+
+        class BatchModule(SingleModule):
+            def get_tracks_info(self, track_ids, quality_tier, codec_options, **kwargs):
+                return {}
+
+        class LegacyModule:
+            get_track_info = get_track_download = get_tracks_info = lambda self, *args, **kwargs: None
+
+        self.assertFalse(has_contract_methods(SingleModule)["batch_track_info"])
+        self.assertFalse(supports_batch_track_info(SingleModule()))
+        self.assertTrue(has_contract_methods(BatchModule)["batch_track_info"])
+        self.assertTrue(supports_batch_track_info(BatchModule()))
+        self.assertTrue(has_contract_methods(LegacyModule)["batch_track_info"])
+
+
 class ModuleHealthCheckTests(unittest.TestCase):
     def setUp(self):
         self.orpheus = Orpheus.__new__(Orpheus)
@@ -0,0 +1,162 @@
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+
+import ffmpeg
+
+from orpheus.delivery import M3UPlaylist, OutputProfile, PipelineStage, SingleFlightMemo, StagedPipeline, load_output_profiles
+from orpheus.delivery.conversion import run_ffmpeg
+from utils.models import CodecEnum
+
+
+class StagedPipelineTests(unittest.TestCase):
+    def test_items_overlap_across_stages_and_come_back_in_order(self):
+        second_item_fetched = threading.Event()
+        overlapped = []
+
+        def fetch(item):
+            if item == 2:
+                second_item_fetched.set()
+
+        def convert(item):
+            if item == 1:
+                # Item 2 is fetched while item 1 is still converting
+                overlapped.append(second_item_fetched.wait(timeout=5))
+
+        pipeline = StagedPipeline([PipelineStage('fetch', fetch), PipelineStage('convert', convert)], queue_size=1)
+        self.assertEqual(list(pipeline.run([1, 2, 3])), [1, 2, 3])
+        self.assertEqual(overlapped, [True])
+
+    def test_finished_items_skip_later_stages(self):
+        tagged = []
+        finished = set()
+
+        def resolve(item):
+            if item % 2: finished.add(item)
+
+        pipeline = StagedPipeline([PipelineStage('resolve', resolve, workers=2), PipelineStage('tag', tagged.append)],
+                                  is_finished=lambda item: item in finished)
+        self.assertEqual(list(pipeline.run(range(6))), list(range(6)))
+        self.assertEqual(sorted(tagged), [0, 2, 4])
+
+    def test_stage_error_is_raised_and_queued_items_are_dropped(self):
+        started = []
+
+        def fetch(item):
+            started.append(item)
+            if item == 1:
+                raise ValueError('broken track')
+            time.sleep(0.01)
+
+        pipeline = StagedPipeline([PipelineStage('fetch', fetch)], queue_size=1)
+        results = []
+        with self.assertRaises(ValueError):
+            for item in pipeline.run(range(20)):
+                results.append(item)
+        self.assertEqual(results, [0])
+        self.assertLess(len(started), 20)
+
+
+
+class SingleFlightMemoTests(unittest.TestCase):
+    def test_concurrent_callers_share_one_computation(self):
+        memo = SingleFlightMemo()
+        calls = []
+        release = threading.Event()
+
+        def search():
+            calls.append(1)
+            release.wait(timeout=5)
+            return ['result']
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(memo.get(('lyrics', 'Song Artist', 'ISRC1'), search))) for _ in range(4)]
+        for thread in threads: thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in threads: thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [['result']] * 4)
+
+    def test_failures_are_not_remembered(self):
+        memo = SingleFlightMemo()
+
+        def fail():
+            raise ValueError('search failed')
+
+        with self.assertRaises(ValueError):
+            memo.get('key', fail)
+        self.assertEqual(memo.get('key', lambda: 'retried'), 'retried')
+
+
+
+class M3UPlaylistTests(unittest.TestCase):
+    def test_entries_are_written_in_playlist_order(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            location = os.path.join(tempdir, "Mix.m3u")
+            playlist = M3UPlaylist(location, extended=True, absolute_paths=False)
+            for index in (3, 1, 2):
+                track_info = SimpleNamespace(name=f"Song {index}", artists=["Artist"], duration=60 * index)
+                playlist.add(index, track_info, os.path.join(tempdir, f"{index}.flac"))
+            playlist.flush()
+
+            with open(location, encoding="utf-8") as fh:
+                content = fh.read()
+            self.assertEqual(os.listdir(tempdir), ["Mix.m3u"])
+
+        self.assertEqual(content, "#EXTM3U\n\n" + "".join(f"#EXTINF:{60 * i}, Artist - Song {i}\n{i}.flac\n\n" for i in (1, 2, 3)))
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+class FakeStream:
+    def __init__(self, code):
+        self.code = code
+
+    def run_async(self, pipe_stdin=False, pipe_stdout=False, pipe_stderr=False):
+        return subprocess.Popen([sys.executable, '-c', self.code], stdin=subprocess.PIPE if pipe_stdin else None,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+class RunFfmpegTests(unittest.TestCase):
+    def test_reports_cpu_time(self):
+        cpu_time = run_ffmpeg(FakeStream('import time\nend = time.process_time() + 0.2\nwhile time.process_time() < end: pass'))
+        if hasattr(os, 'wait4'):
+            self.assertGreaterEqual(cpu_time, 0.2)
+        else:
+            self.assertIsNone(cpu_time)
+
+    def test_failure_raises_with_stderr(self):
+        with self.assertRaises(ffmpeg.Error) as raised:
+            run_ffmpeg(FakeStream('import sys\nsys.stderr.write("Invalid data found")\nsys.exit(1)'))
+        self.assertIn(b'Invalid data found', raised.exception.stderr)
+
+    def test_feed_is_written_to_stdin(self):
+        stream = FakeStream('import sys\nsys.exit(0 if sys.stdin.buffer.read() == b"x" * 200000 else 1)')
+        run_ffmpeg(stream, lambda stdin: stdin.write(b'x' * 200000))
+
+    def test_feed_error_stops_ffmpeg(self):
+        def feed(stdin):
+            raise ConnectionError('connection reset')
+
+        with self.assertRaises(ConnectionError):
+            run_ffmpeg(FakeStream('import sys\nsys.stdin.buffer.read()'), feed)
+
+
+class OutputProfileTests(unittest.TestCase):
+    def test_profiles_from_settings(self):
+        archive, mobile = load_output_profiles({'archive': 'flac', 'mobile': {'codec': 'opus', 'flags': {'b:a': '160k'}, 'path_format': 'Mobile/{artist}/{name}'}})
+        self.assertEqual(archive, OutputProfile('archive', CodecEnum.FLAC))
+        self.assertEqual((mobile.codec, mobile.flags, mobile.path_format), (CodecEnum.OPUS, {'b:a': '160k'}, 'Mobile/{artist}/{name}'))
+
+    def test_unknown_codec_is_rejected(self):
+        with self.assertRaises(KeyError):
+            load_output_profiles({'mobile': 'mp5'})
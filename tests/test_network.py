@@ -1,10 +1,15 @@
+import io
+import json
+import os
 import socket
+import tempfile
 import unittest
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
 import requests
 
 from utils.network import NetworkError, NetworkErrorCode, network_manager
+from utils import utils
 
 
 class NetworkManagerTests(unittest.TestCase):
@@ -44,5 +49,160 @@ class NetworkManagerTests(unittest.TestCase):
         self.assertEqual(error.code, NetworkErrorCode.HTTP_ERROR)
 
 
+class FakeRangeResponse:
+    def __init__(self, body, status_code=200, headers=None):
+        self.body = body
+        self.status_code = status_code
+        self.headers = {'content-length': str(len(body)), **(headers or {})}
+
+    def iter_content(self, chunk_size=1):
+        for offset in range(0, len(self.body), chunk_size):
+            yield self.body[offset:offset + chunk_size]
+
+    def close(self):
+        pass
+
+
+class SegmentedDownloadTests(unittest.TestCase):
+    def setUp(self):
+        self.body = os.urandom(3 * 1024 * 1024 + 123)
+        self.requested_ranges = []
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.file_location = os.path.join(self.tempdir.name, 'track.flac')
+        self._original_settings = dict(utils.segmented_download_settings)
+        utils.configure_segmented_downloads(min_size_mb=1, max_segments=3)
+
+    def tearDown(self):
+        utils.segmented_download_settings.update(self._original_settings)
+        self.tempdir.cleanup()
+
+    def fake_request(self, honour_ranges):
+        def request(method, url, headers=None, **kwargs):
+            byte_range = (headers or {}).get('Range')
+            self.requested_ranges.append(byte_range)
+            if byte_range and honour_ranges:
+                start, end = (int(i) for i in byte_range[len('bytes='):].split('-'))
+                return FakeRangeResponse(self.body[start:end + 1], 206, {'content-range': f'bytes {start}-{end}/{len(self.body)}'})
+            return FakeRangeResponse(self.body, headers={'accept-ranges': 'bytes'})
+        return request
+
+    def test_ranged_download_reassembles_file(self):
+        with patch.object(network_manager, 'request', self.fake_request(honour_ranges=True)):
+            utils.download_file('https://example.com/track.flac', self.file_location)
+
+        with open(self.file_location, 'rb') as fh:
+            self.assertEqual(fh.read(), self.body)
+        self.assertEqual(len(self.requested_ranges), 3)
+        self.assertIsNone(self.requested_ranges[0])
+
+    def test_falls_back_to_single_stream_when_ranges_are_ignored(self):
+        with patch.object(network_manager, 'request', self.fake_request(honour_ranges=False)):
+            utils.download_file('https://example.com/track.flac', self.file_location)
+
+        with open(self.file_location, 'rb') as fh:
+            self.assertEqual(fh.read(), self.body)
+        self.assertEqual(self.requested_ranges[-1], None)
+
+
+
+class ResumableDownloadTests(unittest.TestCase):
+    def setUp(self):
+        self.body = os.urandom(64 * 1024)
+        self.etag = '"v1"'
+        self.requests = []
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.file_location = os.path.join(self.tempdir.name, 'track.flac')
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def request(self, method, url, headers=None, **kwargs):
+        headers = headers or {}
+        self.requests.append(headers)
+        byte_range = headers.get('Range')
+        if byte_range and headers.get('If-Range') == self.etag:
+            start = int(byte_range[len('bytes='):].rstrip('-'))
+            return FakeRangeResponse(self.body[start:], 206, {'content-range': f'bytes {start}-{len(self.body) - 1}/{len(self.body)}', 'etag': self.etag})
+        return FakeRangeResponse(self.body, headers={'etag': self.etag, 'accept-ranges': 'bytes'})
+
+    def write_part(self, data, etag):
+        with open(self.file_location + '.part', 'wb') as fh:
+            fh.write(data)
+        with open(self.file_location + '.part.json', 'w', encoding='utf-8') as fh:
+            json.dump({'length': len(self.body), 'etag': etag, 'last_modified': None}, fh)
+
+    def test_resumes_from_part_file(self):
+        self.write_part(self.body[:1000], self.etag)
+        with patch.object(network_manager, 'request', self.request):
+            utils.download_file('https://example.com/track.flac', self.file_location)
+
+        with open(self.file_location, 'rb') as fh:
+            self.assertEqual(fh.read(), self.body)
+        self.assertEqual(self.requests, [{'Range': 'bytes=1000-', 'If-Range': self.etag}])
+        self.assertFalse(os.path.exists(self.file_location + '.part'))
+        self.assertFalse(os.path.exists(self.file_location + '.part.json'))
+
+    def test_changed_file_restarts_from_zero(self):
+        self.write_part(b'stale bytes', '"v0"')
+        with patch.object(network_manager, 'request', self.request):
+            utils.download_file('https://example.com/track.flac', self.file_location)
+
+        with open(self.file_location, 'rb') as fh:
+            self.assertEqual(fh.read(), self.body)
+        self.assertEqual(len(self.requests), 1)
+
+    def test_truncated_transfer_keeps_part_file(self):
+        def truncated_request(method, url, headers=None, **kwargs):
+            response = FakeRangeResponse(self.body, headers={'etag': self.etag})
+            response.body = self.body[:5000]
+            return response
+
+        with patch.object(network_manager, 'request', truncated_request):
+            with self.assertRaises(Exception):
+                utils.download_file('https://example.com/track.flac', self.file_location)
+
+        self.assertFalse(os.path.exists(self.file_location))
+        self.assertEqual(os.path.getsize(self.file_location + '.part'), 5000)
+
+
+
+class TransferStatsTests(unittest.TestCase):
+    def test_saved_throughput_follows_recent_runs(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            location = os.path.join(tempdir, "throughput.json")
+            stats = utils.TransferStats()
+            stats.record(2 * 1024 * 1024, 1.0)
+            stats.save(location)
+            self.assertEqual(utils.TransferStats.load(location), 2 * 1024 * 1024)
+
+            stats.record(4 * 1024 * 1024, 1.0)
+            stats.save(location)
+            self.assertEqual(utils.TransferStats.load(location), 3 * 1024 * 1024)
+
+            # Runs that barely downloaded anything leave the estimate alone
+            stats.record(1000, 1.0)
+            stats.save(location)
+            self.assertEqual(utils.TransferStats.load(location), 3 * 1024 * 1024)
+
+
+class StreamWriterTests(unittest.TestCase):
+    def test_reads_raw_stream_into_buffer_and_batches_progress(self):
+        body = os.urandom(3 * 1024 * 1024 + 7)
+        response = FakeRangeResponse(body)
+        response.raw = io.BytesIO(body)
+        bar = MagicMock()
+        progress = utils._ProgressReporter(bar, interval=3600)
+
+        with tempfile.TemporaryFile() as fh:
+            written = utils._write_stream(response, fh, progress=progress)
+            progress.flush()
+            fh.seek(0)
+            self.assertEqual(fh.read(), body)
+
+        self.assertEqual(written, len(body))
+        # One redraw for the whole transfer instead of one per chunk
+        bar.update.assert_called_once_with(len(body))
+
+
 if __name__ == '__main__':
     unittest.main()
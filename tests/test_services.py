@@ -1,6 +1,11 @@
+import os
+import sqlite3
+import tempfile
+import time
 import unittest
+from unittest.mock import patch
 
-from orpheus.services import service_registry, session_manager
+from orpheus.services import EventType, MetadataCache, TrackIndex, brain, service_registry, session_manager
 
 
 class ServiceRegistryTests(unittest.TestCase):
@@ -38,5 +43,144 @@ class SessionManagerTests(unittest.TestCase):
         self.assertEqual(session.strategy, "arl")
 
 
+class TrackIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.index = TrackIndex(os.path.join(self.tempdir.name, "track_index.db"), ttl=100, negative_ttl=10)
+
+    def tearDown(self):
+        self.index.close()
+        self.tempdir.cleanup()
+
+    def test_store_and_lookup(self):
+        self.assertIs(self.index.lookup("tidal", 1, "ISRC1", "deezer"), TrackIndex.MISS)
+        self.index.store("tidal", 1, "ISRC1", "deezer", 42, {"region": "us"})
+        self.assertEqual(self.index.lookup("tidal", "1", "ISRC1", "deezer"), (42, {"region": "us"}))
+        self.assertIs(self.index.lookup("tidal", 1, None, "deezer"), TrackIndex.MISS)
+
+    def test_result_ids_keep_their_type(self):
+        self.index.store("tidal", 1, None, "deezer", 42)
+        self.index.store("tidal", 2, None, "deezer", "42")
+        self.assertEqual(self.index.lookup("tidal", 1, None, "deezer"), (42, {}))
+        self.assertIsInstance(self.index.lookup("tidal", 1, None, "deezer")[0], int)
+        self.assertIsInstance(self.index.lookup("tidal", 2, None, "deezer")[0], str)
+
+    def test_purposes_are_kept_apart(self):
+        self.index.store("tidal", 1, None, "deezer", "top")
+        self.index.store("tidal", 1, None, "deezer", "third", purpose="cover")
+        self.index.forget("tidal", 1, None, "deezer", "cover")
+        self.assertEqual(self.index.lookup("tidal", 1, None, "deezer"), ("top", {}))
+        self.assertIs(self.index.lookup("tidal", 1, None, "deezer", "cover"), TrackIndex.MISS)
+
+    def test_older_indexes_are_rebuilt(self):
+        location = os.path.join(self.tempdir.name, "old.db")
+        with sqlite3.connect(location) as connection:
+            connection.execute('CREATE TABLE track_map (source_service TEXT NOT NULL, source_id TEXT NOT NULL, isrc TEXT NOT NULL, '
+                               'target_service TEXT NOT NULL, result_id TEXT, extra_kwargs TEXT, updated REAL NOT NULL, '
+                               'PRIMARY KEY (source_service, source_id, isrc, target_service))')
+            connection.execute("INSERT INTO track_map VALUES ('tidal', '1', '', 'deezer', 'x', NULL, ?)", (time.time(),))
+        connection.close()
+        index = TrackIndex(location)
+        self.addCleanup(index.close)
+        self.assertIs(index.lookup("tidal", 1, None, "deezer"), TrackIndex.MISS)
+        index.store("tidal", 1, None, "deezer", "y")
+        self.assertEqual(index.lookup("tidal", 1, None, "deezer"), ("y", {}))
+
+    def test_negative_results_expire_sooner(self):
+        now = time.time()
+        self.index.store("tidal", 1, None, "deezer")
+        self.index.store("tidal", 2, None, "deezer", "7")
+        self.assertIsNone(self.index.lookup("tidal", 1, None, "deezer"))
+        with patch("orpheus.services.track_index.time.time", return_value=now + 50):
+            self.assertIs(self.index.lookup("tidal", 1, None, "deezer"), TrackIndex.MISS)
+            self.assertEqual(self.index.lookup("tidal", 2, None, "deezer"), ("7", {}))
+            self.index.prune()
+        self.assertIs(self.index.lookup("tidal", 1, None, "deezer"), TrackIndex.MISS)
+
+    def test_unserialisable_kwargs_are_not_stored(self):
+        self.index.store("tidal", 1, None, "deezer", "7", {"session": object()})
+        self.assertIs(self.index.lookup("tidal", 1, None, "deezer"), TrackIndex.MISS)
+
+
+class FakeMetadataModule:
+    def __init__(self):
+        self.calls = []
+        self.name = "fake"
+
+    def get_track_info(self, track_id, quality_tier, codec_options, **extra_kwargs):
+        self.calls.append(("track", track_id, quality_tier))
+        return {"id": track_id, "quality": quality_tier, "padding": "x" * 2000}
+
+    def get_tracks_info(self, track_ids, quality_tier, codec_options, **extra_kwargs):
+        self.calls.append(("tracks", tuple(track_ids), quality_tier))
+        return {track_id: {"id": track_id, "quality": quality_tier, "padding": "x" * 2000} for track_id in track_ids}
+
+    def get_album_info(self, album_id, **extra_kwargs):
+        self.calls.append(("album", album_id))
+        return {"id": album_id, "session": lambda: None}
+
+
+class MetadataCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.module = FakeMetadataModule()
+        self.cache = MetadataCache(os.path.join(self.tempdir.name, "metadata_cache"),
+                                   ttls={"track": 60, "album": 60})
+        self.service = self.cache.wrap("fake", self.module)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_repeated_calls_are_served_from_disk(self):
+        first = self.service.get_track_info("1", "HIFI", None)
+        # A new process sees the same entries
+        other = MetadataCache(self.cache.directory, ttls={"track": 60}).wrap("fake", self.module)
+        self.assertEqual(other.get_track_info("1", "HIFI", None), first)
+        self.service.get_track_info("1", "LOSSLESS", None)
+
+        self.assertEqual(self.module.calls, [("track", "1", "HIFI"), ("track", "1", "LOSSLESS")])
+        self.assertEqual(self.service.name, "fake")
+
+    def test_batches_share_entries_with_single_lookups(self):
+        self.service.get_track_info("1", "HIFI", None)
+        tracks = self.service.get_tracks_info(["1", "2", "3"], "HIFI", None)
+        self.assertEqual(sorted(tracks), ["1", "2", "3"])
+        self.assertEqual(self.service.get_track_info("3", "HIFI", None), tracks["3"])
+
+        # Only the tracks the cache didn't have were asked for, in one call
+        self.assertEqual(self.module.calls, [("track", "1", "HIFI"), ("tracks", ("2", "3"), "HIFI")])
+        self.assertEqual(self.cache.stats()["fake"], {"hits": 2, "misses": 3})
+
+    def test_entries_expire(self):
+        now = time.time()
+        self.service.get_track_info("1", "HIFI", None)
+        with patch("orpheus.services.metadata_cache.time.time", return_value=now + 120):
+            self.service.get_track_info("1", "HIFI", None)
+        self.assertEqual(len(self.module.calls), 2)
+
+    def test_unpicklable_results_are_not_cached(self):
+        self.service.get_album_info("a")
+        self.service.get_album_info("a")
+        self.assertEqual(self.module.calls, [("album", "a"), ("album", "a")])
+
+    def test_size_bound_evicts_least_recently_used(self):
+        self.cache.max_bytes = 200
+        for track_id in ("1", "2", "3"):
+            self.service.get_track_info(track_id, "HIFI", None)
+        self.assertLess(len(self.cache._entries()), 3)
+        self.assertLessEqual(self.cache._directory_size(), 200)
+
+    def test_hit_rates_are_reported_to_the_brain(self):
+        events = []
+        brain.subscribe(EventType.CACHE, events.append)
+        self.addCleanup(brain._subscribers[EventType.CACHE].remove, events.append)
+        for _ in range(4):
+            self.service.get_track_info("1", "HIFI", None)
+        self.cache.report()
+
+        self.assertEqual(len(events), 1)
+        self.assertEqual((events[0].service, events[0].hits, events[0].misses, events[0].hit_rate), ("fake", 3, 1, 0.75))
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,111 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from typing import Dict
+
+from utils.utils import download_file
+
+
+class CoverCache:
+    """
+    Content-addressed cache for cover art shared by every track of a job.
+
+    Covers are keyed by their URL plus the artwork settings they were fetched
+    with, so an album cover is downloaded (and resized) once and reused for
+    every track, the album folder and external cover files. Files live on disk
+    under `directory`; recently read image bytes are also kept in a bounded
+    in-memory LRU so tagging doesn't re-read the same JPEG for every track.
+    """
+
+    def __init__(self, directory: str = 'temp/covers', max_memory_bytes: int = 64 * 1024 * 1024):
+        self.directory = directory
+        self.max_memory_bytes = max_memory_bytes
+        self._memory: 'OrderedDict[tuple, bytes]' = OrderedDict()
+        self._memory_size = 0
+        self._lock = threading.Lock()
+        self._key_locks: Dict[str, threading.Lock] = {}
+        self._stats = dict.fromkeys(['hits', 'misses', 'memory_hits', 'memory_misses'], 0)
+
+    def configure(self, max_memory_mb: float = 64):
+        with self._lock:
+            self.max_memory_bytes = int(float(max_memory_mb) * 1024 * 1024)
+            self._evict()
+
+    @staticmethod
+    def key(url: str, artwork_settings: dict = None) -> str:
+        settings = json.dumps(artwork_settings or {}, sort_keys=True)
+        return hashlib.sha256(f'{url}\n{settings}'.encode('utf-8')).hexdigest()
+
+    def _count(self, stat: str):
+        with self._lock:
+            self._stats[stat] += 1
+
+    def _key_lock(self, key: str) -> threading.Lock:
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def get(self, url: str, artwork_settings: dict = None, headers: dict = None) -> str:
+        """
+        Returns the path of the cached cover, downloading it on a miss. Concurrent
+        callers asking for the same cover wait for a single download.
+        """
+        key = self.key(url, artwork_settings)
+        path = f'{self.directory}/{key}'
+        with self._key_lock(key):
+            if os.path.isfile(path):
+                self._count('hits')
+                return path
+            self._count('misses')
+            os.makedirs(self.directory, exist_ok=True)
+            download_file(url, path, headers=headers, artwork_settings=artwork_settings)
+        return path
+
+    def save(self, url: str, destination: str, artwork_settings: dict = None, headers: dict = None):
+        """Drop-in for download_file(url, destination, artwork_settings=...) served from the cache."""
+        if os.path.isfile(destination):
+            return
+        shutil.copyfile(self.get(url, artwork_settings, headers), destination)
+
+    def read(self, path: str) -> bytes:
+        """Reads an image file, serving recently used covers from memory."""
+        stat = os.stat(path)
+        memory_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            data = self._memory.get(memory_key)
+            if data is not None:
+                self._memory.move_to_end(memory_key)
+                self._stats['memory_hits'] += 1
+                return data
+            self._stats['memory_misses'] += 1
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        with self._lock:
+            if memory_key not in self._memory and len(data) <= self.max_memory_bytes:
+                self._memory[memory_key] = data
+                self._memory_size += len(data)
+                self._evict()
+        return data
+
+    def _evict(self):
+        # Caller holds the lock
+        while self._memory and self._memory_size > self.max_memory_bytes:
+            _, data = self._memory.popitem(last=False)
+            self._memory_size -= len(data)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats)
+
+    def clear(self):
+        """Forgets the memory tier, for when the temp folder holding the disk tier is removed."""
+        with self._lock:
+            self._memory.clear()
+            self._memory_size = 0
+            self._key_locks.clear()
+
+
+cover_cache = CoverCache()
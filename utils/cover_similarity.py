@@ -0,0 +1,54 @@
+import math
+
+from PIL import Image, ImageChops
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Covers are compared at this size, candidates are requested at most at twice that
+COMPARE_RESOLUTION = 256
+CANDIDATE_RESOLUTION = 2 * COMPARE_RESOLUTION
+
+
+def load_cover(image_location: str, resolution: int = COMPARE_RESOLUTION) -> Image.Image:
+    """Decodes a cover at a reduced size (JPEG draft mode scales down while decoding) and resizes it for comparison."""
+    with Image.open(image_location) as im:
+        im.draft('RGB', (resolution, resolution))
+        return im.convert('RGB').resize((resolution, resolution), Image.Resampling.BILINEAR)
+
+
+def _rms_pil(reference: Image.Image, candidate: Image.Image) -> float:
+    h = ImageChops.difference(reference, candidate).convert('L').histogram()
+    return math.sqrt(sum(count * (value ** 2) for value, count in enumerate(h)) / (reference.size[0] * reference.size[1]))
+
+
+class CoverMatcher:
+    """
+    Scores cover candidates against one reference cover with the same root mean
+    square measure as utils.utils.compare_images, but on downscaled images and,
+    when NumPy is installed, vectorised. The reference is decoded once per track.
+    """
+
+    def __init__(self, reference_location: str, resolution: int = COMPARE_RESOLUTION):
+        self.resolution = resolution
+        with Image.open(reference_location) as im:
+            self.reference_resolution = im.size[0]
+        self._reference = load_cover(reference_location, resolution)
+        self._reference_pixels = numpy.asarray(self._reference, dtype=numpy.int32) if numpy is not None else None
+
+    @property
+    def candidate_resolution(self) -> int:
+        """Resolution to request candidates at, no need to fetch them larger than what is compared."""
+        return min(self.reference_resolution, max(self.resolution, CANDIDATE_RESOLUTION))
+
+    def rms(self, candidate_location: str) -> float:
+        candidate = load_cover(candidate_location, self.resolution)
+        if self._reference_pixels is None:
+            return _rms_pil(self._reference, candidate)
+
+        difference = numpy.abs(self._reference_pixels - numpy.asarray(candidate, dtype=numpy.int32))
+        # Same fixed point luma weights as Pillow's RGB to L conversion
+        luma = (difference[..., 0] * 19595 + difference[..., 1] * 38470 + difference[..., 2] * 7471 + 0x8000) >> 16
+        return math.sqrt(float(numpy.mean(luma * luma)))
@@ -1,4 +1,5 @@
 import os
+import threading
 from dataclasses import dataclass, field
 from enum import Flag, auto
 from types import ClassMethodDescriptorType, FunctionType
@@ -9,10 +10,19 @@ from utils.utils import read_temporary_setting, set_temporary_setting
 
 class Oprinter:  # Could change to inherit from print class instead, but this is fine
     def __init__(self):
-        self.indent_number = 1
+        # Indentation is kept per thread so concurrent track downloads don't shift each other's output
+        self._local = threading.local()
         self.printing_enabled = True
         self.multiplier = 8
 
+    @property
+    def indent_number(self) -> int:
+        return getattr(self._local, 'indent_number', 1)
+
+    @indent_number.setter
+    def indent_number(self, value: int):
+        self._local.indent_number = value
+
     def set_indent_number(self, number: int):
         try:
             size = os.get_terminal_size().columns
@@ -138,6 +148,7 @@ class ModuleFlags(Flag):
     private = auto()
     uses_data = auto()
     needs_cover_resize = auto()
+    static_track_info = auto()  # TrackInfo holds no expiring links or tokens, so it can be fetched long before the download
 
 
 class ModuleModes(Flag):
@@ -1,10 +1,11 @@
-import pickle, errno, hashlib, math, os, re, operator
+import pickle, errno, hashlib, json, math, os, re, operator, threading, time
+from concurrent.futures import ThreadPoolExecutor
 from functools import reduce
 
 from tqdm import tqdm
 from PIL import Image, ImageChops
 
-from utils.network import NetworkError, network_manager
+from utils.network import NetworkError, NetworkErrorCode, network_manager
 
 
 def hash_string(input_str: str, hash_type: str = 'MD5'):
@@ -42,34 +43,322 @@ def configure_request_session(allow_insecure_requests: bool):
     network_manager.configure(allow_insecure_requests)
 
 
+segmented_download_settings = {
+    'min_size': 16 * 1024 * 1024,
+    'max_segments': 4
+}
+MIN_SEGMENT_SIZE = 1024 * 1024
+
+MIN_BUFFER_SIZE = 64 * 1024
+MAX_BUFFER_SIZE = 4 * 1024 * 1024
+PROGRESS_INTERVAL = 0.1
+
+
+def configure_segmented_downloads(min_size_mb=16, max_segments=4):
+    """
+    Set the thresholds for splitting downloads into byte ranges fetched over several connections.
+    """
+    segmented_download_settings['min_size'] = int(float(min_size_mb) * 1024 * 1024)
+    segmented_download_settings['max_segments'] = max(1, int(max_segments))
+
+
+class TransferStats:
+    """
+    Bytes and time spent on downloads, for transfer time estimates. The rate of
+    this run is blended into the one saved by earlier runs, so estimates follow
+    recent throughput.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def record(self, size: int, seconds: float):
+        with self._lock:
+            self.bytes += size
+            self.seconds += seconds
+
+    def throughput(self):
+        """Bytes per second of a single download in this run, None until something was downloaded."""
+        with self._lock:
+            return self.bytes / self.seconds if self.bytes and self.seconds > 0 else None
+
+    @staticmethod
+    def load(location):
+        try:
+            with open(location, 'r', encoding='utf-8') as f:
+                return json.load(f).get('bytes_per_second')
+        except (OSError, ValueError, AttributeError):
+            return None
+
+    def save(self, location, weight=0.5, min_bytes=1024 * 1024):
+        # Tiny runs (a cover or two) say little about the connection
+        if self.bytes < min_bytes or not self.throughput():
+            return
+        previous = self.load(location)
+        rate = self.throughput() if not previous else weight * self.throughput() + (1 - weight) * previous
+        with open(location, 'w', encoding='utf-8') as f:
+            json.dump({'bytes_per_second': rate, 'updated': time.time()}, f)
+        with self._lock:
+            self.bytes, self.seconds = 0, 0.0
+
+
+transfer_stats = TransferStats()
+
+
+class RangeNotSupported(Exception):
+    pass
+
+
+def _create_progress_bar(total, indent_level=0, initial=0):
+    try:
+        columns = os.get_terminal_size().columns
+        if os.name == 'nt':
+            return tqdm(total=total, unit='B', unit_scale=True, unit_divisor=1024, initial=initial, miniters=1, ncols=(columns-indent_level), bar_format=' '*indent_level + '{l_bar}{bar}{r_bar}')
+        else:
+            raise
+    except:
+        return tqdm(total=total, unit='B', unit_scale=True, unit_divisor=1024, initial=initial, miniters=1, bar_format=' '*indent_level + '{l_bar}{bar}{r_bar}')
+
+
+def _read_part_state(part_location):
+    # Returns the saved state and the offset to resume from, or (None, 0) if the .part file can't be trusted
+    try:
+        with open(part_location + '.json', 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        offset = os.path.getsize(part_location)
+    except (OSError, ValueError):
+        return None, 0
+    if not state.get('length') or not (state.get('etag') or state.get('last_modified')) or not 0 < offset < state['length']:
+        return None, 0
+    return state, offset
+
+
+def _write_part_state(part_location, response, total):
+    etag = response.headers.get('etag')
+    state = {
+        'length': total,
+        # Weak ETags can't be used with If-Range
+        'etag': etag if etag and not etag.startswith('W/') else None,
+        'last_modified': response.headers.get('last-modified')
+    }
+    if total and (state['etag'] or state['last_modified']):
+        with open(part_location + '.json', 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+    else:
+        silentremove(part_location + '.json')
+
+
+def _discard_part(part_location):
+    silentremove(part_location)
+    silentremove(part_location + '.json')
+
+
+def _plan_segments(response, total, headers):
+    # Only split plain, complete responses from servers that advertise byte ranges
+    if not total or 'Range' in headers or response.status_code != 200:
+        return None
+    if response.headers.get('accept-ranges', '').lower() != 'bytes' or response.headers.get('content-encoding', 'identity').lower() != 'identity':
+        return None
+    if total < segmented_download_settings['min_size'] or segmented_download_settings['max_segments'] < 2:
+        return None
+
+    count = max(2, min(segmented_download_settings['max_segments'], total // MIN_SEGMENT_SIZE))
+    size = -(-total // count)
+    return [(start, min(start + size, total) - 1) for start in range(0, total, size)]
+
+
+class _ProgressReporter:
+    """
+    Collects downloaded byte counts and passes them to the progress bar at most once per interval,
+    instead of redrawing it for every chunk. Shared by all segments of a download.
+    """
+    def __init__(self, bar=None, interval=PROGRESS_INTERVAL):
+        self.bar = bar
+        self.interval = interval
+        self._pending = 0
+        self._last_update = time.monotonic()
+        self._lock = threading.Lock()
+
+    def update(self, size):
+        if not self.bar:
+            return
+        with self._lock:
+            self._pending += size
+            now = time.monotonic()
+            if now - self._last_update >= self.interval:
+                self.bar.update(self._pending)
+                self._pending, self._last_update = 0, now
+
+    def flush(self):
+        with self._lock:
+            if self.bar and self._pending:
+                self.bar.update(self._pending)
+            self._pending = 0
+
+    def reset(self):
+        with self._lock:
+            self._pending = 0
+            if self.bar: self.bar.reset()
+
+
+def _write_chunks(response, f, length=None, progress=None, stop=None):
+    written = 0
+    for chunk in response.iter_content(chunk_size=MIN_BUFFER_SIZE):
+        if stop and stop.is_set():
+            raise KeyboardInterrupt
+        if not chunk:
+            continue
+        if length is not None:
+            chunk = chunk[:length - written]
+        f.write(chunk)
+        written += len(chunk)
+        if progress: progress.update(len(chunk))
+        if length is not None and written >= length:
+            break
+    return written
+
+
+def _write_stream(response, f, length=None, progress=None, stop=None):
+    raw = getattr(response, 'raw', None)
+    # The raw stream skips requests' content decoding, so it is only used for identity encoded bodies
+    if not hasattr(raw, 'readinto') or response.headers.get('content-encoding', 'identity').lower() != 'identity':
+        return _write_chunks(response, f, length, progress, stop)
+
+    buffer = bytearray(MAX_BUFFER_SIZE)
+    view = memoryview(buffer)
+    size, written = MIN_BUFFER_SIZE, 0
+    try:
+        while length is None or written < length:
+            if stop and stop.is_set():
+                raise KeyboardInterrupt
+            read_size = size if length is None else min(size, length - written)
+            start = time.monotonic()
+            count = raw.readinto(view[:read_size])
+            if not count:
+                break
+            f.write(view[:count])
+            written += count
+            if progress: progress.update(count)
+
+            # Grow the reads while the connection fills them quickly, shrink them when it is slow so progress keeps moving
+            elapsed = time.monotonic() - start
+            if count == read_size and elapsed < PROGRESS_INTERVAL / 4:
+                size = min(size * 2, MAX_BUFFER_SIZE)
+            elif elapsed > PROGRESS_INTERVAL:
+                size = max(size // 2, MIN_BUFFER_SIZE)
+    finally:
+        view.release()
+    return written
+
+
+def _preallocate(f, size):
+    # Reserves the blocks up front on POSIX, otherwise just sets the size
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except OSError:
+            pass
+    f.truncate(size)
+
+
+def _download_segments(url, file_location, headers, first_response, segments, total, progress=None):
+    stop = threading.Event()
+
+    def fetch_segment(index, start, end):
+        # The first segment reuses the response that was already opened at byte 0
+        if index == 0:
+            response = first_response
+        else:
+            response = network_manager.request('GET', url, headers={**headers, 'Range': f'bytes={start}-{end}'}, stream=True)
+            if response.status_code != 206 or not response.headers.get('content-range', '').startswith(f'bytes {start}-'):
+                response.close()
+                raise RangeNotSupported(url)
+        try:
+            with open(file_location, 'r+b') as f:
+                f.seek(start)
+                written = _write_stream(response, f, end - start + 1, progress, stop)
+        finally:
+            response.close()
+        if written != end - start + 1:
+            raise NetworkError(message=f'Connection closed early while downloading {url}', code=NetworkErrorCode.CONNECTION_FAILED, url=url)
+
+    # Preallocate so every segment can write at its own offset
+    with open(file_location, 'wb') as f:
+        _preallocate(f, total)
+
+    with ThreadPoolExecutor(max_workers=len(segments), thread_name_prefix='orpheus-segment') as executor:
+        futures = [executor.submit(fetch_segment, index, start, end) for index, (start, end) in enumerate(segments)]
+        try:
+            for future in futures:
+                future.result()
+        except BaseException:
+            stop.set()
+            for future in futures: future.cancel()
+            raise
+
+
 def download_file(url, file_location, headers=None, enable_progress_bar=False, indent_level=0, artwork_settings=None):
     headers = headers or {}
+    # Downloads only get their final name once complete, so an existing file is a finished one
     if os.path.isfile(file_location):
         return None
 
+    part_location = file_location + '.part'
+    state, offset = _read_part_state(part_location)
+    started = time.monotonic()
     try:
-        response = network_manager.request('GET', url, headers=headers, stream=True)
-        total = int(response.headers['content-length']) if 'content-length' in response.headers else None
+        response = None
+        if state:
+            # If-Range makes the server send the whole file instead if it changed since the last attempt
+            response = network_manager.request('GET', url, headers={**headers, 'Range': f'bytes={offset}-', 'If-Range': state['etag'] or state['last_modified']}, stream=True)
+            if response.status_code != 206 or response.headers.get('content-range') != f'bytes {offset}-{state["length"] - 1}/{state["length"]}':
+                offset = 0
+                if response.status_code != 200:
+                    response.close()
+                    response = None
+        if not response:
+            response = network_manager.request('GET', url, headers=headers, stream=True)
 
-        with open(file_location, 'wb') as f:
-            if enable_progress_bar and total:
+        if offset:
+            total = state['length']
+        else:
+            total = int(response.headers['content-length']) if 'content-length' in response.headers else None
+            _write_part_state(part_location, response, total)
+        bar = _create_progress_bar(total, indent_level, offset) if enable_progress_bar and total else None
+        progress = _ProgressReporter(bar)
+
+        try:
+            segments = _plan_segments(response, total, headers) if not offset else None
+            if segments:
                 try:
-                    columns = os.get_terminal_size().columns
-                    if os.name == 'nt':
-                        bar = tqdm(total=total, unit='B', unit_scale=True, unit_divisor=1024, initial=0, miniters=1, ncols=(columns-indent_level), bar_format=' '*indent_level + '{l_bar}{bar}{r_bar}')
-                    else:
-                        raise
-                except:
-                    bar = tqdm(total=total, unit='B', unit_scale=True, unit_divisor=1024, initial=0, miniters=1, bar_format=' '*indent_level + '{l_bar}{bar}{r_bar}')
-                for chunk in response.iter_content(chunk_size=1024):
-                    if chunk:
-                        f.write(chunk)
-                        bar.update(len(chunk))
-                bar.close()
-            else:
-                for chunk in response.iter_content(chunk_size=1024):
-                    if chunk:
-                        f.write(chunk)
+                    _download_segments(url, part_location, headers, response, segments, total, progress)
+                except RangeNotSupported:
+                    # The server ignored the range after all, start over with a single stream
+                    progress.reset()
+                    response = network_manager.request('GET', url, headers=headers, stream=True)
+                    segments = None
+                except BaseException:
+                    # A preallocated file already has the full size, so it can't be resumed
+                    _discard_part(part_location)
+                    raise
+            if not segments:
+                # Not preallocated: the size of the .part file is the offset to resume from
+                with open(part_location, 'ab' if offset else 'wb', buffering=0) as f:
+                    _write_stream(response, f, progress=progress)
+        finally:
+            progress.flush()
+            if bar: bar.close()
+
+        size = os.path.getsize(part_location)
+        if total and size != total:
+            raise NetworkError(message=f'Download of {url} stopped after {size} of {total} bytes', code=NetworkErrorCode.CONNECTION_FAILED, url=url)
+        os.replace(part_location, file_location)
+        silentremove(part_location + '.json')
+        transfer_stats.record(size - offset, time.monotonic() - started)
+
         if artwork_settings and artwork_settings.get('should_resize', False):
             new_resolution = artwork_settings.get('resolution', 1400)
             new_format = artwork_settings.get('format', 'jpeg')
@@ -87,15 +376,44 @@ def download_file(url, file_location, headers=None, enable_progress_bar=False, i
                 im.save(file_location, new_format, quality=new_compression)
         response.close()
     except KeyboardInterrupt:
-        if os.path.isfile(file_location):
-            print(f'\tDeleting partially downloaded file "{str(file_location)}"')
-            silentremove(file_location)
+        if os.path.isfile(part_location + '.json'):
+            print(f'\tKeeping partially downloaded file "{str(part_location)}" to resume later')
+        elif os.path.isfile(part_location):
+            print(f'\tDeleting partially downloaded file "{str(part_location)}"')
+            _discard_part(part_location)
         raise KeyboardInterrupt
     except NetworkError as exc:
         for hint in exc.hints:
             print(f'\tHint: {hint}')
         raise Exception(exc.message) from exc
 
+
+def stream_file(url, f, headers=None, enable_progress_bar=False, indent_level=0):
+    """
+    Writes the body of url to the file object f as it arrives, for consumers like an
+    ffmpeg pipe that never need the file on disk. Unlike download_file it can't resume
+    or split the download, and returns the number of bytes written.
+    """
+    started = time.monotonic()
+    try:
+        with network_manager.request('GET', url, headers=headers or {}, stream=True) as response:
+            total = int(response.headers['content-length']) if 'content-length' in response.headers else None
+            bar = _create_progress_bar(total, indent_level) if enable_progress_bar and total else None
+            progress = _ProgressReporter(bar)
+            try:
+                written = _write_stream(response, f, progress=progress)
+            finally:
+                progress.flush()
+                if bar: bar.close()
+        if total and written != total:
+            raise NetworkError(message=f'Download of {url} stopped after {written} of {total} bytes', code=NetworkErrorCode.CONNECTION_FAILED, url=url)
+    except NetworkError as exc:
+        for hint in exc.hints:
+            print(f'\tHint: {hint}')
+        raise Exception(exc.message) from exc
+    transfer_stats.record(written, time.monotonic() - started)
+    return written
+
 # root mean square code by Charlie Clark: https://code.activestate.com/recipes/577630-comparing-two-images/
 def compare_images(image_1, image_2):
     with Image.open(image_1) as im1, Image.open(image_2) as im2: